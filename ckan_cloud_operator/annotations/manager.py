@@ -29,6 +29,14 @@ def get_status(resource, prefix, status=None):
         return list(statuses)
 
 
+def set_value(resource, key, value):
+    _annotate(resource, f'{key}={value}')
+
+
+def get_value(resource, key, default=None):
+    return _get_annotation(resource, key, default)
+
+
 def _annotate(resource, *annotations, overwrite=True):
     label_prefix = labels_manager.get_label_prefix()
     kind = resource['kind']
@@ -1,24 +1,89 @@
-import subprocess
-import json
+"""Cloudflare API client
+
+Requests use a pooled HTTP session per credentials and are retried with backoff on rate-limit / server errors.
+Zone ids and the DNS records of each zone are fetched once and cached for the run (see clear_cache).
+"""
+import threading
+import time
+
+import requests
 
 from ckan_cloud_operator import logs
 
 
+API_URL = 'https://api.cloudflare.com/client/v4/'
+MAX_RETRIES = 6
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+__SESSIONS = {}
+__ZONE_IDS = {}
+__ZONE_RECORDS = {}
+__LOCK = threading.Lock()
+
+
+def clear_cache():
+    __ZONE_IDS.clear()
+    __ZONE_RECORDS.clear()
+
+
 def get_zone_id(auth_email, auth_key, zone_name):
-    data = curl(auth_email, auth_key, 'zones')
-    zones = [zone['id'] for zone in data['result'] if zone['name'] == zone_name]
-    return zones[0] if len(zones) > 0 else None
+    key = (auth_email, zone_name)
+    if key not in __ZONE_IDS:
+        data = request(auth_email, auth_key, f'zones?name={zone_name}')
+        zones = [zone['id'] for zone in data['result'] if zone['name'] == zone_name]
+        if len(zones) == 0:
+            return None
+        __ZONE_IDS[key] = zones[0]
+    return __ZONE_IDS[key]
+
+
+def list_zones(auth_email, auth_key, per_page=50):
+    zones = list_all(auth_email, auth_key, 'zones', per_page=per_page)
+    for zone in zones:
+        __ZONE_IDS[(auth_email, zone['name'])] = zone['id']
+    return zones
+
+
+def list_dns_records(auth_email, auth_key, zone_id, per_page=1000):
+    """Get all the DNS records of a zone, following the result pagination"""
+    return list_all(auth_email, auth_key, f'zones/{zone_id}/dns_records', per_page=per_page)
+
+
+def get_zone_records(auth_email, auth_key, zone_id):
+    """Get the A / CNAME records of a zone as {name: record}, the records are fetched once per run
+
+    Other record types (e.g. TXT / MX) may share a name with an A / CNAME record, they are not managed by the operator
+    """
+    key = (auth_email, zone_id)
+    if key not in __ZONE_RECORDS:
+        __ZONE_RECORDS[key] = {record['name']: record for record in list_dns_records(auth_email, auth_key, zone_id)
+                               if record['type'] in ['A', 'CNAME']}
+    return __ZONE_RECORDS[key]
+
+
+def batch_dns_records(auth_email, auth_key, zone_id, posts=None, puts=None, deletes=None, batch_size=200):
+    """Create, update and delete DNS records using the batch API, each batch is applied atomically"""
+    changes = [('deletes', {'id': record_id}) for record_id in (deletes or [])]
+    changes += [('puts', record) for record in (puts or [])]
+    changes += [('posts', record) for record in (posts or [])]
+    for i in range(0, len(changes), batch_size):
+        batch = {}
+        for change_type, change in changes[i:i + batch_size]:
+            batch.setdefault(change_type, []).append(change)
+        data = request(auth_email, auth_key, f'zones/{zone_id}/dns_records/batch', batch, 'POST')
+        assert data.get('success'), f'Failed to update DNS records: {data.get("errors")}'
+    __ZONE_RECORDS.pop((auth_email, zone_id), None)
 
 
 def get_zone_rate_limits(auth_email, auth_key, zone_name):
     zone_id = get_zone_id(auth_email, auth_key, zone_name)
-    return curl(auth_email, auth_key, f'zones/{zone_id}/rate_limits?page=1&per_page=1000')
+    assert zone_id is not None, f'Invalid zone name: {zone_name}'
+    return request(auth_email, auth_key, f'zones/{zone_id}/rate_limits?page=1&per_page=1000')
 
 
 def get_record_id(auth_email, auth_key, zone_id, record_name):
-    data = curl(auth_email, auth_key, f'zones/{zone_id}/dns_records?name={record_name}')
-    records = [record['id'] for record in data['result'] if record['name'] == record_name]
-    return records[0] if len(records) > 0 else None
+    record = get_zone_records(auth_email, auth_key, zone_id).get(record_name)
+    return record['id'] if record else None
 
 
 def is_ip(target_ip):
@@ -28,35 +93,76 @@ def is_ip(target_ip):
 def update_a_record(auth_email, auth_key, zone_name, record_name, target_ip):
     zone_id = get_zone_id(auth_email, auth_key, zone_name)
     assert zone_id is not None, f'Invalid zone name: {zone_name}'
-    record_id = get_record_id(auth_email, auth_key, zone_id, record_name)
+    zone_records = get_zone_records(auth_email, auth_key, zone_id)
+    record = zone_records.get(record_name)
 
     cf_record = {'type': 'A' if is_ip(target_ip) else 'CNAME',
                  'name': record_name, 'content': target_ip, 'ttl': 120, 'proxied': False}
 
-    if record_id:
-        print(f'Updating existing record {record_name}')
-        data = curl(auth_email, auth_key, f'zones/{zone_id}/dns_records/{record_id}', cf_record, 'PUT')
+    if record and all(record.get(k) == v for k, v in cf_record.items()):
+        logs.info(f'Record is up to date: {record_name}')
+        return
+    elif record:
+        logs.info(f'Updating existing record {record_name}')
+        data = request(auth_email, auth_key, f'zones/{zone_id}/dns_records/{record["id"]}', cf_record, 'PUT')
     else:
-        print(f'Creating new record: {record_name}')
-        data = curl(auth_email, auth_key, f'zones/{zone_id}/dns_records', cf_record, 'POST')
-    assert data.get('success')
+        logs.info(f'Creating new record: {record_name}')
+        data = request(auth_email, auth_key, f'zones/{zone_id}/dns_records', cf_record, 'POST')
+    assert data.get('success'), f'Failed to update DNS record: {data.get("errors")}'
+    zone_records[record_name] = data['result']
 
 
-def curl(auth_email, auth_key, urlpart, data=None, method='GET'):
-    logs.info(f'Running Cloudflare curl: {urlpart} {data} {method}')
-    logs.debug(f'{auth_email} / {auth_key}')
-    cmd = ['curl', '-s', '-X', method, f'https://api.cloudflare.com/client/v4/{urlpart}']
-    cmd += [
-        '-H', f'X-Auth-Email: {auth_email}',
-        '-H', f'X-Auth-Key: {auth_key}',
-        '-H', 'Content-Type: application/json'
-    ]
-    if data:
-        cmd += ['--data', json.dumps(data)]
-    logs.debug(*cmd)
-    output = subprocess.check_output(cmd)
+def list_all(auth_email, auth_key, urlpart, per_page=1000):
+    """Get all the results of a list endpoint, following the result pagination"""
+    results, page = [], 1
+    separator = '&' if '?' in urlpart else '?'
+    while True:
+        data = request(auth_email, auth_key, f'{urlpart}{separator}page={page}&per_page={per_page}')
+        assert data.get('success'), f'Failed to list {urlpart}: {data.get("errors")}'
+        results += data['result']
+        if page >= (data.get('result_info') or {}).get('total_pages', 1):
+            return results
+        page += 1
+
+
+def request(auth_email, auth_key, urlpart, data=None, method='GET'):
+    """Make a Cloudflare API request, retries with backoff on rate limit and server errors"""
+    logs.debug(f'Cloudflare API request: {method} {urlpart}')
+    session = _get_session(auth_email, auth_key)
+    for retry_num in range(MAX_RETRIES + 1):
+        try:
+            res = session.request(method, f'{API_URL}{urlpart}', json=data, timeout=60)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if retry_num == MAX_RETRIES:
+                raise
+            error, retry_after = e, None
+        else:
+            if res.status_code not in RETRY_STATUS_CODES or retry_num == MAX_RETRIES:
+                break
+            error, retry_after = res.status_code, res.headers.get('Retry-After')
+        sleep_seconds = int(retry_after) if retry_after and retry_after.isdigit() else min(2 ** retry_num, 60)
+        logs.warning(f'Cloudflare API request failed ({error}), retrying in {sleep_seconds} seconds')
+        time.sleep(sleep_seconds)
     try:
-        return json.loads(output)
-    except Exception:
-        logs.critical(f'Got invalid data from cloudflare curl: {output}')
+        return res.json()
+    except ValueError:
+        logs.critical(f'Got invalid data from cloudflare: {res.status_code} {res.text}')
         raise
+
+
+def curl(auth_email, auth_key, urlpart, data=None, method='GET'):
+    return request(auth_email, auth_key, urlpart, data, method)
+
+
+def _get_session(auth_email, auth_key):
+    key = (auth_email, auth_key)
+    with __LOCK:
+        if key not in __SESSIONS:
+            session = requests.Session()
+            session.headers.update({
+                'X-Auth-Email': auth_email or '',
+                'X-Auth-Key': auth_key or '',
+                'Content-Type': 'application/json'
+            })
+            __SESSIONS[key] = session
+        return __SESSIONS[key]
@@ -1,26 +1,44 @@
+import atexit
 import base64
+import json
 import os
+import time
 import yaml
 from sys import stdout
 
 from ckan_cloud_operator import kubectl
 from ckan_cloud_operator import logs
+from ckan_cloud_operator.drivers.kubectl import informer
 
 from ckan_cloud_operator.providers.cluster import manager as cluster_manager
 from ckan_cloud_operator.labels import manager as labels_manager
 
 
+# cached config values are refetched after the TTL, CKAN_CLOUD_OPERATOR_CONFIG_CACHE_TTL=0 disables the cache
+CACHE_TTL_SECONDS = int(os.environ.get('CKAN_CLOUD_OPERATOR_CONFIG_CACHE_TTL', '300'))
+
+# keys which are set on initialization and are not expected to change use a longer TTL
+STATIC_KEYS = ('label-prefix', 'short-label-prefix', 'crd-group', 'crd-prefix')
+STATIC_KEY_PREFIXES = ('installed-crd-',)
+STATIC_CACHE_TTL_SECONDS = int(os.environ.get('CKAN_CLOUD_OPERATOR_CONFIG_STATIC_CACHE_TTL', '3600'))
+
 __CACHED_VALUES = {}
+__CACHED_TIMES = {}
+__PREFETCHED_NAMESPACES = set()
+__SNAPSHOT_LOADED = False
+__SNAPSHOT_CHANGED = False
+__WATCHED_INFORMERS = {}
 
 
-def get(key=None, default=None, secret_name=None, configmap_name=None, namespace=None, required=False, template=None):
+def get(key=None, default=None, secret_name=None, configmap_name=None, namespace=None, required=False, template=None,
+        ttl=None):
+    """Get config values, ttl overrides the default cache TTL in seconds for this key"""
     cache_key = _get_cache_key(secret_name, configmap_name, namespace)
-    if cache_key not in __CACHED_VALUES:
-        __CACHED_VALUES[cache_key] = _fetch(cache_key)
+    values = _get_cached_values(cache_key, _get_ttl(key, ttl))
     if key:
-        value = __CACHED_VALUES[cache_key].get(key, default)
+        value = values.get(key, default)
     else:
-        value = __CACHED_VALUES[cache_key]
+        value = values
     assert value or not required, f'config value is required for {cache_key}:{key}'
     if template:
         if key:
@@ -45,6 +63,7 @@ def set(key=None, value=None, values=None, secret_name=None, configmap_name=None
             label_prefix = None
         if label_prefix:
             __CACHED_VALUES.setdefault(cache_key, {})['label-prefix'] = label_prefix
+            __CACHED_TIMES.setdefault(cache_key, time.time())
     logs.debug('start', **log_kwargs)
     if from_file:
         assert key and value and not values
@@ -59,6 +78,7 @@ def set(key=None, value=None, values=None, secret_name=None, configmap_name=None
 
 
 def delete_key(key, secret_name=None, namespace=None):
+    invalidate(secret_name=secret_name, namespace=namespace)
     kubectl.apply({
         'apiVersion': 'v1',
         'kind': 'Secret',
@@ -84,6 +104,49 @@ def delete(secret_name=None, configmap_name=None, namespace=None, exists_ok=Fals
 def delete_by_extra_operator_labels(extra_operator_labels):
     labels = labels_manager.get_resource_labels(extra_operator_labels)
     labels_manager.delete_by_labels(labels, kinds=['configmap', 'secret'])
+    # the names of the deleted objects are not known
+    clear_cache()
+
+
+def invalidate(secret_name=None, configmap_name=None, namespace=None):
+    """Remove the cached values of a config object, the next get will fetch it from the cluster"""
+    cache_key = _get_cache_key(secret_name, configmap_name, namespace)
+    __CACHED_VALUES.pop(cache_key, None)
+    __CACHED_TIMES.pop(cache_key, None)
+    _set_snapshot_changed()
+
+
+def clear_cache():
+    """Remove all cached values, including the on-disk snapshot values"""
+    __CACHED_VALUES.clear()
+    __CACHED_TIMES.clear()
+    __PREFETCHED_NAMESPACES.clear()
+    _set_snapshot_changed()
+
+
+def prefetch(namespace=None):
+    """Fetch all the operator config objects of a namespace using one labeled list call per kind
+
+    Enabled on first use of a namespace with CKAN_CLOUD_OPERATOR_CONFIG_PREFETCH=true
+    """
+    if not namespace:
+        namespace = cluster_manager.get_operator_namespace_name()
+    __PREFETCHED_NAMESPACES.add(namespace)
+    labels = {f'{labels_manager.get_label_prefix()}/operator-config-namespace': namespace}
+    fetched_time = time.time()
+    for kind in ['configmap', 'secret']:
+        for item in kubectl.get_items_by_labels(kind, labels, required=False, namespace=namespace) or []:
+            name = item['metadata']['name']
+            if kind == 'secret':
+                cache_key = _get_cache_key(name, None, namespace)
+                values = kubectl.decode_secret(item)
+            else:
+                cache_key = _get_cache_key(None, name, namespace)
+                values = item.get('data') or {}
+            __CACHED_VALUES[cache_key] = values
+            __CACHED_TIMES[cache_key] = fetched_time
+    logs.debug('prefetched operator configs', namespace=namespace, num_configs=len(__CACHED_VALUES))
+    _set_snapshot_changed()
 
 
 def list_configs(namespace=None, full=False, show_secrets=False):
@@ -182,6 +245,88 @@ def interactive_set(default_values, secret_name=None, configmap_name=None, names
     return set(values=set_values, secret_name=secret_name, configmap_name=configmap_name, namespace=namespace, extra_operator_labels=extra_operator_labels)
 
 
+def _get_ttl(key, ttl):
+    if ttl is not None:
+        return ttl
+    elif key and (key in STATIC_KEYS or key.startswith(STATIC_KEY_PREFIXES)):
+        return max(STATIC_CACHE_TTL_SECONDS, CACHE_TTL_SECONDS)
+    else:
+        return CACHE_TTL_SECONDS
+
+
+def _get_cached_values(cache_key, ttl):
+    _load_snapshot()
+    config_type, namespace, config_name = _parse_cache_key(cache_key)
+    if namespace not in __PREFETCHED_NAMESPACES and os.environ.get('CKAN_CLOUD_OPERATOR_CONFIG_PREFETCH') == 'true':
+        prefetch(namespace)
+    fetched_time = __CACHED_TIMES.get(cache_key)
+    if cache_key not in __CACHED_VALUES or fetched_time is None or ttl <= 0 or time.time() - fetched_time >= ttl:
+        __CACHED_VALUES[cache_key] = _fetch(cache_key)
+        __CACHED_TIMES[cache_key] = time.time()
+        if config_type == 'configmap':
+            _set_snapshot_changed()
+    return __CACHED_VALUES[cache_key]
+
+
+def _get_snapshot_context():
+    """The snapshot is valid only for the kubeconfig context it was created with"""
+    kubeconfig = os.environ.get('KUBECONFIG', os.path.expanduser('~/.kube/config')).split(os.pathsep)[0]
+    try:
+        with open(kubeconfig) as f:
+            current_context = (yaml.safe_load(f) or {}).get('current-context')
+    except OSError:
+        current_context = None
+    return f'{kubeconfig}:{current_context}'
+
+
+def _load_snapshot():
+    """Load the configmap values saved to CKAN_CLOUD_OPERATOR_CONFIG_SNAPSHOT by previous runs, secrets are not saved"""
+    global __SNAPSHOT_LOADED
+    if __SNAPSHOT_LOADED:
+        return
+    __SNAPSHOT_LOADED = True
+    filename = os.environ.get('CKAN_CLOUD_OPERATOR_CONFIG_SNAPSHOT')
+    if not filename or not os.path.exists(filename):
+        return
+    try:
+        with open(filename) as f:
+            snapshot = json.load(f)
+    except ValueError:
+        logs.warning(f'Invalid config snapshot, ignoring: {filename}')
+        return
+    if snapshot.get('context') == _get_snapshot_context():
+        for cache_key, cached in snapshot.get('configs', {}).items():
+            if cache_key not in __CACHED_VALUES:
+                __CACHED_VALUES[cache_key] = cached['values']
+                __CACHED_TIMES[cache_key] = cached['time']
+
+
+def _set_snapshot_changed():
+    global __SNAPSHOT_CHANGED
+    __SNAPSHOT_CHANGED = True
+
+
+def _save_snapshot():
+    """Save the cached configmap values, the snapshot is written once when the process exits, if values changed"""
+    global __SNAPSHOT_CHANGED
+    filename = os.environ.get('CKAN_CLOUD_OPERATOR_CONFIG_SNAPSHOT')
+    if not filename or not __SNAPSHOT_CHANGED:
+        return
+    __SNAPSHOT_CHANGED = False
+    snapshot = {
+        'context': _get_snapshot_context(),
+        'configs': {
+            cache_key: {'values': values, 'time': __CACHED_TIMES[cache_key]}
+            for cache_key, values in __CACHED_VALUES.items()
+            if cache_key.startswith('configmap:') and cache_key in __CACHED_TIMES
+        }
+    }
+    with open(f'{filename}.tmp', 'w') as f:
+        os.chmod(f'{filename}.tmp', 0o600)
+        json.dump(snapshot, f)
+    os.rename(f'{filename}.tmp', filename)
+
+
 def _fetch(cache_key):
     config_type, namespace, config_name = _parse_cache_key(cache_key)
     fetch_func = {
@@ -193,15 +338,39 @@ def _fetch(cache_key):
 
 
 def _fetch_secret(secret_name, namespace):
-    secret = kubectl.get(f'secret {secret_name}', required=False, namespace=namespace)
+    secret = _fetch_item('secret', secret_name, namespace)
     return kubectl.decode_secret(secret) if secret else None
 
 
 def _fetch_configmap(configmap_name, namespace):
-    configmap = kubectl.get(f'configmap {configmap_name}', required=False, namespace=namespace)
+    configmap = _fetch_item('configmap', configmap_name, namespace)
     return configmap['data'] if configmap else None
 
 
+def _fetch_item(config_type, config_name, namespace):
+    """Informers are used only for the operator namespace, configs in other namespaces (e.g. instance namespaces)
+    are fetched with a plain get and cached for the TTL, to avoid starting a watch for every namespace"""
+    if namespace == cluster_manager.get_operator_namespace_name():
+        _watch_invalidation(config_type, namespace)
+        return informer.get_item(config_type, config_name, namespace=namespace)
+    else:
+        return kubectl.get(f'{config_type} {config_name}', required=False, namespace=namespace)
+
+
+def _watch_invalidation(config_type, namespace):
+    """When informers are enabled, cached values are invalidated on changes, without waiting for the TTL"""
+    config_informer = informer.get_informer(config_type, namespace)
+    if config_informer and __WATCHED_INFORMERS.get((config_type, namespace)) is not config_informer:
+        __WATCHED_INFORMERS[(config_type, namespace)] = config_informer
+
+        def _on_event(event_type, obj):
+            cache_key = f'{config_type}:{namespace}:{obj["metadata"]["name"]}'
+            __CACHED_VALUES.pop(cache_key, None)
+            __CACHED_TIMES.pop(cache_key, None)
+
+        config_informer.add_handler(_on_event)
+
+
 def _save(cache_key, values, extra_operator_labels, dry_run=False):
     config_type, namespace, config_name = _parse_cache_key(cache_key)
     save_func = {
@@ -210,6 +379,9 @@ def _save(cache_key, values, extra_operator_labels, dry_run=False):
     }.get(config_type)
     assert save_func, f'Invalid config type: {config_type}'
     __CACHED_VALUES[cache_key] = res = save_func()
+    __CACHED_TIMES[cache_key] = time.time()
+    if config_type == 'configmap':
+        _set_snapshot_changed()
     return res
 
 
@@ -235,7 +407,12 @@ def _delete(cache_key, exists_ok=False):
     config_type, namespace, config_name = _parse_cache_key(cache_key)
     assert config_type in ['configmap', 'secret'], f'Invalid config type: {config_type}'
     ignore_not_found = ' --ignore-not-found' if exists_ok else ''
-    kubectl.check_call(f'delete{ignore_not_found} {config_type} {config_name}')
+    try:
+        kubectl.check_call(f'delete{ignore_not_found} {config_type} {config_name}')
+    finally:
+        __CACHED_VALUES.pop(cache_key, None)
+        __CACHED_TIMES.pop(cache_key, None)
+        _set_snapshot_changed()
 
 
 def _get_labels(cache_key=None, secret_name=None, configmap_name=None, namespace=None, extra_operator_labels=None):
@@ -263,3 +440,6 @@ def _get_cache_key(secret_name, configmap_name, namespace):
 def _parse_cache_key(cache_key):
     config_type, namespace, config_name = cache_key.split(':')
     return config_type, namespace, config_name
+
+
+atexit.register(_save_snapshot)
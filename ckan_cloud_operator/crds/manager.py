@@ -2,6 +2,7 @@ import hashlib
 
 from ckan_cloud_operator import kubectl
 from ckan_cloud_operator import logs
+from ckan_cloud_operator.drivers.kubectl import informer
 
 from ckan_cloud_operator.config import manager as config_manager
 from ckan_cloud_operator.labels import manager as labels_manager
@@ -34,6 +35,27 @@ def get(singular, *args, name=None, required=True, get_cmd='get', **kwargs):
     return kubectl.get(f'{crd_prefix}{kind_suffix}', *args, required=required, get_cmd=get_cmd, **kwargs)
 
 
+def get_cached(singular, name=None, labels=None, required=False):
+    """Get from the informer cache if informers are enabled, returns the same values as get"""
+    kind = get_resource_kind(singular)
+    crd_informer = informer.get_informer(kind)
+    if name:
+        name = get_resource_name(singular, name)
+        if crd_informer:
+            item = crd_informer.get(name)
+            assert item or not required, f'{kind} not found: {name}'
+            return item
+        else:
+            return kubectl.get(f'{kind} {name}', required=required)
+    elif crd_informer:
+        return {'items': crd_informer.list(labels)}
+    elif labels:
+        items = kubectl.get_items_by_labels(kind, labels, required=required)
+        return {'items': items} if items is not None else None
+    else:
+        return kubectl.get(kind, required=required)
+
+
 def edit(singular, *edit_args, name=None, **edit_kwargs):
     """Run kubectl.get for the given crd singular value and optional get args / kwargs"""
     crd_prefix = get_crd_prefix()
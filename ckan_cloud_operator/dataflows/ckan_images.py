@@ -1,6 +1,6 @@
 import os
 from dataflows import Flow, load, printer, checkpoint, dump_to_path, add_field
-from ckan_cloud_operator.gitlab import CkanGitlab
+from ckan_cloud_operator import gitlab
 
 
 def get_gitlab_repo(rows):
@@ -54,11 +54,7 @@ def parse_dockerfiles():
         else:
             yield from rows
 
-    def _get_dockerfile_row(gitlab_repo_name, gitlab_repo):
-        try:
-            dockerfile = CkanGitlab()._get_file(gitlab_repo_name, 'Dockerfile')
-        except Exception:
-            dockerfile = None
+    def _get_dockerfile_row(gitlab_repo_name, gitlab_repo, dockerfile):
         return {
             'gitlab_repo': gitlab_repo_name,
             'instances': [i['name'] for i in gitlab_repo['instances']],
@@ -75,8 +71,10 @@ def parse_dockerfiles():
         ]}})
         yield package.pkg
         yield from package
-        yield (_get_dockerfile_row(gitlab_repo_name, gitlab_repo) for gitlab_repo_name, gitlab_repo in
-               gitlab_repos.items())
+        # the Dockerfiles of all the repos are fetched concurrently
+        dockerfiles = gitlab.get_files([name for name in gitlab_repos if name], 'Dockerfile')
+        yield (_get_dockerfile_row(gitlab_repo_name, gitlab_repo, dockerfiles.get(gitlab_repo_name))
+               for gitlab_repo_name, gitlab_repo in gitlab_repos.items())
 
     return Flow(
         _parse_gitlab_repos,
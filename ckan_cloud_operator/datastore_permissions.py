@@ -1,3 +1,8 @@
+import traceback
+
+from ckan_cloud_operator import logs
+
+
 DATASTORE_PERMISSIONS_SQL_TEMPLATE = """
 CREATE OR REPLACE VIEW "_table_metadata" AS
     SELECT DISTINCT
@@ -53,3 +58,114 @@ DO $body$
     END;
 $body$;
 """
+
+# checks all the datastore read-only permissions using a single catalog query
+DATASTORE_PERMISSIONS_CHECK_SQL = """
+WITH ro AS (SELECT oid FROM pg_roles WHERE rolname = %(ro_user)s),
+     site AS (SELECT oid FROM pg_roles WHERE rolname = %(site_user)s),
+     public_ns AS (SELECT oid FROM pg_namespace WHERE nspname = 'public')
+SELECT
+    has_database_privilege(%(ro_user)s, current_database(), 'CONNECT') AS connect,
+    has_schema_privilege(%(ro_user)s, 'public', 'USAGE') AS usage,
+    NOT EXISTS (
+        SELECT 1 FROM pg_class
+        WHERE relnamespace = (SELECT oid FROM public_ns) AND relkind IN ('r', 'v', 'm', 'p')
+            AND relname != '_table_metadata' AND NOT has_table_privilege(%(ro_user)s, oid, 'SELECT')
+    ) AS select_tables,
+    EXISTS (
+        SELECT 1 FROM pg_default_acl d, aclexplode(d.defaclacl) a
+        WHERE d.defaclrole = (SELECT oid FROM site) AND d.defaclnamespace = (SELECT oid FROM public_ns)
+            AND d.defaclobjtype = 'r' AND a.grantee = (SELECT oid FROM ro) AND a.privilege_type = 'SELECT'
+    ) AS default_select,
+    EXISTS (
+        SELECT 1 FROM pg_class
+        WHERE relnamespace = (SELECT oid FROM public_ns) AND relname = '_table_metadata'
+            AND relowner = (SELECT oid FROM site) AND has_table_privilege(%(ro_user)s, oid, 'SELECT')
+    ) AND EXISTS (
+        SELECT 1 FROM pg_proc
+        WHERE pronamespace = (SELECT oid FROM public_ns) AND proname = 'populate_full_text_trigger'
+            AND proowner = (SELECT oid FROM site)
+    ) AND NOT EXISTS (
+        SELECT 1 FROM pg_class c
+        LEFT OUTER JOIN pg_trigger t ON t.tgrelid = c.oid AND t.tgname = 'zfulltext'
+        WHERE c.relnamespace = (SELECT oid FROM public_ns) AND c.relkind = 'r' AND t.tgname IS NULL
+    ) AS template
+"""
+
+
+def get_missing_permissions(conn, site_user, ro_user):
+    """Returns the names of the missing permissions, conn must be connected to the datastore db"""
+    with conn.cursor() as cur:
+        cur.execute(DATASTORE_PERMISSIONS_CHECK_SQL, {'site_user': site_user, 'ro_user': ro_user})
+        row = cur.fetchone()
+        return [column.name for column, value in zip(cur.description, row) if not value]
+
+
+def get_permissions_sql(db_name, site_user, ro_user, permissions):
+    """Returns the statements which grant the given permissions"""
+    statements = {
+        'connect': f'GRANT CONNECT ON DATABASE "{db_name}" TO "{ro_user}";',
+        'usage': f'GRANT USAGE ON SCHEMA public TO "{ro_user}";',
+        'select_tables': f'GRANT SELECT ON ALL TABLES IN SCHEMA public TO "{ro_user}";',
+        'default_select': f'ALTER DEFAULT PRIVILEGES FOR USER "{site_user}" IN SCHEMA public '
+                          f'GRANT SELECT ON TABLES TO "{ro_user}";',
+    }
+    return [statements[permission] for permission in permissions if permission in statements]
+
+
+def reconcile(conn, db_name, site_user, ro_user, dry_run=False):
+    """Apply only the missing datastore read-only permissions, returns the names of the missing permissions"""
+    missing_permissions = get_missing_permissions(conn, site_user, ro_user)
+    if missing_permissions and not dry_run:
+        with conn.cursor() as cur:
+            for statement in get_permissions_sql(db_name, site_user, ro_user, missing_permissions):
+                cur.execute(statement)
+        if 'template' in missing_permissions:
+            # the template grants and creates objects owned by the site user, it runs in a separate transaction
+            # so that a failure doesn't roll back the grants
+            conn.commit()
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(DATASTORE_PERMISSIONS_SQL_TEMPLATE.replace('{{SITE_USER}}', site_user)
+                                .replace('{{DS_RO_USER}}', ro_user))
+            except Exception:
+                conn.rollback()
+                traceback.print_exc()
+                logs.warning('Failed to set datastore sql template, continuing anyway', db_name=db_name)
+    return missing_permissions
+
+
+def reconcile_all(datastores, dry_run=False):
+    """Reconcile the permissions of multiple datastores, yields a result dict per datastore
+
+    :param datastores: list of (db_name, site_user, ro_user, db_prefix) tuples
+    """
+    from ckan_cloud_operator.drivers.postgres import driver as postgres_driver
+    from ckan_cloud_operator.providers.db import manager as db_manager
+    for db_name, site_user, ro_user, db_prefix in datastores:
+        res = {'db-name': db_name, 'ro-user': ro_user, 'db-prefix': db_prefix}
+        conn = None
+        try:
+            connection_string = db_manager.get_external_admin_connection_string(db_name=db_name, db_prefix=db_prefix)
+            # grants are per database, each datastore requires its own connection
+            with postgres_driver.connect(connection_string) as conn:
+                res['missing'] = reconcile(conn, db_name, site_user, ro_user, dry_run=dry_run)
+        except Exception as e:
+            res['error'] = str(e)
+        finally:
+            if conn is not None:
+                conn.close()
+        yield res
+
+
+def get_all_datastores():
+    """Get the (db_name, site_user, ro_user, db_prefix) of all datastores created by db migrations"""
+    from ckan_cloud_operator.providers.ckan.db import migration as ckan_db_migration_manager
+    datastores = []
+    for migration in ckan_db_migration_manager.get()['items']:
+        spec = migration['spec']
+        if spec.get('type') in ['deis-ckan', 'new-datastore'] and spec.get('datastore-name'):
+            ro_user = ckan_db_migration_manager.get_datastore_raedonly_user_name(spec['name'])
+            if ro_user:
+                datastores.append((spec['datastore-name'], spec['datastore-name'], ro_user, spec.get('db-prefix')))
+    return datastores
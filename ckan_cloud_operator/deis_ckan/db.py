@@ -1,6 +1,4 @@
-import traceback
-
-from ckan_cloud_operator.datastore_permissions import DATASTORE_PERMISSIONS_SQL_TEMPLATE
+from ckan_cloud_operator import datastore_permissions
 from ckan_cloud_operator.providers.db import manager as db_manager
 from ckan_cloud_operator.providers.ckan.db import migration as ckan_db_migration_manager
 from ckan_cloud_operator.drivers.postgres import driver as postgres_driver
@@ -19,24 +17,13 @@ class DeisCkanInstanceDb(object):
         assert self.db_type == 'datastore'
         db_name = self.db_spec['name']
         ro_user = self.instance.annotations.get_secret('datastoreReadonlyUser')
-        print(f'setting datastore permissions: {db_name} ({ro_user})')
-        with postgres_driver.connect(db_manager.get_external_admin_connection_string(db_name=db_name, db_prefix=self.db_prefix)) as conn:
-            with conn.cursor() as cur:
-                for line in [
-                    f"GRANT CONNECT ON DATABASE \"{db_name}\" TO \"{ro_user}\";",
-                    f"GRANT USAGE ON SCHEMA public TO \"{ro_user}\";",
-                    f"GRANT SELECT ON ALL TABLES IN SCHEMA public TO \"{ro_user}\";",
-                    f"ALTER DEFAULT PRIVILEGES FOR USER \"{db_name}\" IN SCHEMA public GRANT SELECT ON TABLES TO \"{ro_user}\";",
-                ]:
-                    cur.execute(line)
-                # site_user = self.instance.spec.db['name']
-                site_user = db_name
-                datastore_permissions = DATASTORE_PERMISSIONS_SQL_TEMPLATE.replace('{{SITE_USER}}', site_user).replace('{{DS_RO_USER}}', ro_user)
-                try:
-                    cur.execute(datastore_permissions)
-                except Exception:
-                    traceback.print_exc()
-                    print('Failed to set datastore sql template, continuing anyway')
+        # site_user = self.instance.spec.db['name']
+        site_user = db_name
+        connection_string = db_manager.get_external_admin_connection_string(db_name=db_name, db_prefix=self.db_prefix)
+        with postgres_driver.connect(connection_string) as conn:
+            missing_permissions = datastore_permissions.reconcile(conn, db_name, site_user, ro_user)
+        if missing_permissions:
+            print(f'set datastore permissions: {db_name} ({ro_user}): {missing_permissions}')
 
     def update(self):
         db_migration_name = self.db_spec.get('fromDbMigration')
@@ -1,4 +1,6 @@
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
 import yaml
 from ckan_cloud_operator import kubectl
 from ckan_cloud_operator import logs
@@ -19,14 +21,27 @@ class DeisCkanInstanceEnvvars(object):
             print('Applying instance envvars overrides')
             envvars.update(**self.instance.spec.envvars['overrides'])
 
-    def _update(self):
+    def _get_inputs(self):
+        """Resolve all the inputs of the envvars concurrently, returns a dict of input name: value"""
         spec = self.instance.spec
-        db_name = spec.db['name']
-        db_password = self.instance.annotations.get_secret('databasePassword')
-        datastore_name = spec.datastore['name']
-        datastore_password = self.instance.annotations.get_secret('datastorePassword')
-        datastore_ro_user = self.instance.annotations.get_secret('datastoreReadonlyUser')
-        datastore_ro_password = self.instance.annotations.get_secret('datatastoreReadonlyPassword')
+        from ckan_cloud_operator.providers.solr import manager as solr_manager
+        from ckan_cloud_operator.providers.storage import manager as storage_manager
+
+        def _get_source_envvars():
+            if 'fromSecret' in spec.envvars:
+                envvars = kubectl.get(f'secret {spec.envvars["fromSecret"]}')
+                return yaml.load(kubectl.decode_secret(envvars, 'envvars.yaml'))
+            elif 'fromGitlab' in spec.envvars:
+                return CkanGitlab().get_envvars(spec.envvars['fromGitlab'])
+            else:
+                raise Exception(f'invalid envvars spec: {spec.envvars}')
+
+        def _get_secrets():
+            # the annotations secret is fetched once and cached by the annotations object
+            return {key: self.instance.annotations.get_secret(key) for key in [
+                'databasePassword', 'datastorePassword', 'datastoreReadonlyUser', 'datatastoreReadonlyPassword'
+            ]}
+
         no_db_proxy = True
         # db_no_db_proxy = spec.db.get('no-db-proxy') == 'yes'
         # datastore_no_db_proxy = spec.datastore.get('no-db-proxy') == 'yes'
@@ -35,27 +50,46 @@ class DeisCkanInstanceEnvvars(object):
         #     no_db_proxy = True
         # else:
         #     no_db_proxy = False
-        from ckan_cloud_operator.providers.solr import manager as solr_manager
-        solr_http_endpoint = solr_manager.get_internal_http_endpoint()
-        solr_collection_name = spec.solrCloudCollection['name']
-        if 'fromSecret' in spec.envvars:
-            envvars = kubectl.get(f'secret {spec.envvars["fromSecret"]}')
-            envvars = yaml.load(kubectl.decode_secret(envvars, 'envvars.yaml'))
-        elif 'fromGitlab' in spec.envvars:
-            envvars = CkanGitlab().get_envvars(spec.envvars['fromGitlab'])
+        if no_db_proxy:
+            get_postgres_host_port = lambda: db_manager.get_internal_unproxied_db_host_port(db_prefix=spec.db.get('dbPrefix') or '')
         else:
-            raise Exception(f'invalid envvars spec: {spec.envvars}')
-        from ckan_cloud_operator.providers.storage import manager as storage_manager
-        storage_hostname, storage_access_key, storage_secret_key = storage_manager.get_provider().get_credentials()
-        storage_path_parts = spec.storage['path'].strip('/').split('/')
-        storage_bucket = storage_path_parts[0]
-        storage_path = '/'.join(storage_path_parts[1:])
+            get_postgres_host_port = db_manager.get_internal_proxy_host_port
+        input_getters = {
+            'envvars': _get_source_envvars,
+            'secrets': _get_secrets,
+            'solr-http-endpoint': solr_manager.get_internal_http_endpoint,
+            'storage-credentials': lambda: storage_manager.get_provider().get_credentials(),
+            'postgres-host-port': get_postgres_host_port,
+            'current-secret': lambda: kubectl.get('secret ckan-envvars', namespace=self.instance.id, required=False) or {},
+        }
+        with ThreadPoolExecutor(len(input_getters)) as executor:
+            futures = {name: executor.submit(getter) for name, getter in input_getters.items()}
+            inputs = {name: future.result() for name, future in futures.items()}
+        postgres_host, postgres_port = inputs['postgres-host-port']
         if no_db_proxy:
-            postgres_host, postgres_port = db_manager.get_internal_unproxied_db_host_port(db_prefix=spec.db.get('dbPrefix') or '')
             logs.info(f'Bypassing db proxy, connecting to DB directly: {postgres_host}:{postgres_port}')
         else:
-            postgres_host, postgres_port = db_manager.get_internal_proxy_host_port()
             logs.info(f'Connecting to DB proxy: {postgres_host}:{postgres_port}')
+        return inputs
+
+    def _update(self):
+        spec = self.instance.spec
+        inputs = self._get_inputs()
+        envvars = inputs['envvars']
+        secrets = inputs['secrets']
+        db_name = spec.db['name']
+        db_password = secrets['databasePassword']
+        datastore_name = spec.datastore['name']
+        datastore_password = secrets['datastorePassword']
+        datastore_ro_user = secrets['datastoreReadonlyUser']
+        datastore_ro_password = secrets['datatastoreReadonlyPassword']
+        solr_http_endpoint = inputs['solr-http-endpoint']
+        solr_collection_name = spec.solrCloudCollection['name']
+        storage_hostname, storage_access_key, storage_secret_key = inputs['storage-credentials']
+        storage_path_parts = spec.storage['path'].strip('/').split('/')
+        storage_bucket = storage_path_parts[0]
+        storage_path = '/'.join(storage_path_parts[1:])
+        postgres_host, postgres_port = inputs['postgres-host-port']
         envvars.update(
             CKAN_SQLALCHEMY_URL=f"postgresql://{db_name}:{db_password}@{postgres_host}:{postgres_port}/{db_name}",
             CKAN___BEAKER__SESSION__URL=f"postgresql://{db_name}:{db_password}@{postgres_host}:{postgres_port}/{db_name}",
@@ -81,7 +115,9 @@ class DeisCkanInstanceEnvvars(object):
             for k,v
             in envvars.items()
         }
-        kubectl.update_secret('ckan-envvars', envvars, namespace=self.instance.id)
+        # the secret is applied only if the digest of the rendered envvars differs from the current secret
+        kubectl.update_secret('ckan-envvars', envvars, namespace=self.instance.id,
+                              secret=inputs['current-secret'], skip_unchanged=True)
         self.site_url = envvars.get('CKAN_SITE_URL')
 
     def update(self):
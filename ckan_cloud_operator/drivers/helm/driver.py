@@ -1,9 +1,22 @@
+import json
+import os
 import subprocess
+import sys
+import time
+
+import yaml
 
 from ckan_cloud_operator import kubectl
 from ckan_cloud_operator import logs
 
 
+# chart repository indexes older than this are refreshed
+REPO_INDEX_TTL_SECONDS = int(os.environ.get('CKAN_CLOUD_OPERATOR_HELM_REPO_INDEX_TTL') or 600)
+
+__HELM_VERSION = None
+__UPDATED_REPOS = {}
+
+
 def init(tiller_namespace_name):
     if kubectl.get('ns', tiller_namespace_name, required=False):
         logs.info('namespace already exists')
@@ -38,7 +51,7 @@ def init(tiller_namespace_name):
     }
     kubectl.apply(tiller_service_account)
     kubectl.apply(cluster_role_binding)
-    if _check_helm_version() == 2:
+    if get_helm_version() == 2:
         subprocess.check_call(
             f'helm init --upgrade --stable-repo-url https://charts.helm.sh/stable --service-account {tiller_namespace_name}-tiller --history-max 10 --tiller-namespace {tiller_namespace_name}',
             shell=True
@@ -46,17 +59,33 @@ def init(tiller_namespace_name):
 
 
 def deploy(tiller_namespace, chart_repo, chart_name, chart_version, release_name, values_filename=None, namespace=None,
-           dry_run=False, chart_repo_name=None, values=None, service_account=None):
+           dry_run=False, chart_repo_name=None, values=None, service_account=None, skip_unchanged=False,
+           pre_dry_run=None):
+    """Install or upgrade a helm release, returns False if the upgrade was skipped
+
+    :param skip_unchanged: skip the upgrade if the deployed release has the same chart version and values (helm 3)
+    :param pre_dry_run: run a dry-run before the upgrade, defaults to CKAN_CLOUD_OPERATOR_HELM_PRE_DRY_RUN.
+                        if a debug log file is set the upgrade debug output (including the manifest) is written to it
+    """
     if not chart_repo_name:
         chart_repo_name = 'ckan-cloud'
         logs.info(chart_repo_name=chart_repo_name)
     if chart_repo:
-        subprocess.check_call(f'helm repo add "{chart_repo_name}" "{chart_repo}"', shell=True)
+        update_repo(chart_repo_name, chart_repo)
     assert not (values_filename and values), 'Only one of `values_filename` or `values` should be passed'
+    if pre_dry_run is None:
+        pre_dry_run = os.environ.get('CKAN_CLOUD_OPERATOR_HELM_PRE_DRY_RUN') == 'y'
+
+    if skip_unchanged and not dry_run and is_release_unchanged(
+        release_name, namespace, chart_name, chart_version,
+        _load_values_file(values_filename) if values_filename else _get_set_values(values)
+    ):
+        logs.info(f'helm release is up to date, skipping upgrade: {release_name}')
+        return False
 
     version_args = f'--version "{chart_version}"' if chart_version else ''
     dry_run_args = '--dry-run --debug'
-    tiller_cmd = '' if _check_helm_version() == 3 else f' --tiller-namespace {tiller_namespace}'
+    tiller_cmd = '' if get_helm_version() == 3 else f' --tiller-namespace {tiller_namespace}'
     cmd = f'helm upgrade {release_name} {chart_name} ' \
           f' --install --namespace "{namespace}" -i {version_args}'
     if values_filename:
@@ -65,23 +94,77 @@ def deploy(tiller_namespace, chart_repo, chart_name, chart_version, release_name
         for key, value in values.items():
             cmd += f' --set {key}={value}'
     cmd += tiller_cmd
-    logs.info('Running helm upgrade --dry-run')
-    if logs.CKAN_CLOUD_OPERATOR_DEBUG_FILE:
-        logs.info(f'helm dry run debug output is written to debug log file: {logs.CKAN_CLOUD_OPERATOR_DEBUG_FILE}')
-        with open(logs.CKAN_CLOUD_OPERATOR_DEBUG_FILE, 'a') as f:
-            subprocess.check_call(f'{cmd} {dry_run_args}', shell=True, stdout=f, stderr=subprocess.STDOUT)
-    else:
-        subprocess.check_call(f'{cmd} {dry_run_args}', shell=True)
+    if dry_run or pre_dry_run:
+        logs.info('Running helm upgrade --dry-run')
+        _check_call_debug(f'{cmd} {dry_run_args}')
     if not dry_run:
-        logs.info('Running helm upgrade for real this time')
-        subprocess.check_call(cmd, shell=True)
+        logs.info('Running helm upgrade')
+        if logs.CKAN_CLOUD_OPERATOR_DEBUG_FILE:
+            _check_call_debug(f'{cmd} --debug')
+        else:
+            subprocess.check_call(cmd, shell=True)
+    return True
 
 
 def delete(tiller_namespace, release_name):
-    tiller_cmd = '' if _check_helm_version() == 3 else f' --tiller-namespace {tiller_namespace}'
+    tiller_cmd = '' if get_helm_version() == 3 else f' --tiller-namespace {tiller_namespace}'
     subprocess.check_call(f'helm delete --purge --timeout 5 {release_name}' + tiller_cmd, shell=True)
 
 
+def get_helm_version():
+    """Returns the major helm client version, detected once per run"""
+    global __HELM_VERSION
+    if not __HELM_VERSION:
+        __HELM_VERSION = 3 if 'v3.' in str(subprocess.check_output('helm version -c', shell=True)) else 2
+    return __HELM_VERSION
+
+
+def get_latest_chart_version(chart_repo, chart_name, chart_repo_name='ckan-cloud'):
+    """Returns the latest stable version of a chart (e.g. `ckan-cloud/ckan`) from the cached repository index"""
+    update_repo(chart_repo_name, chart_repo)
+    return _get_repo_latest_chart_version(chart_name)
+
+
+def update_repo(chart_repo_name, chart_repo):
+    """Add / refresh a chart repository, skipped if the repository index was refreshed recently"""
+    if __UPDATED_REPOS.get(chart_repo_name) == chart_repo:
+        return
+    index_filename = _get_repo_index_filename(chart_repo_name)
+    if (
+        index_filename and os.path.exists(index_filename)
+        and time.time() - os.path.getmtime(index_filename) < REPO_INDEX_TTL_SECONDS
+        and _get_repo_urls().get(chart_repo_name) == chart_repo
+    ):
+        logs.debug(f'helm repo index is up to date: {chart_repo_name}')
+    else:
+        subprocess.check_call(f'helm repo add "{chart_repo_name}" "{chart_repo}"', shell=True)
+    __UPDATED_REPOS[chart_repo_name] = chart_repo
+
+
+def is_release_unchanged(release_name, namespace, chart_name, chart_version, values):
+    """Compare the deployed release chart version and values to the given chart version and values (helm 3 only)"""
+    if get_helm_version() != 3:
+        return False
+    releases = json.loads(subprocess.check_output(
+        f'helm list -n "{namespace}" --filter "^{release_name}$" -o json', shell=True
+    ))
+    if len(releases) != 1 or releases[0].get('status') != 'deployed':
+        return False
+    chart_version = chart_version or _get_repo_latest_chart_version(chart_name)
+    if not chart_version or releases[0].get('chart') != f'{chart_name.split("/")[-1]}-{chart_version}':
+        logs.debug('helm release chart changed', deployed_chart=releases[0].get('chart'), chart_version=chart_version)
+        return False
+    deployed_values = json.loads(subprocess.check_output(
+        f'helm get values {release_name} -n "{namespace}" -o json', shell=True
+    )) or {}
+    if deployed_values != values:
+        logs.debug('helm release values changed',
+                   changed_keys=sorted(k for k in set(values) | set(deployed_values)
+                                       if values.get(k) != deployed_values.get(k)))
+        return False
+    return True
+
+
 def check_status(instance_id):
     subprocess.check_call(f'helm status ckan-cloud-{instance_id} -n {instance_id}', shell=True)
 
@@ -89,5 +172,63 @@ def get_values(instance_id):
     return subprocess.check_output(f'helm get values ckan-cloud-{instance_id} -n {instance_id} -o json', shell=True)
 
 
-def _check_helm_version():
-    return 3 if 'v3.' in str(subprocess.check_output('helm version -c', shell=True)) else 2
+def _check_call_debug(cmd):
+    if logs.CKAN_CLOUD_OPERATOR_DEBUG_FILE:
+        logs.info(f'helm debug output is written to debug log file: {logs.CKAN_CLOUD_OPERATOR_DEBUG_FILE}')
+        with open(logs.CKAN_CLOUD_OPERATOR_DEBUG_FILE, 'a') as f:
+            subprocess.check_call(cmd, shell=True, stdout=f, stderr=subprocess.STDOUT)
+    else:
+        subprocess.check_call(cmd, shell=True)
+
+
+def _load_values_file(values_filename):
+    with open(values_filename) as f:
+        return json.loads(json.dumps(yaml.safe_load(f) or {}, default=str))
+
+
+def _get_set_values(values):
+    # --set values, parsed the same way as helm for simple key=value pairs
+    set_values = {}
+    for key, value in (values or {}).items():
+        target = set_values
+        parts = str(key).split('.')
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = yaml.safe_load(str(value)) if str(value) else ''
+    return set_values
+
+
+def _get_repo_index_filename(chart_repo_name):
+    if get_helm_version() != 3:
+        return None
+    cache_dir = os.environ.get('HELM_REPOSITORY_CACHE')
+    if not cache_dir:
+        default_cache_home = '~/Library/Caches' if sys.platform == 'darwin' else '~/.cache'
+        cache_home = os.environ.get('HELM_CACHE_HOME') or os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(default_cache_home), 'helm'
+        )
+        cache_dir = os.path.join(cache_home, 'repository')
+    return os.path.join(cache_dir, f'{chart_repo_name}-index.yaml')
+
+
+def _get_repo_urls():
+    try:
+        repos = json.loads(subprocess.check_output('helm repo list -o json', shell=True, stderr=subprocess.DEVNULL))
+    except subprocess.CalledProcessError:
+        # no repositories
+        return {}
+    return {repo['name']: repo['url'] for repo in repos}
+
+
+def _get_repo_latest_chart_version(chart_name):
+    if '/' not in chart_name:
+        return None
+    chart_repo_name, name = chart_name.split('/', 1)
+    index_filename = _get_repo_index_filename(chart_repo_name)
+    if not index_filename or not os.path.exists(index_filename):
+        return None
+    with open(index_filename) as f:
+        entries = (yaml.safe_load(f) or {}).get('entries', {}).get(name) or []
+    # the index entries are sorted by version, latest first, helm installs the latest stable version
+    versions = [entry['version'] for entry in entries if '-' not in entry['version']]
+    return versions[0] if versions else None
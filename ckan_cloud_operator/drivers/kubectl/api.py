@@ -0,0 +1,560 @@
+"""Native Kubernetes API client, used as an optional backend for the kubectl module
+
+Talks JSON to the API server over a single pooled HTTP session instead of spawning a kubectl
+process and parsing YAML for every call. Commands which are not supported by the client raise
+UnsupportedCommand, the kubectl module catches it and falls back to the kubectl subprocess.
+"""
+import atexit
+import base64
+import datetime
+import json
+import os
+import shlex
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+import requests
+import yaml
+from requests.adapters import HTTPAdapter
+
+from ckan_cloud_operator import logs
+
+
+FIELD_MANAGER = 'ckan-cloud-operator'
+LAST_APPLIED_ANNOTATION = 'kubectl.kubernetes.io/last-applied-configuration'
+# fields populated by the server, which must not be sent in a server-side apply
+SERVER_METADATA_FIELDS = ('managedFields', 'resourceVersion', 'uid', 'creationTimestamp', 'generation', 'selfLink')
+
+# resources which are resolved without hitting the discovery endpoints
+BUILTIN_RESOURCES = [
+    # (group_version, kind, plural, namespaced, short_names)
+    ('v1', 'Pod', 'pods', True, ['po']),
+    ('v1', 'Secret', 'secrets', True, []),
+    ('v1', 'ConfigMap', 'configmaps', True, ['cm']),
+    ('v1', 'Service', 'services', True, ['svc']),
+    ('v1', 'ServiceAccount', 'serviceaccounts', True, ['sa']),
+    ('v1', 'Namespace', 'namespaces', False, ['ns']),
+    ('v1', 'Event', 'events', True, ['ev']),
+    ('v1', 'Node', 'nodes', False, ['no']),
+    ('v1', 'PersistentVolumeClaim', 'persistentvolumeclaims', True, ['pvc']),
+    ('v1', 'PersistentVolume', 'persistentvolumes', False, ['pv']),
+    ('apps/v1', 'Deployment', 'deployments', True, ['deploy']),
+    ('apps/v1', 'ReplicaSet', 'replicasets', True, ['rs']),
+    ('apps/v1', 'StatefulSet', 'statefulsets', True, ['sts']),
+]
+
+
+class UnsupportedCommand(Exception):
+    """The command can't be handled by the API client, caller should fall back to kubectl"""
+    pass
+
+
+class KubeApiError(Exception):
+
+    def __init__(self, status_code, reason, message):
+        super().__init__(f'{status_code} {reason}: {message}')
+        self.status_code = status_code
+        self.reason = reason
+        self.message = message
+
+    @property
+    def not_found(self):
+        return self.status_code == 404
+
+
+class ResourceType(object):
+
+    def __init__(self, group_version, kind, plural, namespaced, short_names=None, singular=None):
+        self.group_version = group_version
+        self.kind = kind
+        self.plural = plural
+        self.namespaced = namespaced
+        self.short_names = short_names or []
+        self.singular = singular or kind.lower()
+
+    @property
+    def names(self):
+        return [self.plural, self.singular, self.kind.lower(), *self.short_names]
+
+    def path(self, namespace=None, name=None):
+        prefix = '/api/v1' if self.group_version == 'v1' else f'/apis/{self.group_version}'
+        path = f'{prefix}/namespaces/{namespace}/{self.plural}' if self.namespaced and namespace else f'{prefix}/{self.plural}'
+        return f'{path}/{name}' if name else path
+
+
+class KubeApiClient(object):
+
+    def __init__(self, server, default_namespace='default', token=None, cert=None, verify=True, pool_maxsize=20):
+        self.server = server.rstrip('/')
+        self.default_namespace = default_namespace
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Accept'] = 'application/json'
+        if token:
+            self.session.headers['Authorization'] = f'Bearer {token}'
+        self.session.cert = cert
+        self.session.verify = verify
+        self._resource_types = {}
+        self._discovered_group_versions = set()
+        self._discovery_lock = threading.Lock()
+        for resource_type in BUILTIN_RESOURCES:
+            self._add_resource_type(ResourceType(*resource_type))
+
+    def resolve(self, what):
+        """Resolve a kubectl style resource name (kind, plural, singular, short name or kind.group)"""
+        key = what.lower()
+        resource_type = self._resource_types.get(key)
+        if not resource_type:
+            with self._discovery_lock:
+                resource_type = self._resource_types.get(key) or self._discover(key)
+        if not resource_type:
+            raise UnsupportedCommand(f'unknown resource type: {what}')
+        return resource_type
+
+    def request(self, method, path, params=None, body=None, content_type='application/json', stream=False, timeout=60):
+        headers = {}
+        data = None
+        if body is not None:
+            headers['Content-Type'] = content_type
+            data = json.dumps(body, default=_json_default)
+        res = self.session.request(method, f'{self.server}{path}', params=params, data=data, headers=headers,
+                                   stream=stream, timeout=timeout)
+        if res.status_code >= 400:
+            try:
+                status = res.json()
+                reason, message = status.get('reason', ''), status.get('message', res.text)
+            except ValueError:
+                reason, message = res.reason, res.text
+            raise KubeApiError(res.status_code, reason, message)
+        return res
+
+    def get(self, what, name, namespace=None):
+        resource_type = self.resolve(what)
+        item = self.request('GET', resource_type.path(self._namespace(resource_type, namespace), name)).json()
+        return _fill_kind(item, resource_type)
+
+    def list(self, what, namespace=None, label_selector=None, all_namespaces=False, field_selector=None):
+        resource_type = self.resolve(what)
+        params = {}
+        if label_selector:
+            params['labelSelector'] = label_selector
+        if field_selector:
+            params['fieldSelector'] = field_selector
+        namespace = None if all_namespaces else self._namespace(resource_type, namespace)
+        res = self.request('GET', resource_type.path(namespace), params=params).json()
+        return {
+            'apiVersion': 'v1',
+            'kind': 'List',
+            'metadata': {'resourceVersion': res.get('metadata', {}).get('resourceVersion', '')},
+            'items': [_fill_kind(item, resource_type) for item in res.get('items') or []],
+        }
+
+    def apply(self, resource, dry_run=False):
+        """Server-side apply of a resource, List resources are applied item by item
+
+        Fields populated by the server (e.g. when applying a previously fetched object) are removed before applying.
+        Server-side apply prunes only the fields previously applied by this field manager, objects which are still
+        managed by client-side kubectl apply (last-applied annotation) raise UnsupportedCommand, so that the caller
+        falls back to kubectl apply which prunes fields based on the annotation.
+        """
+        if resource.get('kind') == 'List':
+            return [self.apply(item, dry_run=dry_run) for item in resource.get('items', [])]
+        resource_type = self._resolve_resource(resource)
+        namespace = self._namespace(resource_type, resource['metadata'].get('namespace'))
+        path = resource_type.path(namespace, resource['metadata']['name'])
+        try:
+            existing = self.request('GET', path).json()
+        except KubeApiError as e:
+            if not e.not_found:
+                raise
+            existing = None
+        if existing and _is_client_side_applied(existing):
+            raise UnsupportedCommand(f'{resource["kind"]} {resource["metadata"]["name"]} is managed by client-side apply')
+        params = {'fieldManager': FIELD_MANAGER, 'force': 'true'}
+        if dry_run:
+            params['dryRun'] = 'All'
+        return self.request(
+            'PATCH', path, params=params, body=get_apply_body(resource),
+            content_type='application/apply-patch+yaml'
+        ).json()
+
+    def create(self, resource):
+        resource_type = self._resolve_resource(resource)
+        namespace = self._namespace(resource_type, resource['metadata'].get('namespace'))
+        return self.request('POST', resource_type.path(namespace), body=resource).json()
+
+    def patch(self, what, name, patch, namespace=None, patch_type='merge'):
+        resource_type = self.resolve(what)
+        content_type = {
+            'merge': 'application/merge-patch+json',
+            'strategic': 'application/strategic-merge-patch+json',
+            'json': 'application/json-patch+json',
+        }[patch_type]
+        return self.request('PATCH', resource_type.path(self._namespace(resource_type, namespace), name),
+                            body=patch, content_type=content_type).json()
+
+    def delete(self, what, name=None, namespace=None, label_selector=None, ignore_not_found=False, wait=True,
+               wait_timeout=120):
+        """Delete by name or label selector, waits for the objects to be removed (same as kubectl delete)"""
+        resource_type = self.resolve(what)
+        namespace = self._namespace(resource_type, namespace)
+        if name:
+            names = [name]
+        else:
+            names = [item['metadata']['name'] for item
+                     in self.list(what, namespace=namespace, label_selector=label_selector)['items']]
+        deleted_names = []
+        for name in names:
+            try:
+                self.request('DELETE', resource_type.path(namespace, name), body={'propagationPolicy': 'Background'})
+                deleted_names.append(name)
+            except KubeApiError as e:
+                if not (e.not_found and ignore_not_found):
+                    raise
+        start_time = time.time()
+        while wait and deleted_names:
+            try:
+                self.request('GET', resource_type.path(namespace, deleted_names[0]))
+            except KubeApiError as e:
+                if e.not_found:
+                    deleted_names.pop(0)
+                    continue
+                raise
+            assert time.time() - start_time < wait_timeout, f'timed out waiting for deletion: {deleted_names}'
+            time.sleep(0.5)
+        return names
+
+    def scale(self, what, name, replicas, namespace=None):
+        resource_type = self.resolve(what)
+        path = resource_type.path(self._namespace(resource_type, namespace), name) + '/scale'
+        return self.request('PATCH', path, body={'spec': {'replicas': int(replicas)}},
+                            content_type='application/merge-patch+json').json()
+
+    def watch(self, what, namespace=None, label_selector=None, field_selector=None, resource_version=None,
+              timeout_seconds=60, all_namespaces=False, on_response=None):
+        """Yields (event_type, object) tuples until the server closes the watch
+
+        on_response is called with the streaming response, closing it from another thread stops the watch
+        """
+        resource_type = self.resolve(what)
+        params = {'watch': 'true', 'timeoutSeconds': int(timeout_seconds), 'allowWatchBookmarks': 'true'}
+        if label_selector:
+            params['labelSelector'] = label_selector
+        if field_selector:
+            params['fieldSelector'] = field_selector
+        if resource_version:
+            params['resourceVersion'] = resource_version
+        namespace = None if all_namespaces else self._namespace(resource_type, namespace)
+        res = self.request('GET', resource_type.path(namespace), params=params, stream=True,
+                           timeout=(10, timeout_seconds + 10))
+        if on_response:
+            on_response(res)
+        with res:
+            for line in res.iter_lines():
+                if line:
+                    event = json.loads(line)
+                    yield event['type'], _fill_kind(event['object'], resource_type)
+
+    def read_pod_log(self, pod_name, namespace=None, container=None, since_seconds=None, tail_lines=None,
+                     timestamps=False, follow=False, previous=False, since_time=None):
+        """Returns the log text, or the streaming response if follow is True"""
+        params = {}
+        if container:
+            params['container'] = container
+        if since_seconds:
+            params['sinceSeconds'] = int(since_seconds)
+        if since_time:
+            params['sinceTime'] = since_time
+        if tail_lines is not None:
+            params['tailLines'] = int(tail_lines)
+        if timestamps:
+            params['timestamps'] = 'true'
+        if previous:
+            params['previous'] = 'true'
+        if follow:
+            params['follow'] = 'true'
+        path = f'/api/v1/namespaces/{namespace or self.default_namespace}/pods/{pod_name}/log'
+        if follow:
+            return self.request('GET', path, params=params, stream=True, timeout=(10, None))
+        else:
+            return self.request('GET', path, params=params).text
+
+    def get_cmd(self, what, args=(), namespace=None, get_cmd='get', kwargs=None):
+        """Handle a kubectl.get call, returns the same structure as parsing `kubectl get -o yaml`"""
+        if get_cmd != 'get':
+            raise UnsupportedCommand(f'unsupported get_cmd: {get_cmd}')
+        tokens = _tokenize(what, args, kwargs)
+        kinds, names, flags = _parse_tokens(tokens, value_flags=('-l', '--selector', '-n', '--namespace',
+                                                                 '--field-selector'),
+                                            bool_flags=('--all-namespaces', '-A'))
+        namespace = flags.get('-n') or flags.get('--namespace') or namespace
+        label_selector = flags.get('-l') or flags.get('--selector')
+        all_namespaces = '--all-namespaces' in flags or '-A' in flags
+        if len(kinds) != 1 or ',' in kinds[0] or kinds[0] == 'all':
+            raise UnsupportedCommand(f'unsupported resource kinds: {kinds}')
+        kind = kinds[0]
+        if len(names) == 1 and not label_selector and not all_namespaces:
+            return self.get(kind, names[0], namespace=namespace)
+        elif names:
+            res = {'apiVersion': 'v1', 'kind': 'List', 'metadata': {'resourceVersion': ''}, 'items': []}
+            for name in names:
+                res['items'].append(self.get(kind, name, namespace=namespace))
+            return res
+        else:
+            return self.list(kind, namespace=namespace, label_selector=label_selector,
+                             all_namespaces=all_namespaces, field_selector=flags.get('--field-selector'))
+
+    def call_cmd(self, cmd, namespace=None):
+        """Handle a kubectl.check_call / kubectl.call command for the supported subset of commands"""
+        tokens = shlex.split(cmd)
+        if not tokens:
+            raise UnsupportedCommand(cmd)
+        command, tokens = tokens[0], tokens[1:]
+        if command == 'delete':
+            kinds, names, flags = _parse_tokens(tokens, value_flags=('-l', '--selector', '-n', '--namespace'),
+                                                bool_flags=('--ignore-not-found', '--wait=false', '--now'))
+            namespace = flags.get('-n') or flags.get('--namespace') or namespace
+            label_selector = flags.get('-l') or flags.get('--selector')
+            ignore_not_found = '--ignore-not-found' in flags
+            if not names and not label_selector:
+                raise UnsupportedCommand(cmd)
+            for kind, name in _kind_names(kinds, names):
+                self.delete(kind, name, namespace=namespace, label_selector=label_selector,
+                            ignore_not_found=ignore_not_found)
+        elif command == 'scale':
+            kinds, names, flags = _parse_tokens(tokens, value_flags=('--replicas', '-n', '--namespace'))
+            namespace = flags.get('-n') or flags.get('--namespace') or namespace
+            for kind, name in _kind_names(kinds, names):
+                assert name, 'scale requires a resource name'
+                self.scale(kind, name, flags['--replicas'], namespace=namespace)
+        elif command == 'patch':
+            kinds, names, flags = _parse_tokens(tokens, value_flags=('-p', '--patch', '--type', '-n', '--namespace'))
+            namespace = flags.get('-n') or flags.get('--namespace') or namespace
+            patch = json.loads(flags.get('-p') or flags['--patch'])
+            for kind, name in _kind_names(kinds, names):
+                assert name, 'patch requires a resource name'
+                self.patch(kind, name, patch, namespace=namespace, patch_type=flags.get('--type', 'strategic'))
+        else:
+            raise UnsupportedCommand(cmd)
+
+    def _resolve_resource(self, resource):
+        api_version = resource['apiVersion']
+        if '/' in api_version:
+            return self.resolve(f'{resource["kind"]}.{api_version.split("/")[0]}')
+        else:
+            return self.resolve(resource['kind'])
+
+    def _namespace(self, resource_type, namespace):
+        if not resource_type.namespaced:
+            return None
+        return namespace or self.default_namespace
+
+    def _add_resource_type(self, resource_type):
+        group = resource_type.group_version.split('/')[0] if '/' in resource_type.group_version else ''
+        for name in resource_type.names:
+            self._resource_types.setdefault(name, resource_type)
+            if group:
+                self._resource_types.setdefault(f'{name}.{group}', resource_type)
+
+    def _discover(self, key):
+        """Fetch API group resources until the requested resource is found, results are kept for the session"""
+        group_versions = ['v1']
+        for group in self.request('GET', '/apis').json().get('groups', []):
+            group_versions.append(group['preferredVersion']['groupVersion'])
+        if '.' in key:
+            # prefer the group referenced in the resource name (e.g. ckancloudckaninstance.stable.viderum.com)
+            group_versions.sort(key=lambda gv: not key.endswith('.' + gv.split('/')[0]))
+        for group_version in group_versions:
+            if group_version in self._discovered_group_versions:
+                continue
+            self._discovered_group_versions.add(group_version)
+            prefix = '/api/v1' if group_version == 'v1' else f'/apis/{group_version}'
+            for resource in self.request('GET', prefix).json().get('resources', []):
+                if '/' in resource['name']:
+                    continue
+                self._add_resource_type(ResourceType(
+                    group_version, resource['kind'], resource['name'], resource['namespaced'],
+                    resource.get('shortNames'), resource.get('singularName')
+                ))
+            if key in self._resource_types:
+                return self._resource_types[key]
+        return None
+
+
+def close_response(res):
+    """Stop a streaming response which is being read in another thread
+
+    Closing the response directly blocks until the reading thread releases the stream, so the socket
+    is shut down instead, causing the reading thread to stop and close the response.
+    """
+    fp = getattr(getattr(res.raw, '_fp', None), 'fp', None)
+    sock = getattr(getattr(fp, 'raw', None), '_sock', None)
+    if sock:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    else:
+        res.close()
+
+
+def load_kubeconfig_client(kubeconfig=None, context=None):
+    """Create a client from the kubeconfig file, using the same file resolution as kubectl"""
+    if not kubeconfig:
+        kubeconfig = os.environ.get('KUBECONFIG') or os.path.expanduser('~/.kube/config')
+    config = {}
+    for path in kubeconfig.split(os.pathsep):
+        if path and os.path.exists(path):
+            with open(path) as f:
+                file_config = yaml.safe_load(f) or {}
+            for key in ['clusters', 'users', 'contexts']:
+                config.setdefault(key, [])
+                existing_names = {i['name'] for i in config[key]}
+                config[key] += [i for i in file_config.get(key) or [] if i['name'] not in existing_names]
+            if not config.get('current-context'):
+                config['current-context'] = file_config.get('current-context')
+    assert config, f'kubeconfig not found: {kubeconfig}'
+    context_name = context or config['current-context']
+    context = _get_named(config['contexts'], context_name, 'context')
+    cluster = _get_named(config['clusters'], context['cluster'], 'cluster')
+    user = _get_named(config['users'], context['user'], 'user') if context.get('user') else {}
+    if cluster.get('insecure-skip-tls-verify'):
+        verify = False
+    elif cluster.get('certificate-authority-data'):
+        verify = _write_temp_file(base64.b64decode(cluster['certificate-authority-data']))
+    else:
+        verify = cluster.get('certificate-authority', True)
+    token, cert = _get_user_credentials(user)
+    return KubeApiClient(cluster['server'], default_namespace=context.get('namespace') or 'default',
+                         token=token, cert=cert, verify=verify)
+
+
+def _get_named(items, name, what):
+    for item in items:
+        if item['name'] == name:
+            return item[what]
+    raise Exception(f'kubeconfig {what} not found: {name}')
+
+
+def _get_user_credentials(user):
+    token, cert = user.get('token'), None
+    if user.get('tokenFile'):
+        with open(user['tokenFile']) as f:
+            token = f.read().strip()
+    if user.get('client-certificate-data'):
+        cert = (_write_temp_file(base64.b64decode(user['client-certificate-data'])),
+                _write_temp_file(base64.b64decode(user['client-key-data'])))
+    elif user.get('client-certificate'):
+        cert = (user['client-certificate'], user['client-key'])
+    if user.get('auth-provider'):
+        token = user['auth-provider'].get('config', {}).get('access-token') or token
+    if user.get('exec'):
+        exec_config = user['exec']
+        env = dict(os.environ, **{e['name']: e['value'] for e in exec_config.get('env') or []})
+        credential = json.loads(subprocess.check_output([exec_config['command'], *exec_config.get('args', [])], env=env))
+        status = credential.get('status', {})
+        token = status.get('token') or token
+        if status.get('clientCertificateData'):
+            cert = (_write_temp_file(status['clientCertificateData'].encode()),
+                    _write_temp_file(status['clientKeyData'].encode()))
+    if user.get('username') and not token:
+        logs.warning('kubeconfig basic auth is not supported by the api client')
+    return token, cert
+
+
+def _write_temp_file(data):
+    f = tempfile.NamedTemporaryFile(delete=False, prefix='cco-kubeconfig-')
+    f.write(data)
+    f.close()
+    atexit.register(os.unlink, f.name)
+    return f.name
+
+
+def get_apply_body(resource):
+    """Returns a copy of the resource without the fields populated by the server"""
+    body = dict(resource, metadata={k: v for k, v in resource['metadata'].items() if k not in SERVER_METADATA_FIELDS})
+    body.pop('status', None)
+    return body
+
+
+def _is_client_side_applied(resource):
+    metadata = resource.get('metadata', {})
+    if LAST_APPLIED_ANNOTATION not in (metadata.get('annotations') or {}):
+        return False
+    return not any(
+        field.get('manager') == FIELD_MANAGER and field.get('operation') == 'Apply'
+        for field in metadata.get('managedFields') or []
+    )
+
+
+def _fill_kind(item, resource_type):
+    # list items returned by the API don't include kind / apiVersion, kubectl adds them
+    item.setdefault('kind', resource_type.kind)
+    item.setdefault('apiVersion', resource_type.group_version)
+    return item
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value)} is not JSON serializable')
+
+
+def _tokenize(what, args, kwargs):
+    tokens = shlex.split(what) + [t for arg in args for t in shlex.split(str(arg))]
+    for k, v in (kwargs or {}).items():
+        tokens += [k] + shlex.split(str(v))
+    return tokens
+
+
+def _parse_tokens(tokens, value_flags=(), bool_flags=()):
+    """Split kubectl args to (kinds, names, flags), raises UnsupportedCommand on unknown flags"""
+    positional, flags = [], {}
+    tokens = list(tokens)
+    while tokens:
+        token = tokens.pop(0)
+        if token.startswith('-'):
+            if '=' in token and token not in bool_flags:
+                token, value = token.split('=', 1)
+                if token not in value_flags:
+                    raise UnsupportedCommand(f'unsupported flag: {token}')
+                flags[token] = value
+            elif token in value_flags:
+                if not tokens:
+                    raise UnsupportedCommand(f'missing value for flag: {token}')
+                flags[token] = tokens.pop(0)
+            elif token in bool_flags:
+                flags[token] = True
+            else:
+                raise UnsupportedCommand(f'unsupported flag: {token}')
+        else:
+            positional.append(token)
+    if not positional:
+        raise UnsupportedCommand('missing resource kind')
+    if '/' in positional[0]:
+        # kind/name kind/name ..
+        kinds, names = [], []
+        for token in positional:
+            if '/' not in token:
+                raise UnsupportedCommand(f'mixed resource name formats: {positional}')
+            kind, name = token.split('/', 1)
+            kinds.append(kind)
+            names.append(name)
+        return kinds, names, flags
+    return [positional[0]], positional[1:], flags
+
+
+def _kind_names(kinds, names):
+    if len(kinds) > 1 or (kinds and '/' in kinds[0]):
+        return list(zip(kinds, names))
+    kinds = kinds[0].split(',')
+    if not names:
+        return [(kind, None) for kind in kinds]
+    if len(kinds) > 1:
+        raise UnsupportedCommand(f'multiple kinds with names: {kinds} {names}')
+    return [(kinds[0], name) for name in names]
@@ -23,3 +23,49 @@ def get(what, args, required, namespace, get_cmd, default_flow_style):
         driver.get(what, *args, required=required, namespace=namespace, get_cmd=get_cmd),
         default_flow_style=default_flow_style
     ))
+
+
+@kubectl.command()
+@click.option('--num-objects', default=50)
+@click.option('--num-calls', default=200)
+@click.option('--with-kubectl', is_flag=True, help='also benchmark kubectl subprocess calls against the fake server')
+def benchmark_api(num_objects, num_calls, with_kubectl):
+    """Benchmark the native API client against a local fake API server"""
+    import os
+    import subprocess
+    import tempfile
+    import time
+    from .api import KubeApiClient
+    from .fake_api_server import FakeApiServer
+    with FakeApiServer() as server:
+        for i in range(num_objects):
+            server.add({'apiVersion': 'v1', 'kind': 'ConfigMap',
+                        'metadata': {'name': f'cm{i}', 'namespace': 'ckan-cloud', 'labels': {'i': str(i % 5)}},
+                        'data': {'i': str(i)}})
+        client = KubeApiClient(server.url)
+        results = {}
+        start_time = time.time()
+        for i in range(num_calls):
+            client.get('configmap', f'cm{i % num_objects}', namespace='ckan-cloud')
+        results['api-get-per-second'] = num_calls / (time.time() - start_time)
+        start_time = time.time()
+        for i in range(num_calls):
+            client.list('configmap', namespace='ckan-cloud', label_selector=f'i={i % 5}')
+        results['api-list-per-second'] = num_calls / (time.time() - start_time)
+        if with_kubectl:
+            with tempfile.NamedTemporaryFile('w', suffix='.yaml') as f:
+                yaml.safe_dump({
+                    'apiVersion': 'v1', 'kind': 'Config', 'current-context': 'fake',
+                    'clusters': [{'name': 'fake', 'cluster': {'server': server.url}}],
+                    'users': [{'name': 'fake', 'user': {}}],
+                    'contexts': [{'name': 'fake', 'context': {'cluster': 'fake', 'user': 'fake'}}],
+                }, f)
+                f.flush()
+                env = dict(os.environ, KUBECONFIG=f.name)
+                num_kubectl_calls = min(num_calls, 20)
+                start_time = time.time()
+                for i in range(num_kubectl_calls):
+                    subprocess.check_output(f'kubectl -n ckan-cloud get configmap cm{i % num_objects} -o yaml',
+                                            shell=True, env=env)
+                results['kubectl-get-per-second'] = num_kubectl_calls / (time.time() - start_time)
+        print(yaml.dump(results, default_flow_style=False))
@@ -0,0 +1,414 @@
+"""In-memory fake of the Kubernetes API server
+
+Supports the subset of the API used by the api client: discovery, get / list with label and field
+selectors, watch, server-side apply, merge patch, create, delete, scale and pod logs.
+Used for tests and benchmarks of the api client without a cluster.
+"""
+import copy
+import datetime
+import json
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from .api import BUILTIN_RESOURCES
+
+
+CRD_RESOURCES = [
+    ('stable.viderum.com/v1', 'CkanCloudCkanInstance', 'ckancloudckaninstances', True, []),
+    ('stable.viderum.com/v1', 'CkanCloudCkanInstanceName', 'ckancloudckaninstancenames', True, []),
+    ('stable.viderum.com/v1', 'CkanCloudRoute', 'ckancloudroutes', True, []),
+    ('stable.viderum.com/v1', 'CkanCloudRouter', 'ckancloudrouters', True, []),
+    ('stable.viderum.com/v1', 'CkanCloudUser', 'ckancloudusers', True, []),
+]
+
+
+class FakeApiServer(object):
+
+    def __init__(self, resources=None, log_follow_timeout=1):
+        self.resources = {}
+        for group_version, kind, plural, namespaced, short_names in (resources or BUILTIN_RESOURCES + CRD_RESOURCES):
+            self.resources[(group_version, plural)] = {
+                'name': plural, 'singularName': kind.lower(), 'kind': kind, 'namespaced': namespaced,
+                'shortNames': short_names, 'verbs': ['get', 'list', 'watch', 'create', 'patch', 'delete'],
+            }
+        self.objects = {}
+        self.events = []
+        self.pod_logs = {}
+        self.pod_log_times = {}
+        self.pod_log_queries = []
+        self.requests = []
+        self.resource_version = 0
+        self.log_follow_timeout = log_follow_timeout
+        self.condition = threading.Condition()
+        self._httpd = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        server = self
+
+        class Handler(_Handler):
+            fake = server
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._httpd:
+            with self.condition:
+                self.condition.notify_all()
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def add(self, resource):
+        """Create or replace an object, same as a server-side apply from a client"""
+        group_version, plural = self._get_resource_key(resource)
+        namespace = resource['metadata'].get('namespace', 'default') if self._is_namespaced(group_version, plural) else None
+        return self._save(group_version, plural, namespace, resource['metadata']['name'], copy.deepcopy(resource))
+
+    def delete(self, group_version, plural, namespace, name):
+        with self.condition:
+            obj = self.objects.pop((group_version, plural, namespace, name), None)
+            if obj:
+                self._add_event(group_version, plural, namespace, 'DELETED', obj)
+            return obj
+
+    def set_pod_log(self, namespace, pod_name, container, text):
+        with self.condition:
+            self.pod_logs[(namespace, pod_name, container)] = text
+            self.pod_log_times[(namespace, pod_name, container)] = [(time.time(), len(text))]
+            self.condition.notify_all()
+
+    def append_pod_log(self, namespace, pod_name, container, text):
+        with self.condition:
+            key = (namespace, pod_name, container)
+            self.pod_logs[key] = self.pod_logs.get(key, '') + text
+            self.pod_log_times.setdefault(key, []).append((time.time(), len(text)))
+            self.condition.notify_all()
+
+    def _get_resource_key(self, resource):
+        for (group_version, plural), r in self.resources.items():
+            if group_version == resource['apiVersion'] and r['kind'] == resource['kind']:
+                return group_version, plural
+        raise KeyError(f'unknown resource: {resource["apiVersion"]} {resource["kind"]}')
+
+    def _is_namespaced(self, group_version, plural):
+        return self.resources[(group_version, plural)]['namespaced']
+
+    def _save(self, group_version, plural, namespace, name, obj, event_type=None):
+        with self.condition:
+            existing = self.objects.get((group_version, plural, namespace, name))
+            metadata = obj.setdefault('metadata', {})
+            metadata['name'] = name
+            if namespace:
+                metadata['namespace'] = namespace
+            if existing:
+                metadata['uid'] = existing['metadata']['uid']
+                metadata['creationTimestamp'] = existing['metadata']['creationTimestamp']
+                generation = existing['metadata'].get('generation', 1)
+                if obj.get('spec') != existing.get('spec'):
+                    generation += 1
+                metadata['generation'] = generation
+                if 'status' not in obj and 'status' in existing:
+                    obj['status'] = existing['status']
+            else:
+                metadata['uid'] = str(uuid.uuid4())
+                metadata['creationTimestamp'] = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+                metadata['generation'] = 1
+            self.resource_version += 1
+            metadata['resourceVersion'] = str(self.resource_version)
+            obj.setdefault('kind', self.resources[(group_version, plural)]['kind'])
+            obj.setdefault('apiVersion', group_version)
+            self.objects[(group_version, plural, namespace, name)] = obj
+            self._add_event(group_version, plural, namespace, event_type or ('MODIFIED' if existing else 'ADDED'), obj)
+            return obj
+
+    def _add_event(self, group_version, plural, namespace, event_type, obj):
+        if event_type == 'DELETED':
+            self.resource_version += 1
+        self.events.append((self.resource_version, group_version, plural, namespace, event_type, copy.deepcopy(obj)))
+        self.condition.notify_all()
+
+    def _list(self, group_version, plural, namespace, label_selector, field_selector):
+        with self.condition:
+            items = [
+                copy.deepcopy(obj) for (gv, p, ns, _), obj in sorted(self.objects.items(), key=lambda i: str(i[0]))
+                if gv == group_version and p == plural and (namespace is None or ns == namespace)
+                and _match_labels(obj, label_selector) and _match_fields(obj, field_selector)
+            ]
+            return items, str(self.resource_version)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    fake = None
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PATCH(self):
+        self._handle('PATCH')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def _handle(self, method):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        self.fake.requests.append((method, url.path))
+        body = self._read_body()
+        parts = [p for p in url.path.split('/') if p]
+        if parts == ['api']:
+            return self._send(200, {'kind': 'APIVersions', 'versions': ['v1']})
+        elif parts == ['apis']:
+            groups = sorted({gv for gv, _ in self.fake.resources if '/' in gv})
+            return self._send(200, {'kind': 'APIGroupList', 'groups': [
+                {'name': gv.split('/')[0], 'preferredVersion': {'groupVersion': gv, 'version': gv.split('/')[1]},
+                 'versions': [{'groupVersion': gv, 'version': gv.split('/')[1]}]}
+                for gv in groups
+            ]})
+        if parts[0] == 'api':
+            group_version, rest = parts[1], parts[2:]
+        elif parts[0] == 'apis' and len(parts) >= 3:
+            group_version, rest = f'{parts[1]}/{parts[2]}', parts[3:]
+        else:
+            return self._send_status(404, 'NotFound', f'unknown path: {url.path}')
+        if not rest:
+            return self._send(200, {'kind': 'APIResourceList', 'groupVersion': group_version, 'resources': [
+                r for (gv, _), r in self.fake.resources.items() if gv == group_version
+            ]})
+        namespace = None
+        if rest[0] == 'namespaces' and len(rest) >= 3:
+            namespace, rest = rest[1], rest[2:]
+        plural, name, subresource = (rest + [None, None])[:3]
+        if (group_version, plural) not in self.fake.resources:
+            return self._send_status(404, 'NotFound', f'the server could not find the requested resource')
+        if name is None:
+            if method == 'GET' and query.get('watch') in ('true', '1'):
+                return self._watch(group_version, plural, namespace, query)
+            elif method == 'GET':
+                items, resource_version = self.fake._list(group_version, plural, namespace,
+                                                          query.get('labelSelector'), query.get('fieldSelector'))
+                return self._send(200, {'kind': f'{self.fake.resources[(group_version, plural)]["kind"]}List',
+                                        'apiVersion': group_version, 'items': items,
+                                        'metadata': {'resourceVersion': resource_version}})
+            elif method == 'POST':
+                name = body['metadata']['name']
+                if (group_version, plural, namespace, name) in self.fake.objects:
+                    return self._send_status(409, 'AlreadyExists', f'{plural} "{name}" already exists')
+                return self._send(201, self.fake._save(group_version, plural, namespace, name, body))
+        elif subresource == 'log':
+            return self._pod_log(namespace, name, query)
+        key = (group_version, plural, namespace, name)
+        existing = self.fake.objects.get(key)
+        if method == 'GET':
+            if not existing:
+                return self._send_status(404, 'NotFound', f'{plural} "{name}" not found')
+            return self._send(200, existing)
+        elif method == 'DELETE':
+            if not existing:
+                return self._send_status(404, 'NotFound', f'{plural} "{name}" not found')
+            return self._send(200, self.fake.delete(*key))
+        elif method == 'PUT':
+            return self._send(200, self.fake._save(group_version, plural, namespace, name, body))
+        elif method == 'PATCH':
+            content_type = self.headers.get('Content-Type', '')
+            if subresource == 'scale':
+                if not existing:
+                    return self._send_status(404, 'NotFound', f'{plural} "{name}" not found')
+                obj = copy.deepcopy(existing)
+                obj.setdefault('spec', {})['replicas'] = body['spec']['replicas']
+                obj = self.fake._save(group_version, plural, namespace, name, obj)
+                return self._send(200, {'kind': 'Scale', 'spec': {'replicas': obj['spec']['replicas']}})
+            elif content_type == 'application/apply-patch+yaml':
+                if body.get('metadata', {}).get('managedFields') is not None:
+                    return self._send_status(400, 'BadRequest', 'metadata.managedFields must be nil')
+                if query.get('dryRun'):
+                    return self._send(200, body)
+                body['metadata']['managedFields'] = [{'manager': query.get('fieldManager'), 'operation': 'Apply'}]
+                return self._send(200, self.fake._save(group_version, plural, namespace, name, body))
+            else:
+                if not existing:
+                    return self._send_status(404, 'NotFound', f'{plural} "{name}" not found')
+                obj = _merge_patch(copy.deepcopy(existing), body)
+                return self._send(200, self.fake._save(group_version, plural, namespace, name, obj))
+        return self._send_status(405, 'MethodNotAllowed', f'{method} {url.path}')
+
+    def _watch(self, group_version, plural, namespace, query):
+        resource_version = int(query.get('resourceVersion') or self.fake.resource_version)
+        deadline = time.time() + int(query.get('timeoutSeconds', 60))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            while time.time() < deadline and self.fake._httpd:
+                with self.fake.condition:
+                    events = [e for e in self.fake.events if e[0] > resource_version]
+                    if not events:
+                        self.fake.condition.wait(timeout=min(0.5, max(0, deadline - time.time())))
+                        continue
+                for rv, gv, p, ns, event_type, obj in events:
+                    resource_version = max(resource_version, rv)
+                    if gv == group_version and p == plural and (namespace is None or ns == namespace) \
+                            and _match_labels(obj, query.get('labelSelector')) \
+                            and _match_fields(obj, query.get('fieldSelector')):
+                        self._write_chunk(json.dumps({'type': event_type, 'object': obj}).encode() + b'\n')
+            self._write_chunk(b'')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _pod_log(self, namespace, pod_name, query):
+        container = query.get('container')
+        if not container:
+            containers = [k[2] for k in self.fake.pod_logs if k[:2] == (namespace, pod_name)]
+            container = containers[0] if containers else None
+        key = (namespace, pod_name, container)
+        if key not in self.fake.pod_logs:
+            return self._send_status(404, 'NotFound', f'pod "{pod_name}" container "{container}" not found')
+        self.fake.pod_log_queries.append((key, query))
+        text = self.fake.pod_logs[key]
+        if query.get('timestamps') == 'true' or query.get('sinceTime'):
+            text = self._get_timestamped_pod_log(key, query.get('sinceTime'), query.get('timestamps') == 'true')
+        if query.get('tailLines'):
+            tail_lines = int(query['tailLines'])
+            text = ''.join(text.splitlines(True)[-tail_lines:]) if tail_lines else ''
+        if query.get('follow') != 'true':
+            return self._send(200, text.encode(), content_type='text/plain')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            if text:
+                self._write_chunk(text.encode())
+            sent = len(self.fake.pod_logs[key])
+            idle_since = time.time()
+            while time.time() - idle_since < self.fake.log_follow_timeout and self.fake._httpd:
+                with self.fake.condition:
+                    current = self.fake.pod_logs.get(key, '')
+                    if len(current) <= sent:
+                        self.fake.condition.wait(timeout=0.1)
+                        continue
+                self._write_chunk(current[sent:].encode())
+                sent = len(current)
+                idle_since = time.time()
+            self._write_chunk(b'')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _get_timestamped_pod_log(self, key, since_time, timestamps):
+        # each appended text has the time it was appended
+        lines, start = [], 0
+        text = self.fake.pod_logs[key]
+        for appended_time, length in self.fake.pod_log_times.get(key, []):
+            for line in text[start:start + length].splitlines(True):
+                lines.append((appended_time, line))
+            start += length
+        if since_time:
+            since = datetime.datetime.strptime(since_time[:19], '%Y-%m-%dT%H:%M:%S')
+            since = since.replace(tzinfo=datetime.timezone.utc).timestamp()
+            lines = [(t, line) for t, line in lines if t >= since]
+        return ''.join(f'{_format_timestamp(t)} {line}' if timestamps else line for t, line in lines)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return None
+        return json.loads(self.rfile.read(length))
+
+    def _write_chunk(self, data):
+        self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+        self.wfile.flush()
+
+    def _send(self, status_code, data, content_type='application/json'):
+        if not isinstance(data, bytes):
+            data = json.dumps(data).encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_status(self, status_code, reason, message):
+        self._send(status_code, {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Failure',
+                                 'reason': reason, 'message': message, 'code': status_code})
+
+
+def _format_timestamp(t):
+    # RFC3339Nano, trailing zeros of the fraction are removed
+    nanoseconds = str(int(round(t % 1, 9) * 1e9)).rjust(9, '0').rstrip('0')
+    timestamp = datetime.datetime.fromtimestamp(int(t), datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+    return f'{timestamp}.{nanoseconds}Z' if nanoseconds else f'{timestamp}Z'
+
+
+def _match_labels(obj, label_selector):
+    if not label_selector:
+        return True
+    labels = obj.get('metadata', {}).get('labels') or {}
+    for requirement in label_selector.split(','):
+        if '!=' in requirement:
+            k, v = requirement.split('!=', 1)
+            if labels.get(k) == v:
+                return False
+        elif '=' in requirement:
+            k, v = requirement.replace('==', '=').split('=', 1)
+            if labels.get(k) != v:
+                return False
+        elif requirement.startswith('!'):
+            if requirement[1:] in labels:
+                return False
+        elif requirement not in labels:
+            return False
+    return True
+
+
+def _match_fields(obj, field_selector):
+    if not field_selector:
+        return True
+    for requirement in field_selector.split(','):
+        k, v = requirement.replace('==', '=').split('=', 1)
+        value = obj
+        for attr in k.split('.'):
+            value = value.get(attr) if isinstance(value, dict) else None
+        if str(value) != v:
+            return False
+    return True
+
+
+def _merge_patch(obj, patch):
+    for k, v in patch.items():
+        if v is None:
+            obj.pop(k, None)
+        elif isinstance(v, dict) and isinstance(obj.get(k), dict):
+            obj[k] = _merge_patch(obj[k], v)
+        else:
+            obj[k] = v
+    return obj
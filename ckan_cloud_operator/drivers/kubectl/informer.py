@@ -0,0 +1,315 @@
+"""In-process list-then-watch caches of Kubernetes resources, similar to client-go informers
+
+An informer lists all objects of a kind once, then follows a watch from the list resourceVersion
+to keep the cache up to date. Lookups by name and by labels are served from memory.
+Label lookups are indexed, the index for a label key is built on first use.
+
+Informers are enabled when the native API client is used, or using CKAN_CLOUD_OPERATOR_INFORMERS=true,
+when disabled the helper functions below fall back to direct kubectl calls.
+Writes done using the kubectl module invalidate the related cached objects.
+"""
+import copy
+import json
+import os
+import shlex
+import subprocess
+import threading
+import time
+import traceback
+
+from ckan_cloud_operator import kubectl
+from ckan_cloud_operator import logs
+from ckan_cloud_operator.drivers.kubectl import api as kubectl_api
+
+
+WRITE_COMMANDS = ('delete', 'patch', 'annotate', 'label', 'apply', 'replace', 'edit', 'create')
+VALUE_FLAGS = ('-l', '--selector', '-p', '--patch', '--type', '-n', '--namespace', '-f', '--filename')
+
+__INFORMERS = {}
+__ENABLED = None
+
+
+def is_enabled():
+    if __ENABLED is not None:
+        return __ENABLED
+    return os.environ.get('CKAN_CLOUD_OPERATOR_INFORMERS') == 'true' or bool(kubectl.get_api_client())
+
+
+def enable(enabled=True):
+    """Force enable / disable the informers, set to None to use the default"""
+    global __ENABLED
+    __ENABLED = enabled
+
+
+def get_informer(kind, namespace='ckan-cloud'):
+    if not is_enabled():
+        return None
+    key = (kind, namespace)
+    informer = __INFORMERS.get(key)
+    if not informer:
+        informer = __INFORMERS[key] = Informer(kind, namespace)
+    return informer
+
+
+def get_item(kind, name, required=False, namespace='ckan-cloud'):
+    """Get an item by name from the informer cache, falls back to kubectl.get if informers are disabled"""
+    informer = get_informer(kind, namespace)
+    if informer:
+        item = informer.get(name)
+        assert item or not required, f'{kind} not found: {name}'
+        return item
+    else:
+        return kubectl.get(f'{kind} {name}', required=required, namespace=namespace)
+
+
+def get_items_by_labels(kind, labels, required=False, namespace='ckan-cloud'):
+    """Get items by labels from the informer cache, falls back to kubectl.get_items_by_labels"""
+    informer = get_informer(kind, namespace)
+    if informer:
+        return informer.list(labels)
+    else:
+        return kubectl.get_items_by_labels(kind, labels, required=required, namespace=namespace)
+
+
+def invalidate(kind=None, name=None):
+    """Mark cached objects as stale, the next lookup will fetch them from the cluster"""
+    for informer in list(__INFORMERS.values()):
+        if kind is None or informer.matches_kind(kind):
+            informer.invalidate(name)
+
+
+def invalidate_cmd(cmd):
+    """Invalidate the objects affected by a kubectl command (e.g. `annotate CkanCloudRoute foo x=y`)"""
+    if not __INFORMERS:
+        return
+    try:
+        tokens = shlex.split(cmd)
+    except ValueError:
+        tokens = []
+    if not tokens or tokens[0] not in WRITE_COMMANDS:
+        return
+    positional, has_selector = [], False
+    tokens = tokens[1:]
+    while tokens:
+        token = tokens.pop(0)
+        if token in VALUE_FLAGS:
+            has_selector = has_selector or token in ('-l', '--selector')
+            if tokens: tokens.pop(0)
+        elif token.startswith('-'):
+            has_selector = has_selector or token.startswith('--selector=') or token == '--all'
+        else:
+            positional.append(token)
+    if not positional or '=' in positional[0]:
+        return invalidate()
+    if '/' in positional[0]:
+        for token in positional:
+            kind, _, name = token.partition('/')
+            invalidate(kind, name or None)
+    else:
+        names = [] if has_selector else [t for t in positional[1:] if '=' not in t]
+        for kind in positional[0].split(','):
+            if names:
+                for name in names:
+                    invalidate(kind, name)
+            else:
+                invalidate(kind)
+
+
+def reset():
+    """Stop and remove all informers"""
+    for informer in __INFORMERS.values():
+        informer.stop()
+    __INFORMERS.clear()
+
+
+class Informer(object):
+
+    def __init__(self, kind, namespace='ckan-cloud'):
+        self.kind = kind
+        self.namespace = namespace
+        self._items = {}
+        self._indexes = {}
+        self._resource_version = None
+        self._synced = False
+        self._stale_names = set()
+        self._lock = threading.RLock()
+        self._watch_thread = None
+        self._watch_process = None
+        self._watch_response = None
+        self._handlers = []
+        self._stopped = False
+        self._watch_failed = False
+
+    def matches_kind(self, kind):
+        kind = kind.lower().split('.')[0]
+        return kind in (self.kind.lower(), f'{self.kind.lower()}s')
+
+    def get(self, name):
+        if self._watch_failed:
+            return kubectl.get(f'{self.kind} {name}', required=False, namespace=self.namespace)
+        with self._lock:
+            self._ensure_synced()
+            if name in self._stale_names:
+                self._refresh(name)
+            item = self._items.get(name)
+            return copy.deepcopy(item) if item else None
+
+    def list(self, labels=None):
+        if self._watch_failed:
+            return kubectl.get_items_by_labels(self.kind, labels, required=False, namespace=self.namespace) or []
+        with self._lock:
+            self._ensure_synced()
+            for name in list(self._stale_names):
+                self._refresh(name)
+            names = None
+            for k, v in (labels or {}).items():
+                label_names = self._get_index(k).get(v, set())
+                names = label_names if names is None else names & label_names
+            if names is None:
+                names = self._items.keys()
+            return [copy.deepcopy(self._items[name]) for name in sorted(names)]
+
+    def invalidate(self, name=None):
+        with self._lock:
+            if name:
+                self._stale_names.add(name)
+            else:
+                self._synced = False
+
+    def add_handler(self, handler):
+        """handler(event_type, obj) is called from the watch thread for each change received from the watch"""
+        self._handlers.append(handler)
+
+    def stop(self):
+        self._stopped = True
+        if self._watch_process:
+            self._watch_process.terminate()
+        if self._watch_response:
+            kubectl_api.close_response(self._watch_response)
+
+    def _ensure_synced(self):
+        if self._synced:
+            return
+        res = kubectl.get(self.kind, required=False, namespace=self.namespace)
+        self._items, self._indexes, self._stale_names = {}, {}, set()
+        for item in (res or {}).get('items', []):
+            self._items[item['metadata']['name']] = item
+        self._resource_version = (res or {}).get('metadata', {}).get('resourceVersion') or None
+        self._synced = True
+        logs.debug(f'informer synced: {self.kind}', num_items=len(self._items),
+                   resource_version=self._resource_version)
+        if not self._watch_failed and (not self._watch_thread or not self._watch_thread.is_alive()):
+            self._watch_thread = threading.Thread(target=self._watch, daemon=True)
+            self._watch_thread.start()
+
+    def _refresh(self, name):
+        item = kubectl.get(f'{self.kind} {name}', required=False, namespace=self.namespace)
+        self._stale_names.discard(name)
+        self._set_item(name, item)
+
+    def _get_index(self, label):
+        index = self._indexes.get(label)
+        if index is None:
+            index = self._indexes[label] = {}
+            for name, item in self._items.items():
+                value = (item['metadata'].get('labels') or {}).get(label)
+                if value is not None:
+                    index.setdefault(value, set()).add(name)
+        return index
+
+    def _set_item(self, name, item):
+        old_item = self._items.pop(name, None)
+        if old_item:
+            for label, index in self._indexes.items():
+                value = (old_item['metadata'].get('labels') or {}).get(label)
+                if value is not None:
+                    index.get(value, set()).discard(name)
+        if item:
+            self._items[name] = item
+            for label, index in self._indexes.items():
+                value = (item['metadata'].get('labels') or {}).get(label)
+                if value is not None:
+                    index.setdefault(value, set()).add(name)
+
+    def _on_event(self, event_type, obj):
+        metadata = obj.get('metadata', {})
+        with self._lock:
+            if event_type == 'BOOKMARK':
+                self._resource_version = metadata.get('resourceVersion') or self._resource_version
+            elif event_type == 'ERROR':
+                # usually 410 Gone - the resourceVersion is too old, a relist is required
+                logs.debug(f'informer watch error: {self.kind}', status=obj)
+                self._synced = False
+                return False
+            else:
+                name = metadata['name']
+                existing = self._items.get(name)
+                resource_version = metadata.get('resourceVersion')
+                if event_type == 'DELETED':
+                    self._set_item(name, None)
+                elif not existing or existing['metadata'].get('resourceVersion') != resource_version:
+                    self._set_item(name, obj)
+                else:
+                    return True
+                self._resource_version = resource_version or self._resource_version
+        for handler in self._handlers:
+            handler(event_type, obj)
+        return True
+
+    def _watch(self):
+        num_failures = 0
+        while not self._stopped:
+            try:
+                with self._lock:
+                    self._ensure_synced()
+                client = kubectl.get_api_client()
+                if client:
+                    self._watch_api(client)
+                else:
+                    self._watch_subprocess()
+                num_failures = 0
+            except Exception:
+                if self._stopped:
+                    return
+                logs.debug(f'informer watch failed: {self.kind}')
+                logs.debug_verbose(traceback.format_exc())
+                num_failures += 1
+                with self._lock:
+                    self._synced = False
+                    if num_failures >= 3:
+                        # lookups are delegated to direct kubectl calls, same as without an informer
+                        logs.warning(f'informer watch failed, disabling cache for {self.kind}')
+                        self._watch_failed = True
+                        self._items, self._indexes, self._stale_names = {}, {}, set()
+                        return
+                time.sleep(num_failures)
+
+    def _watch_api(self, client):
+        def _on_response(res):
+            self._watch_response = res
+
+        for event_type, obj in client.watch(self.kind, namespace=self.namespace,
+                                            resource_version=self._resource_version, timeout_seconds=300,
+                                            on_response=_on_response):
+            if self._stopped or not self._on_event(event_type, obj):
+                break
+
+    def _watch_subprocess(self):
+        # --watch outputs the existing objects first, which covers changes made between the list and the watch
+        self._watch_process = subprocess.Popen(
+            ['kubectl', '-n', self.namespace, 'get', self.kind, '--watch', '--output-watch-events', '-o', 'json'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+        decoder, buffer = json.JSONDecoder(), ''
+        for line in self._watch_process.stdout:
+            buffer += line.decode()
+            while buffer.strip():
+                try:
+                    event, end = decoder.raw_decode(buffer.lstrip())
+                except ValueError:
+                    break
+                buffer = buffer.lstrip()[end:]
+                if self._stopped or not self._on_event(event['type'], event['object']):
+                    self._watch_process.terminate()
+                    return
+        assert self._watch_process.wait() == 0, 'kubectl watch failed'
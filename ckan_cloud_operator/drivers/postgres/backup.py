@@ -0,0 +1,206 @@
+"""Streaming PostgreSQL backups
+
+pg_dump output is piped through an optional compressor and streamed directly to object storage,
+without staging the dump on local disk:
+
+* gs:// urls are streamed using `gsutil cp -` (resumable upload)
+* s3:// urls are streamed using a boto3 multipart upload, set CKAN_CLOUD_OPERATOR_BACKUPS_S3_ENDPOINT_URL
+  to use an S3 compatible storage (e.g. MinIO)
+* other urls are written to the local filesystem
+
+Multiple databases are dumped concurrently, a manifest with the size, duration and sha256 checksum
+of each dump is written next to the dumps.
+"""
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ckan_cloud_operator import logs
+
+
+# compressor: (command, file extension)
+COMPRESSORS = {
+    'gzip': (['gzip', '-c'], '.gz'),
+    'pigz': (['pigz', '-c'], '.gz'),
+    'zstd': (['zstd', '-c', '-T0', '-q'], '.zst'),
+    'none': (None, '.sql'),
+}
+DUMP_FORMATS = ('plain', 'custom')
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def get_dump_filename(database, timestamp, dump_format='plain', compressor='gzip'):
+    """Returns the backup file name, custom-format dumps are compressed by pg_dump and use the .dump extension"""
+    extension = '.dump' if dump_format == 'custom' else COMPRESSORS[compressor][1]
+    return f'{database}_{timestamp}{extension}'
+
+
+def get_dump_commands(connection_string, dump_format='plain', compressor='gzip'):
+    """Returns the pipeline of commands which output the dump"""
+    assert dump_format in DUMP_FORMATS, f'Invalid dump format: {dump_format}'
+    assert compressor in COMPRESSORS, f'Invalid compressor: {compressor}'
+    cmds = [['pg_dump', '-d', connection_string, f'--format={dump_format}', '--no-owner', '--no-acl',
+             '--schema=public']]
+    if dump_format == 'plain':
+        cmds.append(['sed', '-E', r's/(DROP|CREATE|COMMENT ON) EXTENSION/-- \1 EXTENSION/g'])
+        compress_cmd, _ = COMPRESSORS[compressor]
+        if compress_cmd:
+            cmds.append(compress_cmd)
+    return cmds
+
+
+def dump(connection_string, url, dump_format='plain', compressor='gzip'):
+    """Dump a database and stream it to the url, returns the dump stats"""
+    start_time = time.time()
+    procs = []
+    for cmd in get_dump_commands(connection_string, dump_format, compressor):
+        procs.append(subprocess.Popen(cmd, stdin=procs[-1].stdout if procs else None, stdout=subprocess.PIPE))
+        if len(procs) > 1:
+            # allow the previous process to receive SIGPIPE if this process exits
+            procs[-2].stdout.close()
+    reader = _HashingReader(procs[-1].stdout)
+    # the dump is uploaded to a temporary url and moved to the final url only if all the processes succeeded,
+    # so that a failed dump doesn't leave a truncated backup which looks like a valid one
+    tmp_url = get_temporary_url(url)
+    uploaded = False
+    try:
+        upload(reader, tmp_url)
+        uploaded = True
+    finally:
+        procs[-1].stdout.close()
+        returncodes = [proc.wait() for proc in procs]
+        if not uploaded or any(returncode != 0 for returncode in returncodes):
+            delete(tmp_url)
+    assert all(returncode == 0 for returncode in returncodes), f'dump failed: {url} (returncodes={returncodes})'
+    move(tmp_url, url)
+    return {
+        'url': url,
+        'format': dump_format,
+        'compressor': 'pg_dump' if dump_format == 'custom' else compressor,
+        'size': reader.size,
+        'sha256': reader.sha256.hexdigest(),
+        'duration_seconds': round(time.time() - start_time, 3),
+    }
+
+
+def dump_all(databases, get_connection_string, base_url, concurrency=4, dump_format='plain', compressor='gzip',
+             timestamp=None, skipped_databases=None):
+    """Dump multiple databases concurrently to {base_url}/{database}_{timestamp}.{ext}
+
+    :param get_connection_string: function which gets a database name and returns a connection string
+    :param skipped_databases: databases which were not changed since the last backup, listed in the manifest
+    :returns: the manifest, which is also written to {base_url}/manifest_{timestamp}.json
+    """
+    timestamp = timestamp or datetime.datetime.now().strftime('%Y%m%d%H%M')
+    start_time = time.time()
+
+    def _dump(database):
+        url = f'{base_url}/{get_dump_filename(database, timestamp, dump_format, compressor)}'
+        logs.info(f'Dumping DB: {database} -> {url}')
+        try:
+            res = dict(dump(get_connection_string(database), url, dump_format, compressor), database=database,
+                       status='success')
+        except Exception as e:
+            logs.error(f'Failed to dump DB: {database} ({e})')
+            return {'database': database, 'url': url, 'status': 'failed', 'error': str(e)}
+        logs.info(f'Dumped DB: {database}', size=res['size'], duration_seconds=res['duration_seconds'])
+        return res
+
+    with ThreadPoolExecutor(max(1, concurrency)) as executor:
+        backups = list(executor.map(_dump, databases))
+    manifest = {
+        'timestamp': timestamp,
+        'format': dump_format,
+        'compressor': 'pg_dump' if dump_format == 'custom' else compressor,
+        'duration_seconds': round(time.time() - start_time, 3),
+        'total_size': sum(backup.get('size', 0) for backup in backups),
+        'backups': backups,
+        'skipped': sorted(skipped_databases or []),
+    }
+    upload_bytes(json.dumps(manifest, indent=2).encode(), f'{base_url}/manifest_{timestamp}.json')
+    return manifest
+
+
+def upload(fileobj, url):
+    """Stream a file object to the url"""
+    if url.startswith('gs://'):
+        proc = subprocess.Popen(['gsutil', '-q', 'cp', '-', url], stdin=subprocess.PIPE)
+        try:
+            shutil.copyfileobj(fileobj, proc.stdin, CHUNK_SIZE)
+        finally:
+            proc.stdin.close()
+        assert proc.wait() == 0, f'upload failed: {url}'
+    elif url.startswith('s3://'):
+        from boto3.s3.transfer import TransferConfig
+        bucket, key = url[len('s3://'):].split('/', 1)
+        _get_s3_client().upload_fileobj(fileobj, bucket, key, Config=TransferConfig(
+            multipart_threshold=CHUNK_SIZE, multipart_chunksize=CHUNK_SIZE, max_concurrency=2
+        ))
+    else:
+        filename = url.replace('file://', '', 1)
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        with open(filename, 'wb') as f:
+            shutil.copyfileobj(fileobj, f, CHUNK_SIZE)
+
+
+def get_temporary_url(url):
+    """Returns the url in a _tmp sub-directory, which is not matched when looking for the latest backups"""
+    base_url, filename = url.rsplit('/', 1) if '/' in url else ('.', url)
+    return f'{base_url}/_tmp/{filename}'
+
+
+def move(src_url, dst_url):
+    if src_url.startswith('gs://'):
+        subprocess.check_call(['gsutil', '-q', 'mv', src_url, dst_url])
+    elif src_url.startswith('s3://'):
+        src_bucket, src_key = src_url[len('s3://'):].split('/', 1)
+        dst_bucket, dst_key = dst_url[len('s3://'):].split('/', 1)
+        s3 = _get_s3_client()
+        s3.copy({'Bucket': src_bucket, 'Key': src_key}, dst_bucket, dst_key)
+        s3.delete_object(Bucket=src_bucket, Key=src_key)
+    else:
+        os.replace(src_url.replace('file://', '', 1), dst_url.replace('file://', '', 1))
+
+
+def delete(url):
+    """Delete the object at the url, errors are logged and ignored"""
+    try:
+        if url.startswith('gs://'):
+            subprocess.run(['gsutil', '-q', 'rm', url], stderr=subprocess.DEVNULL)
+        elif url.startswith('s3://'):
+            bucket, key = url[len('s3://'):].split('/', 1)
+            _get_s3_client().delete_object(Bucket=bucket, Key=key)
+        elif os.path.exists(url.replace('file://', '', 1)):
+            os.remove(url.replace('file://', '', 1))
+    except Exception as e:
+        logs.warning(f'Failed to delete {url}: {e}')
+
+
+def upload_bytes(data, url):
+    from io import BytesIO
+    upload(BytesIO(data), url)
+
+
+def _get_s3_client():
+    import boto3
+    return boto3.client('s3', endpoint_url=os.environ.get('CKAN_CLOUD_OPERATOR_BACKUPS_S3_ENDPOINT_URL') or None)
+
+
+class _HashingReader(object):
+    """File object wrapper which calculates the size and sha256 of the data read from it"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.size += len(data)
+        self.sha256.update(data)
+        return data
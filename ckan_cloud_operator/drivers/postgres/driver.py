@@ -1,39 +1,118 @@
 import psycopg2
+import psycopg2.pool
 import contextlib
 import traceback
+import subprocess
+import threading
+import gzip
+import os
 
 from ckan_cloud_operator import logs
 
 
+ROLE_FIELDS = ['rolname', 'rolsuper', 'rolinherit', 'rolcreaterole', 'rolcreatedb', 'rolcanlogin', 'rolreplication',
+               'rolconnlimit', 'rolpassword', 'rolvaliduntil', 'rolbypassrls', 'rolconfig', 'oid']
+DB_FIELDS = ['datname', 'datdba', 'encoding', 'datcollate', 'datctype', 'datistemplate', 'datallowconn',
+             'datconnlimit', 'datlastsysoid', 'datfrozenxid', 'datminmxid', 'dattablespace', 'datacl']
+POOL_MAX_CONNECTIONS = 4
+
+__POOLS = {}
+__POOLS_LOCK = threading.Lock()
+
+
 @contextlib.contextmanager
 def connect(*args, **kwargs):
     with psycopg2.connect(*args, **kwargs) as conn:
         yield conn
 
 
+@contextlib.contextmanager
+def pooled_connect(connection_string):
+    """Get a connection from a pool of connections to the connection string, usage is the same as connect
+
+    The transaction is committed (or rolled back on error) and the connection is returned to the pool on exit.
+    Up to POOL_MAX_CONNECTIONS connections are used concurrently, additional callers wait for a free connection.
+    """
+    with __POOLS_LOCK:
+        pool = __POOLS.get(connection_string)
+        if not pool:
+            pool = __POOLS[connection_string] = _ConnectionPool(POOL_MAX_CONNECTIONS, connection_string)
+    with pool.semaphore:
+        conn = pool.getconn()
+        if conn.closed:
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+        try:
+            with conn:
+                yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            pool.putconn(conn, close=True)
+            raise
+        except BaseException:
+            pool.putconn(conn)
+            raise
+        else:
+            pool.putconn(conn)
+
+
+class _ConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    """Connection pool which keeps up to maxconn idle connections, connections are opened on first use
+
+    psycopg2 pools keep only minconn idle connections (and open them on init), so minconn is set after init.
+    The semaphore bounds concurrent usage, getconn raises PoolError when all the connections are used.
+    """
+
+    def __init__(self, maxconn, *args, **kwargs):
+        super().__init__(0, maxconn, *args, **kwargs)
+        self.minconn = maxconn
+        self.semaphore = threading.BoundedSemaphore(maxconn)
+
+
+def close_pools():
+    with __POOLS_LOCK:
+        for pool in __POOLS.values():
+            pool.closeall()
+        __POOLS.clear()
+
+
 def create_base_db(admin_conn, db_name, db_password, grant_to_user=None):
-    db_info = get_db_role_info(admin_conn, db_name)
-    errors = []
-    if db_info.get('role'):
-        logs.info(f'Role already exists: {db_name}')
-        errors.append('role-exists')
-    else:
-        create_role_if_not_exists(admin_conn, db_name, db_password)
-    if db_info.get('db'):
-        logs.info(f'DB already exists: {db_name}')
-        errors.append('db-exists')
-    else:
-        logs.info(f'Creating DB: {db_name}')
-        _set_session_autocommit(admin_conn)
-        with admin_conn.cursor() as cur:
-            cur.execute(f'CREATE DATABASE "{db_name}";')
-        _unset_session_autocommit(admin_conn)
-    if grant_to_user:
-        _set_session_autocommit(admin_conn)
-        with admin_conn.cursor() as cur:
-            cur.execute(f'GRANT "{db_name}" to "{grant_to_user}";')
-        _unset_session_autocommit(admin_conn)
+    return create_base_dbs(admin_conn, [(db_name, db_password)], grant_to_user=grant_to_user)[db_name]
+
+
+def create_base_dbs(admin_conn, dbs, grant_to_user=None):
+    """Create databases with an owner role of the same name, existing dbs / roles are skipped
 
+    :param dbs: list of (db_name, db_password) tuples
+    :returns: {db_name: errors}
+    """
+    dbs_info = get_dbs_roles_info(admin_conn, [db_name for db_name, _ in dbs])
+    errors = {db_name: [] for db_name, _ in dbs}
+    create_roles = []
+    for db_name, db_password in dbs:
+        if dbs_info[db_name].get('role'):
+            logs.info(f'Role already exists: {db_name}')
+            errors[db_name].append('role-exists')
+        else:
+            create_roles.append((db_name, db_password))
+    with _autocommit(admin_conn):
+        with admin_conn.cursor() as cur:
+            if create_roles:
+                logs.info(f'Creating roles: {[role_name for role_name, _ in create_roles]}')
+                cur.execute(''.join(
+                    f'CREATE ROLE "{role_name}" WITH LOGIN PASSWORD %s NOSUPERUSER NOCREATEDB NOCREATEROLE; '
+                    f'GRANT "{role_name}" TO postgres; '
+                    for role_name, _ in create_roles
+                ), [role_password for _, role_password in create_roles])
+            for db_name, _ in dbs:
+                if dbs_info[db_name].get('db'):
+                    logs.info(f'DB already exists: {db_name}')
+                    errors[db_name].append('db-exists')
+                else:
+                    # CREATE DATABASE can't run in a multi-statement query
+                    logs.info(f'Creating DB: {db_name}')
+                    cur.execute(f'CREATE DATABASE "{db_name}";')
+            if grant_to_user and dbs:
+                cur.execute(''.join(f'GRANT "{db_name}" to "{grant_to_user}"; ' for db_name, _ in dbs))
     return errors
 
 
@@ -41,124 +120,155 @@ def create_role_if_not_exists(admin_conn, role_name, role_password):
     roles = list(list_roles(admin_conn, role_name=role_name))
     if len(roles) == 0:
         logs.info(f'Creating role: {role_name}')
-        _set_session_autocommit(admin_conn)
-        with admin_conn.cursor() as cur:
-            cur.execute(f'CREATE ROLE "{role_name}" WITH LOGIN PASSWORD %s NOSUPERUSER NOCREATEDB NOCREATEROLE;',
-                        (role_password,))
-            cur.execute(f'GRANT "{role_name}" TO postgres;')
-        _unset_session_autocommit(admin_conn)
+        with _autocommit(admin_conn):
+            with admin_conn.cursor() as cur:
+                cur.execute(f'CREATE ROLE "{role_name}" WITH LOGIN PASSWORD %s NOSUPERUSER NOCREATEDB NOCREATEROLE;',
+                            (role_password,))
+                cur.execute(f'GRANT "{role_name}" TO postgres;')
 
 
 def delete_role(admin_conn, role_name):
-    roles = list(list_roles(admin_conn, role_name=role_name))
-    if len(roles) > 0:
-        logs.info(f'Deleting role: {role_name}')
-        _set_session_autocommit(admin_conn)
-        with admin_conn.cursor() as cur:
-            try:
-                cur.execute(f'DROP ROLE "{role_name}"')
-            except psycopg2.ProgrammingError:
-                traceback.print_exc()
-        _unset_session_autocommit(admin_conn)
+    delete_roles(admin_conn, [role_name])
+
+
+def delete_roles(admin_conn, role_names):
+    role_names = list(list_roles(admin_conn, role_names=role_names))
+    if role_names:
+        logs.info(f'Deleting roles: {role_names}')
+        with _autocommit(admin_conn):
+            with admin_conn.cursor() as cur:
+                try:
+                    cur.execute('DROP ROLE IF EXISTS ' + ', '.join(f'"{role_name}"' for role_name in role_names))
+                except psycopg2.ProgrammingError:
+                    traceback.print_exc()
 
 
 def delete_base_db(admin_conn, db_name):
-    errors = []
-    db_info = get_db_role_info(admin_conn, db_name)
-    logs.info(f'Revoking connect and terminating all connections db: {db_name}')
-    _set_session_autocommit(admin_conn)
-    with admin_conn.cursor() as cur:
-        try: cur.execute(f'REVOKE CONNECT ON DATABASE "{db_name}" FROM public;')
-        except psycopg2.ProgrammingError:
-            traceback.print_exc()
-    _unset_session_autocommit(admin_conn)
-    with admin_conn.cursor() as cur:
-        try: cur.execute('SELECT pg_terminate_backend(pg_stat_activity.pid) '
-                         'FROM pg_stat_activity '
-                         'WHERE pg_stat_activity.datname = %s;', (db_name,))
-        except psycopg2.ProgrammingError:
-            traceback.print_exc()
-    if db_info.get('db'):
-        logs.info(f'Deleting db: {db_name}')
-        _set_session_autocommit(admin_conn)
-        with admin_conn.cursor() as cur:
-            try: cur.execute(f'DROP DATABASE "{db_name}"')
-            except psycopg2.ProgrammingError:
-                traceback.print_exc()
-        _unset_session_autocommit(admin_conn)
-    else:
-        logs.info(f'DB does not exist: {db_name}')
-        errors.append('db-does-not-exist')
-    if db_info.get('role'):
-        logs.info(f'Deleting role: {db_name}')
-        _set_session_autocommit(admin_conn)
+    return delete_base_dbs(admin_conn, [db_name])[db_name]
+
+
+def delete_base_dbs(admin_conn, db_names):
+    """Terminate connections and delete databases and their owner roles of the same name
+
+    :returns: {db_name: errors}
+    """
+    dbs_info = get_dbs_roles_info(admin_conn, db_names)
+    errors = {db_name: [] for db_name in db_names}
+    existing_db_names = [db_name for db_name in db_names if dbs_info[db_name].get('db')]
+    existing_role_names = [db_name for db_name in db_names if dbs_info[db_name].get('role')]
+    with _autocommit(admin_conn):
         with admin_conn.cursor() as cur:
-            try:
-                cur.execute(f'DROP ROLE "{db_name}"')
-            except psycopg2.ProgrammingError:
-                traceback.print_exc()
-        _unset_session_autocommit(admin_conn)
-    else:
-        logs.info(f'Role does not exist: {db_name}')
-        errors.append('role-does-not-exist')
+            if existing_db_names:
+                logs.info(f'Revoking connect and terminating all connections dbs: {existing_db_names}')
+                try:
+                    cur.execute(''.join(f'REVOKE CONNECT ON DATABASE "{db_name}" FROM public; '
+                                        for db_name in existing_db_names))
+                    cur.execute('SELECT pg_terminate_backend(pg_stat_activity.pid) '
+                                'FROM pg_stat_activity '
+                                'WHERE pg_stat_activity.datname = any(%s);', (existing_db_names,))
+                except psycopg2.ProgrammingError:
+                    traceback.print_exc()
+            for db_name in db_names:
+                if db_name in existing_db_names:
+                    logs.info(f'Deleting db: {db_name}')
+                    try:
+                        # DROP DATABASE can't run in a multi-statement query
+                        cur.execute(f'DROP DATABASE "{db_name}"')
+                    except psycopg2.ProgrammingError:
+                        traceback.print_exc()
+                else:
+                    logs.info(f'DB does not exist: {db_name}')
+                    errors[db_name].append('db-does-not-exist')
+                if db_name not in existing_role_names:
+                    logs.info(f'Role does not exist: {db_name}')
+                    errors[db_name].append('role-does-not-exist')
+            if existing_role_names:
+                logs.info(f'Deleting roles: {existing_role_names}')
+                try:
+                    cur.execute('DROP ROLE IF EXISTS ' + ', '.join(f'"{role_name}"' for role_name in existing_role_names))
+                except psycopg2.ProgrammingError:
+                    traceback.print_exc()
     return errors
 
 
 def get_db_role_info(admin_conn, db_name):
-    res = {'role': None, 'db': None}
-    cur = admin_conn.cursor()
-    fields = 'rolname | rolsuper | rolinherit | rolcreaterole | rolcreatedb | rolcanlogin | rolreplication | rolconnlimit | rolpassword | rolvaliduntil | rolbypassrls | rolconfig |  oid'.split(' | ')
-    fields_select = ', '.join(fields)
-    cur.execute(f'select {fields_select} from pg_roles where rolname=%s', (db_name,))
-    row = cur.fetchone()
-    res['role'] = dict(zip(fields, row)) if row else None
-    fields = 'datname | datdba | encoding | datcollate | datctype | datistemplate | datallowconn | datconnlimit | datlastsysoid | datfrozenxid | datminmxid | dattablespace | datacl'.split(' | ')
-    fields_select = ', '.join(fields)
-    cur.execute(f'select {fields_select} from pg_database where datname=%s', (db_name,))
-    row = cur.fetchone()
-    res['db'] = dict(zip(fields, row)) if row else None
-    cur.close()
+    return get_dbs_roles_info(admin_conn, [db_name])[db_name]
+
+
+def get_dbs_roles_info(admin_conn, names=None):
+    """Get the role and db info of multiple names using a single catalog query
+
+    :param names: list of role / db names, if not provided returns all roles and dbs
+    :returns: {name: {'role': role_info or None, 'db': db_info or None}}
+    """
+    fields_select = ', '.join([f'r.{field}' for field in ROLE_FIELDS] + [f'd.{field}' for field in DB_FIELDS])
+    where = ' where coalesce(r.rolname, d.datname) = any(%s)' if names is not None else ''
+    res = {name: {'role': None, 'db': None} for name in (names or [])}
+    with admin_conn.cursor() as cur:
+        cur.execute(f'select {fields_select} from pg_roles r '
+                    f'full outer join pg_database d on d.datname = r.rolname{where}',
+                    (list(names),) if names is not None else ())
+        for row in cur:
+            role = dict(zip(ROLE_FIELDS, row[:len(ROLE_FIELDS)])) if row[0] is not None else None
+            db = dict(zip(DB_FIELDS, row[len(ROLE_FIELDS):])) if row[len(ROLE_FIELDS)] is not None else None
+            res[role['rolname'] if role else db['datname']] = {'role': role, 'db': db}
     return res
 
 
 def list_db_names(admin_conn, full=False, validate=False):
     if validate: full = True
     failures = []
-    cur = admin_conn.cursor()
-    cur.execute('select datname from pg_database')
-    for row in cur:
-        db_name = row[0]
-        if full:
-            data = get_db_role_info(admin_conn, db_name)
-            if validate and not (data.get('db') and data.get('role')): failures.append(db_name)
-            yield data
-        else:
-            yield db_name
+    if full:
+        dbs_roles_info = get_dbs_roles_info(admin_conn)
+        for name, data in sorted(dbs_roles_info.items()):
+            if data.get('db'):
+                if validate and not data.get('role'): failures.append(name)
+                yield data
+    else:
+        with admin_conn.cursor() as cur:
+            cur.execute('select datname from pg_database')
+            for row in cur.fetchall():
+                yield row[0]
     if validate and len(failures) > 0: raise Exception(f'Failed to get role for following dbs: {failures}')
 
 
-def list_roles(admin_conn, full=False, validate=False, role_name=None):
+def list_roles(admin_conn, full=False, validate=False, role_name=None, role_names=None):
     if validate: full=True
-    failures = []
-    cur = admin_conn.cursor()
     if role_name is not None:
-        where = ' where rolname=%s'
-        args = (role_name,)
+        role_names = [role_name]
+    failures = []
+    if full:
+        dbs_roles_info = get_dbs_roles_info(admin_conn, role_names)
+        for name, data in sorted(dbs_roles_info.items()):
+            if data.get('role'):
+                if validate and not data.get('db'): failures.append(name)
+                yield data
     else:
-        where = ''
-        args = ()
-    cur.execute(f'select rolname from pg_roles{where}', args)
-    for row in cur:
-        role_name = row[0]
-        if full:
-            data = get_db_role_info(admin_conn, role_name)
-            if validate and not (data.get('db') and data.get('role')): failures.append(role_name)
-            yield data
-        else:
-            yield role_name
+        with admin_conn.cursor() as cur:
+            if role_names is not None:
+                cur.execute('select rolname from pg_roles where rolname = any(%s)', (list(role_names),))
+            else:
+                cur.execute('select rolname from pg_roles')
+            for row in cur.fetchall():
+                yield row[0]
     if validate and len(failures) > 0: raise Exception(f'Failed to get db for following roles: {failures}')
 
 
+def get_dbs_change_markers(admin_conn):
+    """Get a marker of the writes to each database from the statistics collector, using a single query
+
+    The marker changes when rows are inserted / updated / deleted or when the statistics are reset
+    returns {db_name: marker}
+    """
+    with admin_conn.cursor() as cur:
+        cur.execute('select datname, tup_inserted, tup_updated, tup_deleted, stats_reset from pg_stat_database '
+                    'where datname is not null')
+        return {
+            db_name: f'{tup_inserted}:{tup_updated}:{tup_deleted}:{stats_reset.isoformat() if stats_reset else ""}'
+            for db_name, tup_inserted, tup_updated, tup_deleted, stats_reset in cur.fetchall()
+        }
+
+
 def initialize_extensions(admin_db_conn, extension_names):
     with admin_db_conn.cursor() as cur:
         cur.execute(' '.join([
@@ -167,6 +277,102 @@ def initialize_extensions(admin_db_conn, extension_names):
         ]))
 
 
+def is_custom_format_dump(filename):
+    """Returns True if the file is a pg_dump custom-format archive, which can be restored in parallel"""
+    with open(filename, 'rb') as f:
+        return f.read(5) == b'PGDMP'
+
+
+def restore(connection_string, filename, role=None, jobs=1, progress_interval=100):
+    """Restore a dump file to the database, yields progress dicts
+
+    custom-format dumps are restored with pg_restore using `jobs` parallel jobs,
+    plain SQL dumps (optionally gzip / zstd compressed) are streamed to psql.
+    :param role: the restored objects are owned by this role
+    """
+    if is_custom_format_dump(filename):
+        yield from _pg_restore(connection_string, filename, role, jobs, progress_interval)
+    else:
+        yield from _psql_restore(connection_string, filename, role)
+
+
+def _pg_restore(connection_string, filename, role, jobs, progress_interval):
+    num_items = len([
+        line for line in subprocess.check_output(['pg_restore', '--list', filename]).decode().splitlines()
+        if line.strip() and not line.startswith(';')
+    ])
+    yield {'msg': f'Restoring {num_items} items using {jobs} jobs', 'total-items': num_items}
+    cmd = ['pg_restore', '--dbname', connection_string, '--no-owner', '--no-acl', '--exit-on-error', '--verbose',
+           '--jobs', str(jobs)]
+    if role:
+        cmd += ['--role', role]
+    proc = subprocess.Popen(cmd + [filename], stderr=subprocess.PIPE)
+    restored_items, errors = 0, []
+    for line in proc.stderr:
+        line = line.decode().strip()
+        if line.startswith('pg_restore: processing item') or line.startswith('pg_restore: creating'):
+            restored_items += 1
+            if restored_items % progress_interval == 0:
+                yield {'msg': f'Restored {restored_items}/{num_items} items', 'restored-items': restored_items,
+                       'total-items': num_items}
+        elif 'error' in line.lower():
+            errors.append(line)
+    assert proc.wait() == 0, f'pg_restore failed: {errors}'
+    yield {'msg': f'Restored {num_items} items', 'restored-items': num_items, 'total-items': num_items}
+
+
+def _psql_restore(connection_string, filename, role, chunk_size=1024 * 1024, progress_bytes=256 * 1024 * 1024):
+    total_bytes = os.path.getsize(filename)
+    proc = subprocess.Popen(['psql', '--quiet', '--set', 'ON_ERROR_STOP=1', '--dbname', connection_string],
+                            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+    next_progress_bytes = progress_bytes
+    decompress_proc = None
+    try:
+        if role:
+            proc.stdin.write(f'SET ROLE "{role}";\n'.encode())
+        with open(filename, 'rb') as raw:
+            magic = raw.read(4)
+            raw.seek(0)
+            if magic[:2] == b'\x1f\x8b':
+                source = gzip.GzipFile(fileobj=raw)
+            elif magic == b'\x28\xb5\x2f\xfd':
+                decompress_proc = subprocess.Popen(['zstd', '-dc'], stdin=raw, stdout=subprocess.PIPE)
+                source = decompress_proc.stdout
+            else:
+                source = raw
+            while True:
+                chunk = source.read(chunk_size)
+                if not chunk:
+                    break
+                proc.stdin.write(chunk)
+                # the offset of the compressed file, it's shared with the decompress process
+                read_bytes = os.lseek(raw.fileno(), 0, os.SEEK_CUR)
+                if read_bytes >= next_progress_bytes:
+                    next_progress_bytes += progress_bytes
+                    yield {'msg': f'Restored {read_bytes}/{total_bytes} bytes', 'restored-bytes': read_bytes,
+                           'total-bytes': total_bytes}
+    except BrokenPipeError:
+        pass
+    finally:
+        proc.stdin.close()
+    assert not decompress_proc or decompress_proc.wait() == 0, f'zstd decompress failed ({decompress_proc.returncode})'
+    assert proc.wait() == 0, f'psql restore failed ({proc.returncode})'
+    yield {'msg': f'Restored {total_bytes} bytes', 'restored-bytes': total_bytes, 'total-bytes': total_bytes}
+
+
+@contextlib.contextmanager
+def _autocommit(conn):
+    """Run statements which can't run in a transaction (e.g. CREATE DATABASE), toggles autocommit once"""
+    if conn.autocommit:
+        yield
+    else:
+        _set_session_autocommit(conn)
+        try:
+            yield
+        finally:
+            _unset_session_autocommit(conn)
+
+
 def _set_session_autocommit(conn):
     conn.commit()
     conn.set_session(autocommit=True)
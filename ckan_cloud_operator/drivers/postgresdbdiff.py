@@ -7,9 +7,12 @@
 # I want users to be able just copy/paste this file and run it
 import argparse
 import difflib
+import json
 import os.path
 import subprocess
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
 def check_database_name(name):
@@ -55,6 +58,20 @@ def parser_arguments():
     parser.add_argument('--rowcount',
                         help='Compare tables row count',
                         action='store_true')
+    parser.add_argument('--rowcount-estimate',
+                        help='Compare tables estimated row count (pg_class.reltuples), '
+                             'fast but requires recently analyzed tables',
+                        action='store_true')
+    parser.add_argument('--rowcount-workers',
+                        help='Number of tables row counts to run in parallel',
+                        type=int, default=4)
+    parser.add_argument('--catalog',
+                        help='Compare using a few catalog queries per DB instead of psql \\d per table '
+                             '(requires psycopg2)',
+                        action='store_true')
+    parser.add_argument('--json',
+                        help='Output the results as JSON',
+                        action='store_true')
 
     return parser.parse_args()
 
@@ -192,7 +209,132 @@ def get_table_definition(db_name, table_name):
     return '\n'.join(lines)
 
 
+CATALOG_RELATIONS_QUERY = """
+    SELECT c.relname, c.relkind, c.reltuples::bigint,
+           CASE WHEN c.relkind IN ('v', 'm') THEN pg_get_viewdef(c.oid) END
+    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = 'public' AND c.relkind IN ('r', 'p', 'v', 'm')
+"""
+
+CATALOG_COLUMNS_QUERY = """
+    SELECT table_name, column_name, data_type, character_maximum_length, numeric_precision, numeric_scale,
+           is_nullable, column_default
+    FROM information_schema.columns
+    WHERE table_schema = 'public'
+"""
+
+CATALOG_INDEXES_QUERY = """
+    SELECT tablename, indexname, indexdef FROM pg_indexes WHERE schemaname = 'public'
+"""
+
+CATALOG_CONSTRAINTS_QUERY = """
+    SELECT c.relname, con.conname, pg_get_constraintdef(con.oid)
+    FROM pg_constraint con
+    JOIN pg_class c ON c.oid = con.conrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = 'public'
+"""
+
+
+def connect_db(db_name):
+    import psycopg2
+    if '=' in db_name or '://' in db_name:
+        return psycopg2.connect(db_name)
+    else:
+        return psycopg2.connect(dbname=db_name)
+
+
+def get_db_catalog(db_name):
+    """Get the definitions of all tables and views using a few catalog queries over one connection
+
+    Returns {'tables': {name: definition}, 'views': {name: definition}, 'rowcount_estimates': {table: reltuples}}
+    where definition is a dict of columns, indexes and constraints (and the view query for views)
+    """
+    conn = connect_db(db_name)
+    try:
+        with conn.cursor() as cur:
+            catalog = {'tables': {}, 'views': {}, 'rowcount_estimates': {}}
+            relations = {}
+            cur.execute(CATALOG_RELATIONS_QUERY)
+            for name, kind, reltuples, view_definition in cur.fetchall():
+                definition = relations[name] = {'columns': {}, 'indexes': {}, 'constraints': {}}
+                if kind in ('v', 'm'):
+                    definition['definition'] = view_definition
+                    catalog['views'][name] = definition
+                else:
+                    catalog['tables'][name] = definition
+                    catalog['rowcount_estimates'][name] = reltuples
+            cur.execute(CATALOG_COLUMNS_QUERY)
+            for table_name, column_name, *column in cur.fetchall():
+                if table_name in relations:
+                    relations[table_name]['columns'][column_name] = ' '.join(str(x) for x in column)
+            cur.execute(CATALOG_INDEXES_QUERY)
+            for table_name, index_name, index_definition in cur.fetchall():
+                if table_name in relations:
+                    relations[table_name]['indexes'][index_name] = index_definition
+            cur.execute(CATALOG_CONSTRAINTS_QUERY)
+            for table_name, constraint_name, constraint_definition in cur.fetchall():
+                if table_name in relations:
+                    relations[table_name]['constraints'][constraint_name] = constraint_definition
+        return catalog
+    finally:
+        conn.close()
+
+
+def format_catalog_definition(definition):
+    """Format a catalog table / view definition as text, sorted so that it can be diffed"""
+    lines = []
+    for key in ('columns', 'indexes', 'constraints'):
+        if definition[key]:
+            lines.append('{}:'.format(key.capitalize()))
+            lines += sorted('    {} {}'.format(name, value) for name, value in definition[key].items())
+    if definition.get('definition'):
+        lines.append('View definition:')
+        lines += ['    ' + x for x in definition['definition'].strip().splitlines()]
+    return '\n'.join(lines)
+
+
+def get_table_rowcounts(options, tables, rowcount_estimates=None):
+    """Get the row count of the tables in both DBs, returns {table: (db1_rowcount, db2_rowcount)}
+
+    Tables are counted in parallel, each worker uses its own connection per DB
+    """
+    if options.rowcount_estimate:
+        if rowcount_estimates is None:
+            rowcount_estimates = [get_db_catalog(options.db1)['rowcount_estimates'],
+                                  get_db_catalog(options.db2)['rowcount_estimates']]
+        return {t: (rowcount_estimates[0].get(t), rowcount_estimates[1].get(t)) for t in tables}
+    local = threading.local()
+    conns, conns_lock = [], threading.Lock()
+
+    def count(db_name, table_name):
+        if not options.catalog:
+            return get_table_rowcount(db_name, table_name)
+        if not hasattr(local, 'conns'):
+            local.conns = {}
+        if db_name not in local.conns:
+            local.conns[db_name] = connect_db(db_name)
+            with conns_lock:
+                conns.append(local.conns[db_name])
+        with local.conns[db_name].cursor() as cur:
+            cur.execute('select count(1) from "{}";'.format(table_name))
+            return cur.fetchone()[0]
+
+    try:
+        with ThreadPoolExecutor(max(1, options.rowcount_workers)) as executor:
+            futures = {
+                t: (executor.submit(count, options.db1, t), executor.submit(count, options.db2, t))
+                for t in tables
+            }
+            return {t: (f1.result(), f2.result()) for t, (f1, f2) in futures.items()}
+    finally:
+        for conn in conns:
+            conn.close()
+
+
 def compare_number_of_items(options, db1_items, db2_items, items_name):
+    if options.json:
+        return {'additional_in_db1': sorted(db1_items - db2_items), 'additional_in_db2': sorted(db2_items - db1_items)}
     if db1_items != db2_items:
         additional_db1 = db1_items - db2_items
         additional_db2 = db2_items - db1_items
@@ -216,23 +358,35 @@ def compare_number_of_items(options, db1_items, db2_items, items_name):
 
 # TODO: Using same function to compare tables and views. It is not very suited
 # for views. But I do not see any clear way to have cleaner interface
-def compare_each_table(options, db1_tables, db2_tables, items_name):
+def compare_each_table(options, db1_tables, db2_tables, items_name, db1_definitions=None, db2_definitions=None,
+                       rowcount_estimates=None):
+    """Compare the definitions of tables / views in both DBs
+
+    :param db1_definitions / db2_definitions: catalog definitions, if not provided psql \\d output is compared
+    """
     not_matching_tables = []
     not_matching_rowcount = []
+    rowcount_tables = []
+    diffs = {}
 
     for t in sorted(db1_tables & db2_tables):
-        t1 = get_table_definition(options.db1, t)
-        t2 = get_table_definition(options.db2, t)
+        if db1_definitions is not None:
+            t1 = format_catalog_definition(db1_definitions[t])
+            t2 = format_catalog_definition(db2_definitions[t])
+        else:
+            t1 = get_table_definition(options.db1, t)
+            t2 = get_table_definition(options.db2, t)
         if t1 != t2:
             not_matching_tables.append(t)
 
-            diff = difflib.unified_diff(
+            diff = list(difflib.unified_diff(
                 [x + '\n' for x in t1.splitlines()],
                 [x + '\n' for x in t2.splitlines()],
                 '{}.{}.{}'.format(items_name, options.db1, t),
                 '{}.{}.{}'.format(items_name, options.db2, t),
                 n=sys.maxsize
-            )
+            ))
+            diffs[t] = ''.join(diff)
 
             if options.diff_folder:
                 if not os.path.exists(options.diff_folder):
@@ -244,11 +398,23 @@ def compare_each_table(options, db1_tables, db2_tables, items_name):
                     for diff_line in diff:
                         f.write(diff_line)
 
-        elif options.rowcount:
-            t1_rowcount = get_table_rowcount(options.db1, t)
-            t2_rowcount = get_table_rowcount(options.db2, t)
-            if t1_rowcount != t2_rowcount:
-                not_matching_rowcount.append('{} ({} != {})'.format(t, t1_rowcount, t2_rowcount))
+        elif (
+            (options.rowcount_estimate and items_name == 'TABLES')
+            or (options.rowcount and not options.rowcount_estimate)
+        ):
+            rowcount_tables.append(t)
+
+    rowcounts = get_table_rowcounts(options, rowcount_tables, rowcount_estimates) if rowcount_tables else {}
+    for t in rowcount_tables:
+        t1_rowcount, t2_rowcount = rowcounts[t]
+        if t1_rowcount != t2_rowcount:
+            not_matching_rowcount.append(t)
+
+    if options.json:
+        return {
+            'not_matching': {t: diffs[t] for t in not_matching_tables},
+            'not_matching_rowcount': {t: list(rowcounts[t]) for t in not_matching_rowcount},
+        }
 
     if not_matching_tables:
         sys.stdout.write('{}: not matching\n'.format(items_name))
@@ -259,24 +425,45 @@ def compare_each_table(options, db1_tables, db2_tables, items_name):
     if not_matching_rowcount:
         sys.stdout.write('{}: not matching rowcount\n'.format(items_name))
         for t in not_matching_rowcount:
-            sys.stdout.write('\t{}\n'.format(t))
+            sys.stdout.write('\t{} ({} != {})\n'.format(t, *rowcounts[t]))
         sys.stdout.write('\n')
 
 
 def main():
     options = parser_arguments()
+    results = {}
+
+    if options.catalog:
+        db1_catalog = get_db_catalog(options.db1)
+        db2_catalog = get_db_catalog(options.db2)
+        rowcount_estimates = [db1_catalog['rowcount_estimates'], db2_catalog['rowcount_estimates']]
+        for items_name, key in (('TABLES', 'tables'), ('VIEWS', 'views')):
+            db1_items, db2_items = set(db1_catalog[key]), set(db2_catalog[key])
+            results[key] = dict(
+                compare_number_of_items(options, db1_items, db2_items, items_name) or {},
+                **(compare_each_table(options, db1_items, db2_items, items_name,
+                                      db1_catalog[key], db2_catalog[key], rowcount_estimates) or {})
+            )
+    else:
+        db1_tables = get_db_tables(options.db1)
+        db2_tables = get_db_tables(options.db2)
 
-    db1_tables = get_db_tables(options.db1)
-    db2_tables = get_db_tables(options.db2)
+        results['tables'] = dict(
+            compare_number_of_items(options, db1_tables, db2_tables, 'TABLES') or {},
+            **(compare_each_table(options, db1_tables, db2_tables, 'TABLES') or {})
+        )
 
-    compare_number_of_items(options, db1_tables, db2_tables, 'TABLES')
-    compare_each_table(options, db1_tables, db2_tables, 'TABLES')
+        db1_views = get_db_views(options.db1)
+        db2_views = get_db_views(options.db2)
+        results['views'] = dict(
+            compare_number_of_items(options, db1_views, db2_views, 'VIEWS') or {},
+            **(compare_each_table(options, db1_views, db2_views, 'VIEWS') or {})
+        )
 
-    db1_views = get_db_views(options.db1)
-    db2_views = get_db_views(options.db2)
-    compare_number_of_items(options, db1_views, db2_views, 'VIEWS')
-    compare_each_table(options, db1_views, db2_views, 'VIEWS')
+    if options.json:
+        json.dump(dict(results, db1=options.db1, db2=options.db2), sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
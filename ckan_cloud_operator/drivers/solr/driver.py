@@ -0,0 +1,54 @@
+import threading
+import time
+
+import requests
+
+from ckan_cloud_operator import logs
+
+
+__SESSION = None
+__LOCK = threading.Lock()
+
+
+def get_session():
+    global __SESSION
+    with __LOCK:
+        if not __SESSION:
+            __SESSION = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=20)
+            __SESSION.mount('http://', adapter)
+            __SESSION.mount('https://', adapter)
+        return __SESSION
+
+
+def curl(base_url, path, required=False, max_retries=15, parse_json=False, on_retry=None, timeout=60):
+    """Make a Solr HTTP GET request using a pooled session
+
+    If required, failed requests are retried with exponential backoff (up to 30 seconds) and an exception is raised
+    if all retries failed, otherwise returns False on failure.
+    Returns the response text, or the parsed response if parse_json is set.
+
+    :param base_url: the Solr base url, e.g. http://solr:8983/solr - or a function which returns it
+    :param on_retry: called before each retry, can be used to restore the connection
+    """
+    for retry_num in range(max_retries + 1 if required else 1):
+        url = (base_url() if callable(base_url) else base_url) + path
+        try:
+            res = get_session().get(url, timeout=timeout)
+            if res.status_code == 200:
+                return res.json() if parse_json else res.text
+            error = f'{res.status_code} {res.text}'
+        except (requests.ConnectionError, requests.Timeout, ValueError) as e:
+            error = str(e)
+        if not required:
+            logs.warning(f'Failed to run solr request: {url}: {error}')
+            return False
+        elif retry_num < max_retries:
+            sleep_seconds = min(2 ** retry_num, 30)
+            logs.info(f'Failed to run solr request: {url} - retrying in {sleep_seconds} seconds')
+            logs.debug(error)
+            time.sleep(sleep_seconds)
+            if on_retry:
+                on_retry()
+    logs.critical(error)
+    raise Exception(f'Failed to run solr request: {url}')
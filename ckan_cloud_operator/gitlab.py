@@ -1,14 +1,98 @@
+"""GitLab API client
+
+Requests use a pooled HTTPS session per token and are retried with backoff on rate-limit / server errors.
+GET responses are cached on disk (CKAN_CLOUD_OPERATOR_GITLAB_CACHE_DIR, set to an empty string to disable)
+and revalidated using conditional requests (ETag / If-None-Match), so unchanged responses are not downloaded again.
+"""
+import hashlib
 import json
-import subprocess
+import os
 import re
-import functools
+import tempfile
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
 
 from ckan_cloud_operator import logs
 
 
+API_URL = 'https://gitlab.com/api/v4/'
+MAX_RETRIES = 5
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+POOL_MAXSIZE = 16
+CACHE_DIR = os.environ.get('CKAN_CLOUD_OPERATOR_GITLAB_CACHE_DIR',
+                           os.path.expanduser('~/.cache/ckan-cloud-operator/gitlab'))
+
+__SESSIONS = {}
+__TOKENS = {}
+__PROJECT_IDS = {}
+# .env file contents, keyed by (project, commit sha)
+__DOTENV_CACHE = {}
+__LOCK = threading.Lock()
+
+
+def clear_cache():
+    __DOTENV_CACHE.clear()
+    __PROJECT_IDS.clear()
+    __TOKENS.clear()
+
+
+def get_files(projects, file, ref='master', concurrency=8):
+    """Get a file from multiple projects concurrently, returns {project: content}, content is None on failure"""
+    ckan_gitlab = CkanGitlab()
+
+    def _get_file(project):
+        try:
+            return project, ckan_gitlab._get_file(project, file, ref=ref)
+        except Exception as e:
+            logs.warning(f'Failed to get {project}/{file}: {e}')
+            return project, None
+
+    with ThreadPoolExecutor(max(1, concurrency)) as executor:
+        return dict(executor.map(_get_file, projects))
+
+
+def get_project_id(project):
+    """Get the id of a project by its path, the ids are cached for the run"""
+    if project not in __PROJECT_IDS:
+        gitlab_project_encoded = project.replace('/', '%2F')
+        __PROJECT_IDS[project] = json.loads(request(f'projects/{gitlab_project_encoded}'))['id']
+    return __PROJECT_IDS[project]
+
+
+def request(urlpart, postjson=None, method='GET', token_name=None):
+    """Make a GitLab API request, returns the response text
+
+    GET requests are revalidated against the on-disk response cache, other requests are sent with the postjson body
+    """
+    logs.debug(f'GitLab API request: {method} {urlpart}')
+    session = _get_session(token_name)
+    url = f'{API_URL}{urlpart}'
+    cached = _get_cached_response(token_name, url) if method == 'GET' else None
+    headers = {'If-None-Match': cached['etag']} if cached else {}
+    for retry_num in range(MAX_RETRIES + 1):
+        res = session.request(method, url, json=postjson, headers=headers, timeout=60)
+        if res.status_code not in RETRY_STATUS_CODES or retry_num == MAX_RETRIES:
+            break
+        retry_after = res.headers.get('Retry-After')
+        sleep_seconds = int(retry_after) if retry_after and retry_after.isdigit() else min(2 ** retry_num, 60)
+        logs.warning(f'GitLab API request failed ({res.status_code}), retrying in {sleep_seconds} seconds')
+        time.sleep(sleep_seconds)
+    if cached and res.status_code == 304:
+        return cached['text']
+    if postjson:
+        assert res.status_code in [200, 201], res.text
+    else:
+        res.raise_for_status()
+    if method == 'GET' and res.headers.get('ETag'):
+        _set_cached_response(token_name, url, res.headers['ETag'], res.text)
+    return res.text
+
+
 class CkanGitlab(object):
 
     def initialize(self, project, git_branch='master'):
@@ -59,7 +143,21 @@ class CkanGitlab(object):
             return False
 
     def get_envvars(self, project, git_branch='master'):
-        return self._parse_dotenv(self._get_file(project, '.env', ref=git_branch))
+        """Get the parsed .env file, the file is fetched once per commit of the branch"""
+        commit_sha = self.get_branch_commit_sha(project, git_branch)
+        key = (project, commit_sha)
+        content = _get_cached_dotenv(key)
+        if content is None:
+            content = self._get_file(project, '.env', ref=commit_sha)
+            _set_cached_dotenv(key, content)
+        else:
+            logs.debug(f'using cached .env: {project}@{commit_sha}')
+        return self._parse_dotenv(content)
+
+    def get_branch_commit_sha(self, project, git_branch='master'):
+        project_id = self._get_project_id(project)
+        branch = git_branch.replace('/', '%2F')
+        return json.loads(self._curl(f'projects/{project_id}/repository/branches/{branch}'))['commit']['id']
 
     def _get_updated_dockerfile(self, data):
         needs_update = False
@@ -105,32 +203,19 @@ class CkanGitlab(object):
                 return None
 
     def _curl(self, urlpart, postjson=None, method='POST', token_name=None, download_filename=None):
-        from ckan_cloud_operator.providers.ckan import manager as ckan_manager
-        gitlab_token = ckan_manager.gitlab_token(token_name)
         if postjson:
-            r = requests.request(
-                method,
-                f'https://gitlab.com/api/v4/{urlpart}',
-                headers={
-                    'PRIVATE-TOKEN': gitlab_token
-                },
-                json=postjson
-            )
-            assert r.status_code in [200, 201], r.text
-            return r.text
+            return request(urlpart, postjson, method, token_name=token_name)
         elif download_filename:
-            cmd = f'curl -f -s --header "PRIVATE-TOKEN: {gitlab_token}" https://gitlab.com/api/v4/{urlpart} > {download_filename}'
-            subprocess.check_call(cmd, shell=True)
+            with _get_session(token_name).get(f'{API_URL}{urlpart}', stream=True, timeout=60) as res:
+                res.raise_for_status()
+                with open(download_filename, 'wb') as f:
+                    for chunk in res.iter_content(chunk_size=1024 * 1024):
+                        f.write(chunk)
         else:
-            cmd = ['curl', '-f', '-s',
-                   '--header', f'PRIVATE-TOKEN: {gitlab_token}',
-                   f'https://gitlab.com/api/v4/{urlpart}']
-            return subprocess.check_output(cmd).decode()
+            return request(urlpart, token_name=token_name)
 
-    @functools.lru_cache()
     def _get_project_id(self, project):
-        gitlab_project_encoded = project.replace('/', '%2F')
-        return json.loads(self._curl(f'projects/{gitlab_project_encoded}'))['id']
+        return get_project_id(project)
 
     def _parse_dotenv(self, content, overrides=None):
         # https://github.com/joke2k/django-environ/blob/develop/environ/environ.py
@@ -175,3 +260,60 @@ build:
     - docker push "$CI_REGISTRY_IMAGE:$CI_COMMIT_REF_SLUG"
   except:
     - {git_branch}""".format(git_branch=git_branch)
+
+
+# module level cache accessors, the cache global names would be mangled inside the class
+
+
+def _get_cached_dotenv(key):
+    return __DOTENV_CACHE.get(key)
+
+
+def _set_cached_dotenv(key, content):
+    __DOTENV_CACHE[key] = content
+
+
+def _get_session(token_name=None):
+    with __LOCK:
+        if token_name not in __TOKENS:
+            from ckan_cloud_operator.providers.ckan import manager as ckan_manager
+            __TOKENS[token_name] = ckan_manager.gitlab_token(token_name)
+        gitlab_token = __TOKENS[token_name]
+        if gitlab_token not in __SESSIONS:
+            session = requests.Session()
+            session.headers.update({'PRIVATE-TOKEN': gitlab_token})
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE)
+            session.mount('https://', adapter)
+            __SESSIONS[gitlab_token] = session
+        return __SESSIONS[gitlab_token]
+
+
+def _get_response_cache_filename(token_name, url):
+    # the token name is part of the key, responses may differ between tokens with different permissions
+    key = hashlib.sha256(f'{token_name or ""}:{url}'.encode()).hexdigest()
+    return os.path.join(CACHE_DIR, key[:2], f'{key}.json')
+
+
+def _get_cached_response(token_name, url):
+    if not CACHE_DIR:
+        return None
+    try:
+        with open(_get_response_cache_filename(token_name, url)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _set_cached_response(token_name, url, etag, text):
+    """Write a response to the cache, the responses may include secrets so the cache is readable only by the user"""
+    if not CACHE_DIR:
+        return
+    filename = _get_response_cache_filename(token_name, url)
+    try:
+        os.makedirs(os.path.dirname(filename), mode=0o700, exist_ok=True)
+        fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename))
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'etag': etag, 'text': text}, f)
+        os.replace(tmp_filename, filename)
+    except OSError as e:
+        logs.warning(f'Failed to cache GitLab response: {e}')
@@ -2,16 +2,54 @@ import yaml
 import base64
 import traceback
 import datetime
+import hashlib
 import json
 import logging
+import os
 import subprocess
+import tempfile
 from ckan_cloud_operator import yaml_config
 from ckan_cloud_operator import logs
+from ckan_cloud_operator.drivers.kubectl import api as kubectl_api
+
+
+__API_CLIENT = None
+
+
+def get_api_client():
+    """Returns the native API client if enabled with CKAN_CLOUD_OPERATOR_KUBECTL_BACKEND=api, otherwise None"""
+    global __API_CLIENT
+    if __API_CLIENT is None:
+        __API_CLIENT = False
+        if os.environ.get('CKAN_CLOUD_OPERATOR_KUBECTL_BACKEND') == 'api':
+            try:
+                __API_CLIENT = kubectl_api.load_kubeconfig_client()
+            except Exception:
+                logs.warning('Failed to initialize kubectl api client, falling back to kubectl subprocess')
+                logs.debug_verbose(traceback.format_exc())
+    return __API_CLIENT or None
+
+
+def set_api_client(client):
+    """Override the API client, set to None to use the kubectl subprocess"""
+    global __API_CLIENT
+    __API_CLIENT = client or False
+    from ckan_cloud_operator.drivers.kubectl import informer
+    informer.reset()
 
 
 def check_call(cmd, namespace='ckan-cloud', use_first_pod=False):
     cmd = _parse_call_cmd(cmd, namespace, use_first_pod)
-    logs.subprocess_check_call(f'kubectl -n {namespace} {cmd}', shell=True)
+    client = get_api_client()
+    try:
+        if client:
+            try:
+                return client.call_cmd(cmd, namespace=namespace)
+            except kubectl_api.UnsupportedCommand as e:
+                logs.debug(f'kubectl api client fallback: {e}')
+        logs.subprocess_check_call(f'kubectl -n {namespace} {cmd}', shell=True)
+    finally:
+        _invalidate_informers(cmd=cmd)
 
 
 def get_deployment_pod_name(deployment_name, namespace='ckan-cloud', use_first_pod=False, required_phase=None):
@@ -32,7 +70,20 @@ def check_output(cmd, namespace='ckan-cloud'):
 
 
 def call(cmd, namespace='ckan-cloud'):
-    return subprocess.call(f'kubectl -n {namespace} {cmd}', shell=True)
+    client = get_api_client()
+    try:
+        if client:
+            try:
+                client.call_cmd(cmd, namespace=namespace)
+                return 0
+            except kubectl_api.UnsupportedCommand as e:
+                logs.debug(f'kubectl api client fallback: {e}')
+            except kubectl_api.KubeApiError as e:
+                logs.error(str(e))
+                return 1
+        return subprocess.call(f'kubectl -n {namespace} {cmd}', shell=True)
+    finally:
+        _invalidate_informers(cmd=cmd)
 
 
 def getstatusoutput(cmd, namespace='ckan-cloud', use_first_pod=False):
@@ -41,6 +92,17 @@ def getstatusoutput(cmd, namespace='ckan-cloud', use_first_pod=False):
 
 
 def get(what, *args, required=True, namespace='ckan-cloud', get_cmd='get', **kwargs):
+    client = get_api_client()
+    if client:
+        try:
+            return client.get_cmd(what, args, namespace=namespace, get_cmd=get_cmd, kwargs=kwargs)
+        except kubectl_api.UnsupportedCommand as e:
+            logs.debug(f'kubectl api client fallback: {e}')
+        except kubectl_api.KubeApiError:
+            if required:
+                raise
+            else:
+                return None
     extra_args = ' '.join(args)
     extra_kwargs = ' '.join([f'{k} {v}' for k, v in kwargs.items()])
     try:
@@ -66,6 +128,7 @@ def edit(what, *edit_args, namespace='ckan-cloud', **edit_kwargs):
         name = item['metadata']['name']
         kind = item['kind']
         subprocess.check_call(f'kubectl -n {namespace} edit {kind}/{name} {extra_edit_args} {extra_edit_kwargs}', shell=True)
+        _invalidate_informers(kind, name)
 
 
 def get_items_by_labels(resource_kind, labels, required=True, namespace='ckan-cloud'):
@@ -78,6 +141,16 @@ def get_items_by_labels(resource_kind, labels, required=True, namespace='ckan-cl
     return res['items'] if res else None
 
 
+def get_all_namespaces_items(resource_kinds, required=False):
+    """Get the items of all namespaces using one call per kind, returns items grouped by namespace"""
+    namespaces_items = {}
+    for resource_kind in resource_kinds:
+        res = get(resource_kind, '--all-namespaces', required=required)
+        for item in (res or {}).get('items', []):
+            namespaces_items.setdefault(item['metadata'].get('namespace'), []).append(item)
+    return namespaces_items
+
+
 def edit_items_by_labels(resource_kind, labels, namespace='ckan-cloud'):
     label_selector = ','.join([f'{k}={v}' for k,v in labels.items()])
     edit(f'{resource_kind} -l {label_selector}', namespace=namespace)
@@ -112,16 +185,26 @@ def decode_secret(secret, attr=None, required=False):
         }
 
 
-def update_secret(name, values, namespace='ckan-cloud', labels=None, dry_run=False):
+def update_secret(name, values, namespace='ckan-cloud', labels=None, dry_run=False, secret=None, skip_unchanged=False):
+    """Update the values of a secret, keeping the existing values
+
+    :param secret: previously fetched secret, to skip getting it again (use {} if the secret doesn't exist)
+    :param skip_unchanged: skip the apply if the digest of the updated values matches the existing secret
+    """
     for k, v in values.items():
         v_type = type(v)
         assert v_type == str, f'Invalid type ({v_type}) for {k}: {v}'
     if not labels:
         labels = {}
-    secret = get(f'secret {name}', required=False, namespace=namespace)
+    if secret is None:
+        secret = get(f'secret {name}', required=False, namespace=namespace)
     labels = dict(secret.get('metadata', {}).get('labels', {}), **labels) if secret else labels
-    data = decode_secret(secret, required=False)
-    data.update(**values)
+    cur_data = decode_secret(secret, required=False)
+    data = dict(cur_data, **values)
+    if skip_unchanged and secret and get_secret_data_digest(data) == get_secret_data_digest(cur_data) \
+            and labels == secret.get('metadata', {}).get('labels', {}):
+        logs.debug(f'secret is up to date: {namespace}/{name}')
+        return data
     apply({
         'apiVersion': 'v1',
         'kind': 'Secret',
@@ -136,6 +219,11 @@ def update_secret(name, values, namespace='ckan-cloud', labels=None, dry_run=Fal
     return data
 
 
+def get_secret_data_digest(data):
+    """Returns a digest of decoded secret data, empty values are ignored as they are not saved in the secret"""
+    return hashlib.sha256(json.dumps({k: v for k, v in data.items() if v}, sort_keys=True).encode()).hexdigest()
+
+
 def update_configmap(name, values, namespace='ckan-cloud', labels=None, dry_run=False):
     for k, v in values.items():
         v_type = type(v)
@@ -197,13 +285,161 @@ def get_deployment_detailed_status(deployment, pod_label_selector, main_containe
     return dict(status, ready=ready, namespace=deployment['metadata']['namespace'])
 
 
+def is_deployment_rolled_out(deployment):
+    """Same conditions as kubectl rollout status: all replicas are updated to the latest generation and available"""
+    status = deployment.get('status') or {}
+    replicas = deployment['spec'].get('replicas', 1)
+    return (
+        status.get('observedGeneration', 0) >= deployment['metadata'].get('generation', 0)
+        and status.get('updatedReplicas', 0) == replicas
+        and status.get('replicas', 0) == replicas
+        and status.get('availableReplicas', 0) == replicas
+    )
+
+
+def wait_deployment_rollout(name, namespace='ckan-cloud', timeout_seconds=600):
+    """Wait for a deployment rolling update to complete using a watch on the deployment"""
+    client = get_api_client()
+    if not client:
+        return check_call(f'rollout status deployment/{name} --timeout={timeout_seconds}s', namespace=namespace)
+    deadline = datetime.datetime.now() + datetime.timedelta(seconds=timeout_seconds)
+    deployment = client.get('deployments', name, namespace=namespace)
+    while not is_deployment_rolled_out(deployment):
+        remaining_seconds = (deadline - datetime.datetime.now()).total_seconds()
+        assert remaining_seconds > 0, f'timed out waiting for deployment rollout: {name}'
+        for event_type, obj in client.watch('deployments', namespace=namespace,
+                                            field_selector=f'metadata.name={name}',
+                                            resource_version=deployment['metadata']['resourceVersion'],
+                                            timeout_seconds=max(1, min(int(remaining_seconds), 60))):
+            if event_type == 'ERROR':
+                obj = client.get('deployments', name, namespace=namespace)
+            elif event_type == 'DELETED':
+                raise Exception(f'deployment was deleted during rollout: {name}')
+            elif event_type == 'BOOKMARK':
+                continue
+            deployment = obj
+            logs.debug('deployment rollout', name=name, generation=deployment['metadata'].get('generation'),
+                       status=deployment.get('status'))
+            if is_deployment_rolled_out(deployment):
+                break
+
+
+def get_pod_logs(pod_name, container=None, namespace='ckan-cloud', since_time=None, tail_lines=None, timestamps=False):
+    """Get the logs of a pod container, returns None if the logs could not be fetched
+
+    :param since_time: RFC3339 timestamp, only logs from this time are returned
+    :param timestamps: prefix each line with its RFC3339Nano timestamp
+    """
+    client = get_api_client()
+    if client:
+        try:
+            return client.read_pod_log(pod_name, namespace=namespace, container=container, since_time=since_time,
+                                       tail_lines=tail_lines, timestamps=timestamps)
+        except kubectl_api.KubeApiError as e:
+            logs.debug(f'failed to get pod logs: {e}')
+            return None
+    cmd = ['kubectl', '-n', namespace, 'logs', pod_name]
+    if container:
+        cmd += ['-c', container]
+    if since_time:
+        cmd.append(f'--since-time={since_time}')
+    if tail_lines is not None:
+        cmd.append(f'--tail={int(tail_lines)}')
+    if timestamps:
+        cmd.append('--timestamps')
+    res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if res.returncode != 0:
+        logs.debug(f'failed to get pod logs: {res.stderr.decode(errors="replace")}')
+        return None
+    return res.stdout.decode(errors='replace')
+
+
+class PodLogsStream(object):
+    """Stream the log lines of a pod container, close() can be called from another thread to stop streaming"""
+
+    def __init__(self, pod_name, container=None, namespace='ckan-cloud', follow=True, since_seconds=None,
+                 tail_lines=None):
+        self.pod_name = pod_name
+        self.container = container
+        self.namespace = namespace
+        self.follow = follow
+        self.since_seconds = since_seconds
+        self.tail_lines = tail_lines
+        self._process = None
+        self._stderr = None
+        self._response = None
+        self._closed = False
+
+    def __iter__(self):
+        client = get_api_client()
+        if client:
+            res = client.read_pod_log(self.pod_name, namespace=self.namespace, container=self.container,
+                                      since_seconds=self.since_seconds, tail_lines=self.tail_lines, follow=self.follow)
+            if self.follow:
+                self._response = res
+                lines = (line.decode(errors='replace') for line in res.iter_lines())
+            else:
+                lines = iter(res.splitlines())
+        else:
+            cmd = ['kubectl', '-n', self.namespace, 'logs', self.pod_name]
+            if self.container:
+                cmd += ['-c', self.container]
+            if self.follow:
+                cmd.append('-f')
+            if self.since_seconds:
+                cmd.append(f'--since={int(self.since_seconds)}s')
+            if self.tail_lines is not None:
+                cmd.append(f'--tail={int(self.tail_lines)}')
+            # stderr is written to a file, so that a large error output doesn't block the process
+            self._stderr = tempfile.TemporaryFile()
+            self._process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=self._stderr)
+            lines = (line.decode(errors='replace').rstrip('\n') for line in self._process.stdout)
+        try:
+            for line in lines:
+                if self._closed:
+                    break
+                yield line
+            if self._process and not self._closed:
+                self._check_process()
+        except Exception:
+            # closing the stream from another thread raises an exception in the reading thread
+            if not self._closed:
+                raise
+        finally:
+            self.close()
+
+    def _check_process(self):
+        returncode = self._process.wait()
+        if returncode != 0:
+            self._stderr.seek(0)
+            error = self._stderr.read().decode(errors='replace').strip()
+            raise Exception(f'kubectl logs failed ({returncode}): {error}')
+
+    def close(self):
+        self._closed = True
+        if self._process and self._process.poll() is None:
+            self._process.terminate()
+        if self._stderr:
+            self._stderr.close()
+        if self._response:
+            kubectl_api.close_response(self._response)
+
+
 def create(resource, is_yaml=False):
     if is_yaml: resource = yaml.load(resource)
+    client = get_api_client()
     try:
+        if client:
+            try:
+                return client.create(resource)
+            except kubectl_api.UnsupportedCommand as e:
+                logs.debug(f'kubectl api client fallback: {e}')
         logs.subprocess_run('kubectl create -f -', input=yaml.dump(resource).encode())
     except:
         logging.exception('Failed to create resource\n%s', yaml.dump(resource, default_flow_style=False))
         raise
+    finally:
+        _invalidate_informers(resource.get('kind'), resource.get('metadata', {}).get('name'))
 
 
 
@@ -214,14 +450,25 @@ def apply(resource, is_yaml=False, reconcile=False, dry_run=False):
     if dry_run:
         args.append('--dry-run')
     args = " ".join(args)
+    client = None if reconcile else get_api_client()
     try:
-        logs.subprocess_run(
-            f'kubectl {cmd} {args} -f -',
-            input=yaml.dump(resource).encode()
-        )
+        applied = False
+        if client:
+            try:
+                client.apply(resource, dry_run=dry_run)
+                applied = True
+            except kubectl_api.UnsupportedCommand as e:
+                logs.debug(f'kubectl api client fallback: {e}')
+        if not applied:
+            logs.subprocess_run(
+                f'kubectl {cmd} {args} -f -',
+                input=yaml.dump(resource).encode()
+            )
     except:
         logging.exception('Failed to apply resource\n%s', yaml.dump(resource, default_flow_style=False))
         raise
+    if not dry_run:
+        _invalidate_informers(resource.get('kind'), resource.get('metadata', {}).get('name'))
     if dry_run:
         print(yaml.dump(resource, default_flow_style=False))
 
@@ -518,6 +765,14 @@ class BaseAnnotations(object):
         return self.resource_values['metadata'].get('annotations', {}).get(f'ckan-cloud/{annotation}', default)
 
 
+def _invalidate_informers(kind=None, name=None, cmd=None):
+    from ckan_cloud_operator.drivers.kubectl import informer
+    if cmd:
+        informer.invalidate_cmd(cmd)
+    elif kind:
+        informer.invalidate(kind, name)
+
+
 def _parse_call_cmd(cmd, namespace, use_first_pod):
     args = []
     for arg in cmd.split(' '):
@@ -1,5 +1,6 @@
 from logging import CRITICAL, ERROR, WARNING, INFO, DEBUG, getLevelName
 import datetime
+import json
 from distutils.util import strtobool
 import os
 from ruamel import yaml
@@ -14,6 +15,9 @@ CKAN_CLOUD_OPERATOR_DEBUG_VERBOSE = strtobool(os.environ.get('CKAN_CLOUD_OPERATO
 
 DEBUG_VERBOSE = 'verbose debug'
 
+CKAN_CLOUD_LOG_START = '--START_CKAN_CLOUD_LOG--'
+CKAN_CLOUD_LOG_END = '--END_CKAN_CLOUD_LOG--'
+
 
 def info(*args, **kwargs):
     log(INFO, *args, **kwargs)
@@ -113,6 +117,21 @@ def yaml_dump(data, *args, **kwargs):
     return yaml.dump(data, *args, Dumper=YamlSafeDumper, default_flow_style=False, **kwargs)
 
 
+# ckan cloud logs
+
+
+def parse_ckan_cloud_logs(text):
+    """Returns the ckan cloud log data found in the text and the remaining text of an incomplete log entry"""
+    logdatas = []
+    parts = text.split(CKAN_CLOUD_LOG_START)
+    for i, logline in enumerate(parts[1:], start=1):
+        if CKAN_CLOUD_LOG_END in logline:
+            logdatas.append(json.loads(logline.split(CKAN_CLOUD_LOG_END)[0]))
+        elif i == len(parts) - 1:
+            return logdatas, CKAN_CLOUD_LOG_START + logline
+    return logdatas, ''
+
+
 class YamlSafeDumper(yaml.SafeDumper):
 
     def ignore_aliases(self, data):
@@ -3,6 +3,15 @@ import os
 import datetime
 import traceback
 import time
+import re
+import queue
+import tempfile
+import subprocess
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
 
 from ckan_cloud_operator import logs
 from ckan_cloud_operator import kubectl
@@ -31,6 +40,13 @@ from .constants import (
 )
 
 
+RESTORE_JOBS = int(os.environ.get('CKAN_CLOUD_OPERATOR_DB_RESTORE_JOBS') or 4)
+# dumps which can be imported by the db provider (Google Cloud SQL import supports plain SQL, optionally gzipped)
+PROVIDER_IMPORT_DUMP_EXTENSIONS = ('.gz', '.sql')
+# Cloud SQL runs one import operation per instance at a time, concurrent provider imports fail and are retried
+__PROVIDER_IMPORT_LOCK = threading.Lock()
+
+
 def initialize(log_kwargs=None, interactive=False):
     log_kwargs = log_kwargs or {}
     logs.info(f'Installing crds', **log_kwargs)
@@ -81,12 +97,11 @@ def delete(name, delete_dbs=False):
     migration = crds_manager.get(CRD_SINGULAR, name=name, required=False) or {}
     if delete_dbs:
         db_prefix = migration.get('spec', {}).get('db-prefix') or ''
-        admin_connection_string = db_manager.get_external_admin_connection_string(db_prefix=db_prefix)
         db_name = migration.get('spec', {}).get('datastore-name')
         datastore_name = migration.get('spec', {}).get('db-name')
         datastore_ro_name = crds_manager.config_get(CRD_SINGULAR, name, key='datastore-readonly-user-name', is_secret=True, required=False)
         if db_name or datastore_name or datastore_ro_name:
-            with postgres_driver.connect(admin_connection_string) as admin_conn:
+            with db_manager.admin_connect(db_prefix=db_prefix) as admin_conn:
                 _delete_dbs(admin_conn, db_name, datastore_name, datastore_ro_name)
     crds_manager.delete(CRD_SINGULAR, name)
 
@@ -310,6 +325,31 @@ def get_db_import_urls(old_site_id):
     )
 
 
+def get_latest_backup_urls(gs_base_url, db_names, date_path, hour=None):
+    """Find the latest hourly backups of the given dbs using a single listing of the date path
+
+    Backups are stored as {gs_base_url}/{date_path}/{HH}/{db_name}_{YYYYmmddHHMM}.gz
+    Returns the backup urls (in the order of db_names) from the latest hour which has backups of all the dbs,
+    or None if not found
+    """
+    date_url = f'{gs_base_url}/{date_path}/'
+    list_url = f'{date_url}{hour:02d}/*' if hour is not None else f'{date_url}**'
+    logs.info(f'looking for backups in {list_url}')
+    _, output = _gcloud().getstatusoutput(f"ls '{list_url}'", gsutil=True)
+    hour_urls = {}
+    for url in output.splitlines():
+        if not url.startswith(date_url) or url.count('/') != date_url.count('/') + 1:
+            continue
+        url_hour, filename = url[len(date_url):].split('/')
+        for db_name in db_names:
+            if re.match(rf'^{re.escape(db_name)}_\d+\.', filename):
+                hour_urls.setdefault(url_hour, {}).setdefault(db_name, []).append(url)
+    for url_hour in sorted(hour_urls, reverse=True):
+        if all(db_name in hour_urls[url_hour] for db_name in db_names):
+            return [max(hour_urls[url_hour][db_name]) for db_name in db_names]
+    return None
+
+
 def _get_spec(name, spec):
     return dict(name=name, **spec)
 
@@ -378,9 +418,10 @@ def _initialize_postgis_extensions(db_name, db_prefix):
 
 def _update_db_proxy(db_name, datastore_name, datastore_ro_name, db_password, datastore_password, datastore_ro_password, db_prefix):
     logs.info('Updating db proxy')
-    db_proxy_manager.update(wait_updated=False)
+    # waits until the new databases are live in the proxy
+    db_proxy_manager.update(wait_updated=True)
     ok = False
-    for i in range(5):
+    for i in range(10):
         try:
             for user, password, db in [(db_name, db_password, db_name),
                                        (datastore_name, datastore_password, datastore_name),
@@ -394,10 +435,8 @@ def _update_db_proxy(db_name, datastore_name, datastore_ro_name, db_password, da
         except Exception as e:
             logs.warning(str(e))
         logs.info(f'Waiting for connection to db proxy...')
-        # 40 seconds on first iteration - to ensure secret is updated in pgbouncer volume
-        time.sleep(40 if i == 0 else 1)
+        time.sleep(2)
         db_proxy_manager.reload()
-        time.sleep(10 if i == 2 else 5)
     assert ok, 'failed to get connection to db proxy'
     yield {'step': 'update-db-proxy',
            'msg': f'Updated DB Proxy with the new dbs and roles: {db_name}, {datastore_name}, {datastore_ro_name} ({db_prefix})'}
@@ -405,8 +444,7 @@ def _update_db_proxy(db_name, datastore_name, datastore_ro_name, db_password, da
 
 def _create_base_dbs_and_roles(migration_name, db_name, datastore_name, recreate_dbs, datastore_ro_name, db_prefix=None):
     logs.info('Creating base DBS')
-    admin_connection_string = db_manager.get_external_admin_connection_string(db_prefix=db_prefix)
-    with postgres_driver.connect(admin_connection_string) as admin_conn:
+    with db_manager.admin_connect(db_prefix=db_prefix) as admin_conn:
         if recreate_dbs:
             _delete_dbs(admin_conn, db_name, datastore_name, datastore_ro_name)
         if not datastore_name:
@@ -421,15 +459,12 @@ def _create_base_dbs_and_roles(migration_name, db_name, datastore_name, recreate
         )
         yield {'step': 'get-create-passwords', 'msg': 'Created Passwords'}
         admin_user = db_manager.get_admin_db_user(db_prefix=db_prefix)
-        if db_name:
-            db_errors = postgres_driver.create_base_db(admin_conn, db_name, db_password, grant_to_user=admin_user)
-        else:
-            db_errors = []
-        if datastore_name:
-            datastore_errors = postgres_driver.create_base_db(admin_conn, datastore_name, datastore_password,
-                                                              grant_to_user=admin_user)
-        else:
-            datastore_errors = []
+        errors = postgres_driver.create_base_dbs(
+            admin_conn,
+            [(name, password) for name, password in [(db_name, db_password), (datastore_name, datastore_password)] if name],
+            grant_to_user=admin_user
+        )
+        db_errors, datastore_errors = errors.get(db_name, []), errors.get(datastore_name, [])
         if datastore_name and db_name:
             assert (len(datastore_errors) == 0 and len(db_errors) == 0) or len(password_errors) == 3, \
                 'some passwords were not created, but DB / roles need to be created, we cannot know the right passwords'
@@ -442,10 +477,8 @@ def _create_base_dbs_and_roles(migration_name, db_name, datastore_name, recreate
 
 
 def _delete_dbs(admin_conn, db_name, datastore_name, datastore_ro_name):
-    if db_name:
-        postgres_driver.delete_base_db(admin_conn, db_name)
-    if datastore_name:
-        postgres_driver.delete_base_db(admin_conn, datastore_name)
+    # the read-only role has privileges on the datastore db, it's deleted after the dbs
+    postgres_driver.delete_base_dbs(admin_conn, [name for name in [db_name, datastore_name] if name])
     if datastore_ro_name:
         postgres_driver.delete_role(admin_conn, datastore_ro_name)
 
@@ -453,19 +486,70 @@ def _delete_dbs(admin_conn, db_name, datastore_name, datastore_ro_name):
 def _import_data(old_site_id, db_name, datastore_name, skip_datastore_import=False,
                  db_import_url=None, datastore_import_url=None,
                  import_user=None, db_prefix=None):
+    """Import the db and the datastore concurrently, yields progress events of both imports as they happen
+
+    Only direct restores run concurrently, imports done by the db provider run one after the other
+    """
     if db_import_url or datastore_import_url:
         assert db_import_url and datastore_import_url
         db_url, datastore_url = db_import_url, datastore_import_url
     else:
         db_url, datastore_url = get_db_import_urls(old_site_id)
     assert db_url and (datastore_url or skip_datastore_import), f'failed to find db import urls for old site id {old_site_id}'
-    _gcloudsql().import_db(db_url, db_name, import_user=import_user or db_name, db_prefix=db_prefix)
-    yield {'step': 'import-db-data', 'msg': f'Imported DB: {db_name}'}
+    imports = [('db', 'DB', db_url, db_name)]
     if skip_datastore_import:
         yield {'step': 'import-datastore-data', 'msg': 'skipped'}
     else:
-        _gcloudsql().import_db(datastore_url, datastore_name, import_user=import_user or datastore_name, db_prefix=db_prefix)
-        yield {'step': 'import-datastore-data', 'msg': f'Imported Datastore: {datastore_name}'}
+        imports.append(('datastore', 'Datastore', datastore_url, datastore_name))
+    events = queue.Queue()
+
+    def _import(import_type, import_label, import_url, target_db_name):
+        for event in _import_db(import_url, target_db_name, import_user or target_db_name, db_prefix):
+            events.put(dict(event, step=f'import-{import_type}-data-progress', db=target_db_name))
+        events.put({'step': f'import-{import_type}-data', 'msg': f'Imported {import_label}: {target_db_name}'})
+
+    with ThreadPoolExecutor(len(imports)) as executor:
+        futures = [executor.submit(_import, *args) for args in imports]
+        while not events.empty() or not all(future.done() for future in futures):
+            try:
+                yield events.get(timeout=1)
+            except queue.Empty:
+                pass
+        for future in futures:
+            future.result()
+
+
+def _import_db(import_url, db_name, import_user, db_prefix):
+    """Import a dump to the db, yields progress events
+
+    Plain SQL dumps in Google Storage (.sql / .gz) are imported by the db provider (e.g. Google Cloud SQL import),
+    other dumps (e.g. zstd compressed) are downloaded and restored directly,
+    custom-format dumps are restored using parallel pg_restore jobs
+    """
+    if import_url.startswith('gs://') and import_url.endswith(PROVIDER_IMPORT_DUMP_EXTENSIONS):
+        with __PROVIDER_IMPORT_LOCK:
+            yield {'msg': f'Importing {import_url} using the db provider'}
+            _gcloudsql().import_db(import_url, db_name, import_user=import_user, db_prefix=db_prefix)
+    else:
+        connection_string = db_manager.get_external_admin_connection_string(db_name, db_prefix=db_prefix)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = _download_dump(import_url, tmpdir)
+            yield {'msg': f'Restoring {import_url}', 'size-bytes': os.path.getsize(filename)}
+            yield from postgres_driver.restore(connection_string, filename, role=import_user, jobs=RESTORE_JOBS)
+
+
+def _download_dump(import_url, tmpdir):
+    if import_url.startswith('file://') or '://' not in import_url:
+        return import_url.replace('file://', '', 1)
+    filename = os.path.join(tmpdir, 'dump')
+    if import_url.startswith('gs://'):
+        subprocess.check_call(['gsutil', '-q', 'cp', import_url, filename])
+    else:
+        with requests.get(import_url, stream=True, timeout=60) as res:
+            res.raise_for_status()
+            with open(filename, 'wb') as f:
+                shutil.copyfileobj(res.raw, f, 1024 * 1024)
+    return filename
 
 
 def _gcloud():
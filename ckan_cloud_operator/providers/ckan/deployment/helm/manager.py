@@ -24,12 +24,17 @@ import subprocess
 import traceback
 import datetime
 import time
-import json
 import binascii
 import os
+import queue
+import socket
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
 
 from ckan_cloud_operator import kubectl
 from ckan_cloud_operator.drivers.kubectl import rbac as kubectl_rbac_driver
+from ckan_cloud_operator.drivers.kubectl import informer
 from ckan_cloud_operator import logs
 from ckan_cloud_operator.drivers.helm import driver as helm_driver
 from ckan_cloud_operator.config import manager as config_manager
@@ -42,6 +47,13 @@ from ckan_cloud_operator.providers.ckan.constants import INSTANCE_CRD_SINGULAR
 from ckan_cloud_operator.routers import manager as routers_manager
 
 
+LOGS_TAIL_LINES = int(os.environ.get('CKAN_CLOUD_OPERATOR_STATUS_LOGS_TAIL_LINES') or 200)
+LOGS_MAX_WORKERS = 8
+
+__POD_LOGS_CACHE = {}
+__POD_LOGS_CACHE_LOCK = threading.Lock()
+
+
 def initialize(interactive=False):
     tiller_namespace_name = _get_resource_name()
     helm_driver.init(tiller_namespace_name)
@@ -53,11 +65,7 @@ def update(instance_id, instance, force=False, dry_run=False, skip_solr=False):
                instance_id=instance_id, tiller_namespace_name=tiller_namespace_name)
     _create_private_container_registry_secret(instance_id)
     _init_ckan_infra_secret(instance_id, dry_run=dry_run)
-    ckan_helm_chart_repo = instance['spec'].get(
-        "ckanHelmChartRepo",
-        "https://raw.githubusercontent.com/ViderumGlobal/ckan-cloud-helm/master/charts_repository"
-    )
-    ckan_helm_chart_version = instance['spec'].get("ckanHelmChartVersion", "")
+    ckan_helm_chart_repo, ckan_helm_chart_version = _get_helm_chart(instance)
     ckan_helm_release_name = f'ckan-cloud-{instance_id}'
     if not skip_solr:
         solr_schema = instance['spec'].get("ckanSolrSchema", "ckan_default")
@@ -81,7 +89,7 @@ def update(instance_id, instance, force=False, dry_run=False, skip_solr=False):
         }
     _helm_deploy(
         values, tiller_namespace_name, ckan_helm_chart_repo, ckan_helm_chart_version,
-        ckan_helm_release_name, instance_id, dry_run=dry_run
+        ckan_helm_release_name, instance_id, dry_run=dry_run, skip_unchanged=not force
     )
     if not dry_run:
         _wait_instance_events(instance_id)
@@ -95,14 +103,37 @@ def update(instance_id, instance, force=False, dry_run=False, skip_solr=False):
             _scale_down_scale_up(namespace=instance_id, replicas=values.get('replicas', 1))
 
 
+def get_update_hash_data(instance_id, instance):
+    """Returns the deployment configuration which is not part of the instance spec, used to detect changes"""
+    ckan_helm_chart_repo, ckan_helm_chart_version = _get_helm_chart(instance)
+    return {
+        'chart-repo': ckan_helm_chart_repo,
+        'chart-version': ckan_helm_chart_version or helm_driver.get_latest_chart_version(ckan_helm_chart_repo,
+                                                                                         'ckan-cloud/ckan'),
+        'private-registry': config_manager.get('private-registry', secret_name='ckan-docker-registry'),
+        'docker-image-pull-secret-name': config_manager.get('docker-image-pull-secret-name',
+                                                            secret_name='ckan-docker-registry'),
+    }
+
+
+def _get_helm_chart(instance):
+    ckan_helm_chart_repo = instance['spec'].get(
+        "ckanHelmChartRepo",
+        "https://raw.githubusercontent.com/ViderumGlobal/ckan-cloud-helm/master/charts_repository"
+    )
+    ckan_helm_chart_version = instance['spec'].get("ckanHelmChartVersion", "")
+    return ckan_helm_chart_repo, ckan_helm_chart_version
+
+
 def _helm_deploy(values, tiller_namespace_name, ckan_helm_chart_repo, ckan_helm_chart_version, ckan_helm_release_name,
-                 instance_id, dry_run=False):
+                 instance_id, dry_run=False, skip_unchanged=False):
     logs.debug(f'Deploying helm chart {ckan_helm_chart_repo} {ckan_helm_chart_version} to release {ckan_helm_release_name} (instance_id={instance_id})')
     with tempfile.NamedTemporaryFile('w') as f:
         yaml.dump(values, f, default_flow_style=False)
         f.flush()
         helm_driver.deploy(tiller_namespace_name, ckan_helm_chart_repo, 'ckan-cloud/ckan', ckan_helm_chart_version,
-                           ckan_helm_release_name, f.name, instance_id, dry_run=dry_run)
+                           ckan_helm_release_name, f.name, instance_id, dry_run=dry_run,
+                           skip_unchanged=skip_unchanged)
 
 
 def delete(instance_id, instance):
@@ -120,15 +151,24 @@ def delete(instance_id, instance):
     assert len(errors) == 0, ', '.join(errors)
 
 
-def get(instance_id, instance=None):
+def get(instance_id, instance=None, resources=None, with_logs=True):
+    """Get the deployment status of an instance
+
+    :param resources: the namespace Deployment / ReplicaSet / Pod items, if not provided all the namespace resources are fetched
+    :param with_logs: fetch the container logs, without logs readiness is determined from the pod conditions
+    """
     image = None
     latest_operator_timestamp, latest_pod_name, latest_pod_status = None, None, None
     item_app_statuses = {}
     ckan_deployment_status = None
     ckan_deployment_ready = None
     ckan_deployment_status_pods = []
-    logs.debug('Getting all namespace resources', namespace=instance_id)
-    all_resources = kubectl.get('all', namespace=instance_id, required=False)
+    ckan_pods = []
+    if resources is None:
+        logs.debug('Getting all namespace resources', namespace=instance_id)
+        all_resources = kubectl.get('all', namespace=instance_id, required=False)
+    else:
+        all_resources = {'items': resources}
     num_resource_items = len(all_resources.get('items'))
     logs.debug(num_resource_items=num_resource_items)
     if num_resource_items > 0:
@@ -163,18 +203,8 @@ def get(instance_id, instance=None):
                     if not latest_operator_timestamp or latest_operator_timestamp < pod_operator_timestamp:
                         latest_operator_timestamp = pod_operator_timestamp
                         latest_pod_name = pod['metadata']['name']
-                    for container in ["secrets", "ckan"]:
-                        status_code, output = subprocess.getstatusoutput(
-                            f'kubectl -n {instance_id} logs {pod["metadata"]["name"]} -c {container}',
-                        )
-                        container_logs = output if status_code == 0 else None
-                        logs.debug(len_container_logs=len(container_logs) if container_logs else 0)
-                        if container == 'ckan':
-                            pod_status['logs'] = output
-                        if container_logs:
-                            for logline in container_logs.split("--START_CKAN_CLOUD_LOG--")[1:]:
-                                logdata = json.loads(logline.split("--END_CKAN_CLOUD_LOG--")[0])
-                                pod_status.setdefault("ckan-cloud-logs", []).append(logdata)
+                    if with_logs:
+                        ckan_pods.append((pod, pod_status))
                     if not image:
                         image = pod["spec"]["containers"][0]["image"]
                     else:
@@ -184,7 +214,11 @@ def get(instance_id, instance=None):
                     ckan_deployment_status_pods.append(pod_status)
                     if latest_pod_name == pod_status['name']:
                         latest_pod_status = pod_status
-        if not latest_pod_status or len(latest_pod_status.get('errors', [])) > 0 or latest_pod_status['logs'] is None:
+        if ckan_pods:
+            _set_pods_logs(instance_id, ckan_pods)
+        if not latest_pod_status or len(latest_pod_status.get('errors', [])) > 0:
+            ckan_deployment_ready = False
+        elif with_logs and latest_pod_status['logs'] is None:
             ckan_deployment_ready = False
     else:
         ckan_deployment_ready = False
@@ -200,7 +234,7 @@ def get(instance_id, instance=None):
             'ckan_instance_id': instance_id,
             'namespace': instance_id,
             'status_generated_at': datetime.datetime.now(),
-            'status_generated_from': subprocess.check_output(["hostname"]).decode().strip(),
+            'status_generated_from': socket.gethostname(),
         }
     }
 
@@ -266,6 +300,8 @@ def _create_private_container_registry_secret(instance_id):
     if config_manager.get('private-registry', secret_name='ckan-docker-registry') == 'y':
         docker_server, docker_username, docker_password, docker_email = ckan_manager.get_docker_credentials()
         image_pull_secret_name = config_manager.get('docker-image-pull-secret-name', secret_name='ckan-docker-registry')
+        if kubectl.get(f'secret {image_pull_secret_name}', namespace=instance_id, required=False):
+            return
         subprocess.call(f'kubectl -n {instance_id} create secret docker-registry {image_pull_secret_name} '
                               f'--docker-password={docker_password} '
                               f'--docker-server={docker_server} '
@@ -344,6 +380,11 @@ def _check_instance_events(instance_id):
                         ckan_cloud_events.add(logdata["event"])
                 if kind == "pods":
                     pod_names.append(item["name"])
+    logs.debug(ckan_cloud_events=ckan_cloud_events)
+    return _get_missing_instance_events(ckan_cloud_events), errors, ckan_cloud_logs
+
+
+def _get_missing_instance_events(ckan_cloud_events):
     expected_events = {
         ("ckan-env-vars-created", "ckan-env-vars-exists"),
         ("ckan-secrets-created", "ckan-secrets-exists"),
@@ -363,79 +404,233 @@ def _check_instance_events(instance_id):
                 break
         if not found:
             missing.add('/'.join(events))
-    logs.debug(ckan_cloud_events=ckan_cloud_events)
-    return missing, errors, ckan_cloud_logs
+    return missing
+
+
+def _set_pods_logs(instance_id, pods):
+    """Get the secrets and ckan container logs of the pods concurrently and set them in the pod statuses"""
+    tasks = [(pod, pod_status, container) for pod, pod_status in pods for container in ('secrets', 'ckan')]
+    pod_names = set(pod['metadata']['name'] for pod, _ in pods)
+    with __POD_LOGS_CACHE_LOCK:
+        for key in [key for key in __POD_LOGS_CACHE if key[0] == instance_id and key[1] not in pod_names]:
+            del __POD_LOGS_CACHE[key]
+    with ThreadPoolExecutor(max_workers=min(LOGS_MAX_WORKERS, len(tasks))) as executor:
+        results = list(executor.map(lambda task: _get_container_logs(instance_id, task[0], task[2]), tasks))
+    for (pod, pod_status, container), (container_logs, logdatas) in zip(tasks, results):
+        logs.debug(container=container, len_container_logs=len(container_logs) if container_logs else 0)
+        if container == 'ckan':
+            pod_status['logs'] = container_logs
+        if logdatas:
+            pod_status.setdefault("ckan-cloud-logs", []).extend(logdatas)
+
+
+def _get_container_logs(instance_id, pod, container):
+    """Returns the last LOGS_TAIL_LINES log lines and the ckan cloud log data of a pod container
+
+    The parsed logs are cached per pod container and restart count, subsequent calls only fetch the logs
+    since the last fetched log line, logs of terminated containers are not fetched again.
+    """
+    pod_name = pod['metadata']['name']
+    key = (instance_id, pod_name, container)
+    container_status = _get_container_status(pod, container)
+    restart_count = container_status.get('restartCount', 0)
+    with __POD_LOGS_CACHE_LOCK:
+        cached = __POD_LOGS_CACHE.get(key)
+    if not cached or cached['restart_count'] != restart_count:
+        cached = {'restart_count': restart_count, 'fetched': False, 'lines': collections.deque(maxlen=LOGS_TAIL_LINES),
+                  'ckan-cloud-logs': [], 'remaining': '', 'last_timestamp': None, 'last_timestamp_lines': 0}
+    if not cached['fetched'] or 'terminated' not in container_status.get('state', {}):
+        since_time = cached['last_timestamp'].split('.')[0] + 'Z' if cached['last_timestamp'] else None
+        output = kubectl.get_pod_logs(pod_name, container, namespace=instance_id, since_time=since_time,
+                                      timestamps=True)
+        if output is None:
+            return None, list(cached['ckan-cloud-logs'])
+        new_lines = []
+        last_timestamp, last_timestamp_lines = cached['last_timestamp'], cached['last_timestamp_lines']
+        skip_lines = last_timestamp_lines
+        for line in output.splitlines():
+            timestamp, _, text = line.partition(' ')
+            timestamp = _normalize_log_timestamp(timestamp)
+            # since_time has a resolution of seconds, skip the lines which were already fetched
+            if cached['last_timestamp'] and timestamp < cached['last_timestamp']:
+                continue
+            elif timestamp == cached['last_timestamp'] and skip_lines > 0:
+                skip_lines -= 1
+                continue
+            if timestamp == last_timestamp:
+                last_timestamp_lines += 1
+            else:
+                last_timestamp, last_timestamp_lines = timestamp, 1
+            new_lines.append(text)
+        if new_lines:
+            logdatas, cached['remaining'] = logs.parse_ckan_cloud_logs(cached['remaining'] + '\n'.join(new_lines) + '\n')
+            cached['ckan-cloud-logs'] += logdatas
+            cached['lines'].extend(new_lines)
+        cached.update(fetched=True, last_timestamp=last_timestamp, last_timestamp_lines=last_timestamp_lines)
+        with __POD_LOGS_CACHE_LOCK:
+            __POD_LOGS_CACHE[key] = cached
+    return '\n'.join(cached['lines']), list(cached['ckan-cloud-logs'])
+
+
+def _get_container_status(pod, container):
+    status = pod.get('status', {})
+    for container_status in status.get('initContainerStatuses', []) + status.get('containerStatuses', []):
+        if container_status['name'] == container:
+            return container_status
+    return {}
+
+
+def _normalize_log_timestamp(timestamp):
+    # RFC3339Nano timestamps omit trailing zeros, pad the fraction so timestamps can be compared as strings
+    seconds, _, fraction = timestamp.rstrip('Z').partition('.')
+    return f'{seconds}.{fraction.ljust(9, "0")}Z'
+
+
+class _CkanCloudLogsWatcher(object):
+    """Follows the logs of the ckan and secrets containers of the instance ckan pods
+
+    Pods are watched, a log stream is started for each new container (or container restart).
+    Ckan cloud log data is put in the events queue as soon as it's written by the container.
+    """
+
+    def __init__(self, instance_id):
+        self.instance_id = instance_id
+        self.events = queue.Queue()
+        self._streams = {}
+        self._lock = threading.Lock()
+        self._pods_informer = informer.Informer('pods', namespace=instance_id)
+
+    def start(self):
+        self._pods_informer.add_handler(lambda event_type, pod: event_type != 'DELETED' and self._on_pod(pod))
+        self.check_pods()
+        return self
+
+    def check_pods(self):
+        for pod in self._pods_informer.list({'app': 'ckan'}):
+            self._on_pod(pod)
+
+    def stop(self):
+        self._pods_informer.stop()
+        with self._lock:
+            for stream in self._streams.values():
+                stream.close()
+
+    def _on_pod(self, pod):
+        if (pod['metadata'].get('labels') or {}).get('app') != 'ckan':
+            return
+        pod_name = pod['metadata']['name']
+        status = pod.get('status', {})
+        for container_status in status.get('initContainerStatuses', []) + status.get('containerStatuses', []):
+            state = container_status.get('state', {})
+            if container_status['name'] in ('secrets', 'ckan') and ('running' in state or 'terminated' in state):
+                key = (pod_name, container_status['name'], container_status.get('restartCount', 0))
+                with self._lock:
+                    if key in self._streams:
+                        continue
+                    stream = self._streams[key] = kubectl.PodLogsStream(pod_name, container_status['name'],
+                                                                        namespace=self.instance_id)
+                threading.Thread(target=self._follow, args=(key, stream), daemon=True).start()
+
+    def _follow(self, key, stream):
+        buffer = ''
+        try:
+            for line in stream:
+                logdatas, buffer = logs.parse_ckan_cloud_logs(buffer + line + '\n')
+                for logdata in logdatas:
+                    self.events.put(dict(logdata, pod=stream.pod_name, container=stream.container))
+        except Exception:
+            logs.debug('Failed to follow container logs', pod=stream.pod_name, container=stream.container)
+            logs.debug_verbose(traceback.format_exc())
+            # will be retried on next check of the pods
+            with self._lock:
+                self._streams.pop(key, None)
+
 
 def _wait_instance_events(instance_id):
     start_time = datetime.datetime.now()
     last_message = 0
     logs.info('Waiting for instance events', start_time=start_time)
     missing_events = None
-    while True:
-        time.sleep(15)
-        currently_missing, errors, ckan_logs = _check_instance_events(instance_id)
-        if len(currently_missing) == 0:
-            logs.info('All instance events completed successfully')
-            break
-        if currently_missing != missing_events:
-            missing_events = currently_missing
-            logs.info('Still waiting for', repr(sorted(missing_events)))
-            start_time = datetime.datetime.now()
-        time_passed = (datetime.datetime.now() - start_time).total_seconds()
-        if time_passed - last_message >= 60:
-            logs.info('%d seconds since started waiting' % time_passed)
-            last_message += 60
-        if time_passed > int(os.environ.get('CCO_WAIT_TIMEOUT', 500)):
-            failed_pods = [
-                item for item in kubectl.get(f'pods -n {instance_id}').get('items', [])
-                    if not all(stat.get('ready') for stat in item['status']['containerStatuses'])
-            ]
-            logs.info('*** SOMETHING WENT WRONG!!! ***')
-            logs.info(100*'#')
-            logs.info(100*'#')
-            if not len(failed_pods):
-                logs.info('But we could not get failing containers')
-                logs.info('You may try increasing default wait timeout by setting CCO_WAIT_TIMEOUT environment variable [default: 500]')
-                ckan_pod_name = [
-                    item['metadata']['name'] for item in kubectl.get(f'pods -n {instance_id}').get('items', [])
-                        if item.get('metadata', {}).get('labels', {}).get('app') == 'ckan'
-                ][0]
-                _log_container_error('CONTAINER LOGS', ckan_pod_name, 'ckan')
-                kubectl.call(f'logs {ckan_pod_name}', namespace=instance_id)
-
-            logs.info('Number of Failed Pods: %s' % len(failed_pods))
-            for pod_meta in failed_pods:
-                init_containers = pod_meta['status'].get('initContainerStatuses')
-                pod_name = pod_meta['metadata']['name']
-                if init_containers is not None:
-                    logs.info('Checking Init Containers in %s' % pod_name)
-                    for i, init_container in enumerate(init_containers):
-                        if not init_container.get('ready'):
-                            container_name = pod_meta['spec']['initContainers'][i]['name']
-                            _log_container_error('INIT CONTAINER LOGS', pod_name, container_name)
-                            kubectl.call(f'logs {pod_name} -c {container_name}', namespace=instance_id)
-                        else:
-                            logs.info('Init Containers are fine in %s' % pod_name)
-                logs.info('Checking Containers in %s' % pod_name)
-                container_stats = pod_meta['status'].get('containerStatuses')
-                no_log_statuses = ['PodInitializing']
-                pod_status = [
-                    stat.get('state', {}).get('waiting', {}).get('reason') in no_log_statuses for stat in container_stats
-                ]
-                if all(pod_status):
-                    logs.info('Pod %s looks good describing:' % pod_name)
-                    _log_container_error('KUBECTL DESCRIBE POD', pod_name)
-                    kubectl.call(f'describe pod {pod_name}', namespace=instance_id)
+    ckan_cloud_events = set()
+    watcher = _CkanCloudLogsWatcher(instance_id).start()
+    try:
+        while True:
+            try:
+                logdata = watcher.events.get(timeout=5)
+                logs.debug(ckan_cloud_log=logdata)
+                if 'event' in logdata:
+                    ckan_cloud_events.add(logdata['event'])
+            except queue.Empty:
+                watcher.check_pods()
+            currently_missing = _get_missing_instance_events(ckan_cloud_events)
+            if len(currently_missing) == 0:
+                logs.info('All instance events completed successfully')
+                break
+            if currently_missing != missing_events:
+                missing_events = currently_missing
+                logs.info('Still waiting for', repr(sorted(missing_events)))
+                start_time = datetime.datetime.now()
+            time_passed = (datetime.datetime.now() - start_time).total_seconds()
+            if time_passed - last_message >= 60:
+                logs.info('%d seconds since started waiting' % time_passed)
+                last_message += 60
+            if time_passed > int(os.environ.get('CCO_WAIT_TIMEOUT', 500)):
+                _log_instance_events_timeout(instance_id)
+                raise Exception('timed out waiting for instance events')
+    finally:
+        watcher.stop()
+
+
+def _log_instance_events_timeout(instance_id):
+    failed_pods = [
+        item for item in kubectl.get(f'pods -n {instance_id}').get('items', [])
+            if not all(stat.get('ready') for stat in item['status']['containerStatuses'])
+    ]
+    logs.info('*** SOMETHING WENT WRONG!!! ***')
+    logs.info(100*'#')
+    logs.info(100*'#')
+    if not len(failed_pods):
+        logs.info('But we could not get failing containers')
+        logs.info('You may try increasing default wait timeout by setting CCO_WAIT_TIMEOUT environment variable [default: 500]')
+        ckan_pod_name = [
+            item['metadata']['name'] for item in kubectl.get(f'pods -n {instance_id}').get('items', [])
+                if item.get('metadata', {}).get('labels', {}).get('app') == 'ckan'
+        ][0]
+        _log_container_error('CONTAINER LOGS', ckan_pod_name, 'ckan')
+        kubectl.call(f'logs {ckan_pod_name}', namespace=instance_id)
+
+    logs.info('Number of Failed Pods: %s' % len(failed_pods))
+    for pod_meta in failed_pods:
+        init_containers = pod_meta['status'].get('initContainerStatuses')
+        pod_name = pod_meta['metadata']['name']
+        if init_containers is not None:
+            logs.info('Checking Init Containers in %s' % pod_name)
+            for i, init_container in enumerate(init_containers):
+                if not init_container.get('ready'):
+                    container_name = pod_meta['spec']['initContainers'][i]['name']
+                    _log_container_error('INIT CONTAINER LOGS', pod_name, container_name)
+                    kubectl.call(f'logs {pod_name} -c {container_name}', namespace=instance_id)
                 else:
-                    logs.info('Pod %s look did not start:' % pod_name)
-                    for i, container in enumerate(container_stats):
-                        container_name = pod_meta['spec']['containers'][i]['name']
-                        _log_container_error('CONTAINER LOGS', pod_name, container_name)
-                        kubectl.call(f'logs {pod_name}', namespace=instance_id)
-
-            logs.info(100*'#')
-            logs.info(100*'#')
-            raise Exception('timed out waiting for instance events')
+                    logs.info('Init Containers are fine in %s' % pod_name)
+        logs.info('Checking Containers in %s' % pod_name)
+        container_stats = pod_meta['status'].get('containerStatuses')
+        no_log_statuses = ['PodInitializing']
+        pod_status = [
+            stat.get('state', {}).get('waiting', {}).get('reason') in no_log_statuses for stat in container_stats
+        ]
+        if all(pod_status):
+            logs.info('Pod %s looks good describing:' % pod_name)
+            _log_container_error('KUBECTL DESCRIBE POD', pod_name)
+            kubectl.call(f'describe pod {pod_name}', namespace=instance_id)
+        else:
+            logs.info('Pod %s look did not start:' % pod_name)
+            for i, container in enumerate(container_stats):
+                container_name = pod_meta['spec']['containers'][i]['name']
+                _log_container_error('CONTAINER LOGS', pod_name, container_name)
+                kubectl.call(f'logs {pod_name}', namespace=instance_id)
+
+    logs.info(100*'#')
+    logs.info(100*'#')
 
 
 def _pre_update_hook_admin_user(instance, sub_domain, root_domain, instance_id, res, dry_run=False):
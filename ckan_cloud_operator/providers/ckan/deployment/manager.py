@@ -23,8 +23,17 @@ def delete(instance_id, instance_type, instance):
     return _get_deployment_provider(instance_type).delete(instance_id, instance)
 
 
-def get(instance_id, instance_type, instance):
-    return _get_deployment_provider(instance_type).get(instance_id, instance)
+def get(instance_id, instance_type, instance, resources=None, with_logs=True):
+    return _get_deployment_provider(instance_type).get(instance_id, instance, resources=resources, with_logs=with_logs)
+
+
+def get_update_hash_data(instance_id, instance_type, instance):
+    return _get_deployment_provider(instance_type).get_update_hash_data(instance_id, instance)
+
+
+def get_resources_snapshot():
+    """Get the instance deployment resources of all namespaces using one call per kind, returns {namespace: [items]}"""
+    return kubectl.get_all_namespaces_items(['deployment', 'replicaset', 'pod'])
 
 
 def get_backend_url(instance_id, instance_type, instance):
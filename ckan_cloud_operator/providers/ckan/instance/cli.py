@@ -64,6 +64,42 @@ def update(instance_id_or_name, override_spec_json, persist_overrides, wait_read
     logs.exit_great_success()
 
 
+@instance.command('update-all')
+@click.argument('INSTANCE_ID_OR_NAME', nargs=-1)
+@click.option('--concurrency', default=4, help='Maximum number of instances to update in parallel')
+@click.option('--rate-limit', type=float, help='Maximum number of instance updates to start per minute')
+@click.option('--journal', help='Append progress to this file, can be used with --resume')
+@click.option('--resume', is_flag=True, help='Skip instances which were successfully updated according to the journal')
+@click.option('--wait-ready', is_flag=True)
+@click.option('--skip-deployment', is_flag=True)
+@click.option('--skip-route', is_flag=True)
+@click.option('--force', is_flag=True)
+@click.option('--dry-run', is_flag=True)
+def update_all(instance_id_or_name, concurrency, rate_limit, journal, resume, wait_ready, skip_deployment, skip_route,
+               force, dry_run):
+    """Update multiple instances in parallel, defaults to all instances
+
+    A failure of an instance update does not stop the other updates, failed instances are listed at the end.
+
+    Example:
+
+    ckan-cloud-operator ckan instance update-all --concurrency 8 --rate-limit 20 --journal update-all.jsonl --resume
+    """
+    failed = []
+    for result in manager.update_all(instance_id_or_name, concurrency=concurrency, rate_limit=rate_limit,
+                                     journal_filename=journal, resume=resume, wait_ready=wait_ready,
+                                     skip_deployment=skip_deployment, skip_route=skip_route, force=force,
+                                     dry_run=dry_run):
+        logs.info('Instance update completed', **result)
+        if result['status'] != 'success':
+            failed.append(result)
+    if failed:
+        logs.print_yaml_dump(failed)
+        logs.exit_catastrophic_failure()
+    else:
+        logs.exit_great_success()
+
+
 @instance.command()
 @click.argument('INSTANCE_ID_OR_NAME')
 @click.argument('ATTR', required=False)
@@ -91,13 +127,14 @@ def edit(instance_id_or_name):
 @click.option('-q', '--quick', is_flag=True)
 @click.option('-c', '--credentials', is_flag=True)
 @click.option('--name')
-def list_instances(full, quick, name, credentials):
+@click.option('--with-logs', is_flag=True, help='Fetch the container logs of each instance, slow for many instances')
+def list_instances(full, quick, name, credentials, with_logs):
     '''
     List existing CKAN instaces
     '''
     instances = list(
         manager.list_instances(full=full, quick=quick,
-                               name=name, withCredentials=credentials)
+                               name=name, withCredentials=credentials, with_logs=with_logs)
     )
     logs.print_yaml_dump(instances)
     logs.exit_great_success(quiet=True)
@@ -151,11 +188,14 @@ def delete(instance_id_or_name, no_dry_run):
 
 @instance.command('logs')
 @click.argument('INSTANCE_ID')
-@click.option('--service', help='Service name. One of `ckan`, `giftless`, `jobs`, `jobs-db`, `redis`. Defaults to `ckan`', default='ckan')
+@click.option('--service', help='Service name. One of `ckan`, `giftless`, `jobs`, `jobs-db`, `redis`, `nginx`. Defaults to `ckan`. '
+                                'Comma-separated list to stream logs of multiple services', default='ckan')
 @click.option('--since', help='Only return logs newer than a relative duration like 5s, 2m, or 3h. Defaults to all logs.')
 @click.option('--follow', help='Specify if the logs should be streamed.')
 @click.option('--tail', help='Lines of recent log file to display. Defaults to -1 with no selector, showing all log lines otherwise 10, if a selector is provided.')
 @click.option('--container', help='Conainer name if multiple')
+@click.option('--all-containers', is_flag=True, help='Stream the logs of all the containers of the service pods')
+@click.option('--ckan-cloud-logs', is_flag=True, help='Output the ckan cloud log markers as parsed JSON')
 def ckan_logs(instance_id, **kubectl_args):
     '''
     Check CKAN and other service container logs
@@ -6,11 +6,19 @@ import os
 import traceback
 import subprocess
 import sys
+import json
+import threading
+import concurrent.futures
+import queue
+import re
+import hashlib
 
 from ckan_cloud_operator import kubectl
 from ckan_cloud_operator import logs
+from ckan_cloud_operator.annotations import manager as annotations_manager
 from ckan_cloud_operator.config import manager as config_manager
 from ckan_cloud_operator.crds import manager as crds_manager
+from ckan_cloud_operator.drivers.kubectl import informer
 from ckan_cloud_operator.labels import manager as labels_manager
 from ckan_cloud_operator.providers.cluster import manager as cluster_manager
 from ckan_cloud_operator.providers.storage.constants import CONFIG_NAME
@@ -73,13 +81,21 @@ def create(instance_type, instance_id=None, instance_name=None, values=None, val
 
 
 def update(instance_id_or_name, override_spec=None, persist_overrides=False, wait_ready=False, skip_deployment=False,
-           skip_route=False, force=False, dry_run=False, skip_solr=False):
+           skip_route=False, force=False, dry_run=False, skip_solr=False, skip_router_update=False):
     instance_id, instance_type, instance = _get_instance_id_and_type(instance_id_or_name, required=not dry_run)
     if dry_run:
         logs.info('update instance', instance_id=instance_id, instance_id_or_name=instance_id_or_name,
                   override_spec=override_spec, persist_overrides=persist_overrides, wait_ready=wait_ready,
                   skip_deployment=skip_deployment, skip_route=skip_route, force=force, dry_run=dry_run)
     else:
+        # only the args which affect the deployment are hashed, skip_router_update / force / dry_run are not
+        # included, so that a hash saved by a single instance update matches the hash in update-all and vice versa
+        update_hash_kwargs = dict(override_spec=override_spec, skip_deployment=skip_deployment, skip_route=skip_route,
+                                  skip_solr=skip_solr)
+        if not force and _is_instance_unchanged(instance_id, instance_type, instance, **update_hash_kwargs):
+            logs.info('Instance spec and configuration are unchanged and the deployment is ready, skipping update '
+                      '(use --force to update)', instance_id=instance_id)
+            return
         pre_update_hook_data = deployment_manager.pre_update_hook(instance_id, instance_type, instance, override_spec,
                                                                   skip_route)
 
@@ -111,8 +127,11 @@ def update(instance_id_or_name, override_spec=None, persist_overrides=False, wai
                 'root-domain': root_domain,
                 'sub-domain': sub_domain
             })
-            logs.info(f'updating routers_manager wait_ready: {wait_ready}')
-            routers_manager.update('instances-default', wait_ready)
+            if skip_router_update:
+                logs.info('skipping instances-default router update')
+            else:
+                logs.info(f'updating routers_manager wait_ready: {wait_ready}')
+                routers_manager.update('instances-default', wait_ready)
         else:
             logs.info('skipping route creation', skip_route=skip_route, sub_domain=pre_update_hook_data.get('sub-domain'))
         logs.info('creating ckan admin')
@@ -123,9 +142,118 @@ def update(instance_id_or_name, override_spec=None, persist_overrides=False, wai
             ckan_admin_name = pre_update_hook_data.get('ckan-admin-name', 'admin')
             res = create_ckan_admin_user(instance_id, ckan_admin_name, ckan_admin_email, ckan_admin_password)
             logs.info(**res)
+        # the pre update hook and the deployment may modify the spec, the hash is calculated from the updated instance
+        instance = crds_manager.get(INSTANCE_CRD_SINGULAR, name=instance_id)
+        annotations_manager.set_value(
+            instance, 'update-hash', _get_update_hash(instance_id, instance_type, instance, **update_hash_kwargs)
+        )
         logs.info('Instance is ready', instance_id=instance_id, instance_name=(instance_id_or_name if instance_id_or_name != instance_id else None))
 
 
+def _get_update_hash(instance_id, instance_type, instance, **kwargs):
+    """Hash of the instance spec, update arguments and the dependent configuration which affect the deployment"""
+    use_cloud_storage = config_manager.get('use-cloud-native-storage', secret_name=CONFIG_NAME)
+    data = {
+        'spec': instance['spec'],
+        'update-args': kwargs,
+        'deployment': deployment_manager.get_update_hash_data(instance_id, instance_type, instance),
+        'use-cloud-native-storage': use_cloud_storage,
+        'storage-provider-id': get_storage_provider_id() if use_cloud_storage else None,
+        'default-root-domain': routers_manager.get_default_root_domain(),
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _is_instance_unchanged(instance_id, instance_type, instance, **kwargs):
+    """Returns True if the instance was updated with the same hash and the deployment is ready"""
+    previous_hash = annotations_manager.get_value(instance, 'update-hash')
+    if not previous_hash or previous_hash != _get_update_hash(instance_id, instance_type, instance, **kwargs):
+        return False
+    status = deployment_manager.get(instance_id, instance_type, instance, with_logs=False)
+    logs.debug('instance is unchanged, checking deployment status', instance_id=instance_id, ready=status.get('ready'))
+    return bool(status.get('ready'))
+
+
+def update_all(instance_ids_or_names=None, concurrency=4, rate_limit=None, journal_filename=None, resume=False,
+               wait_ready=False, skip_deployment=False, skip_route=False, force=False, dry_run=False, skip_solr=False):
+    """Update multiple instances in parallel, yields a progress dict for each completed instance
+
+    concurrency: maximum number of instances updated at the same time
+    rate_limit: maximum number of instance updates started per minute
+    journal_filename: append progress to this file (json lines), with resume - skip instances which were updated
+    """
+    if not instance_ids_or_names:
+        instance_ids_or_names = [instance['id'] for instance in get_all_instance_id_names()]
+    if resume:
+        assert journal_filename, 'resume requires a journal file'
+        completed = _get_update_all_journal_completed(journal_filename)
+        logs.info(f'resuming, skipping {len(completed)} completed instances')
+        instance_ids_or_names = [i for i in instance_ids_or_names if i not in completed]
+    logs.info(f'updating {len(instance_ids_or_names)} instances', concurrency=concurrency, rate_limit=rate_limit)
+    # instance lookups in the workers are served from the informer caches, the watches are stopped when done
+    informers_enabled = informer.is_enabled()
+    if not informers_enabled:
+        informer.enable()
+    journal_lock = threading.Lock()
+    rate_limit_lock = threading.Lock()
+    next_start_time = [time.time()]
+
+    def _journal(**kwargs):
+        if journal_filename:
+            with journal_lock:
+                with open(journal_filename, 'a') as f:
+                    f.write(json.dumps(dict(kwargs, timestamp=datetime.datetime.now().isoformat())) + '\n')
+
+    def _update(instance_id_or_name):
+        if rate_limit:
+            with rate_limit_lock:
+                start_time = max(time.time(), next_start_time[0])
+                next_start_time[0] = start_time + 60 / rate_limit
+            time.sleep(max(0, start_time - time.time()))
+        _journal(instance=instance_id_or_name, status='started')
+        start_time = time.time()
+        try:
+            update(instance_id_or_name, wait_ready=wait_ready, skip_deployment=skip_deployment, skip_route=skip_route,
+                   force=force, dry_run=dry_run, skip_solr=skip_solr, skip_router_update=True)
+            result = {'instance': instance_id_or_name, 'status': 'success'}
+        except Exception as e:
+            logs.error(f'failed to update instance {instance_id_or_name}', exception=str(e))
+            logs.debug(traceback.format_exc())
+            result = {'instance': instance_id_or_name, 'status': 'failed', 'error': str(e)}
+        result['duration'] = round(time.time() - start_time, 2)
+        _journal(**result)
+        return result
+
+    try:
+        num_success = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in concurrent.futures.as_completed([executor.submit(_update, i) for i in instance_ids_or_names]):
+                result = future.result()
+                if result['status'] == 'success':
+                    num_success += 1
+                yield result
+        if num_success and not skip_route and not dry_run:
+            # router is updated once for all the instances instead of once per instance
+            logs.info(f'updating routers_manager wait_ready: {wait_ready}')
+            routers_manager.update('instances-default', wait_ready)
+    finally:
+        if not informers_enabled:
+            informer.enable(None)
+            informer.reset()
+
+
+def _get_update_all_journal_completed(journal_filename):
+    completed = set()
+    if os.path.exists(journal_filename):
+        with open(journal_filename) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    if entry['status'] == 'success':
+                        completed.add(entry['instance'])
+    return completed
+
+
 def delete(instance_id):
     try:
         instance_id, instance_type, instance = _get_instance_id_and_type(instance_id=instance_id)
@@ -234,13 +362,13 @@ def get_backend_url(instance_id_or_name=None, instance_id=None):
 
 
 def get_all_instance_id_names():
-    instance_names = crds_manager.get(INSTANCE_NAME_CRD_SINGULAR, required=False)
+    instance_names = crds_manager.get_cached(INSTANCE_NAME_CRD_SINGULAR, required=False)
     instance_name_ids = {}
     if instance_names:
         for instance_name in instance_names['items']:
             instance_name_ids[instance_name['spec']['latest-instance-id']] = instance_name['spec']['name']
     label_prefix = labels_manager.get_label_prefix()
-    for instance in crds_manager.get(INSTANCE_CRD_SINGULAR)['items']:
+    for instance in crds_manager.get_cached(INSTANCE_CRD_SINGULAR, required=True)['items']:
         instance_id = instance['metadata']['labels'][f'{label_prefix}/crd-ckaninstance-name']
         instance_name = instance_name_ids.pop(instance_id, None)
         yield {'id': instance_id, 'name': instance_name}
@@ -249,15 +377,21 @@ def get_all_instance_id_names():
 
 
 def get_all_instances():
-    return crds_manager.get(INSTANCE_CRD_SINGULAR)['items']
+    return crds_manager.get_cached(INSTANCE_CRD_SINGULAR, required=True)['items']
+
 
+def list_instances(full=False, quick=False, withCredentials=False, name=None, with_logs=False):
+    """List instances with their deployment status
 
-def list_instances(full=False, quick=False, withCredentials=False, name=None):
+    The deployment resources of all instances are fetched in a single snapshot, unless with_logs is set
+    which fetches the namespace resources and container logs of each instance separately.
+    """
     if quick:
         for instance in get_all_instance_id_names():
             if name is not None and instance['name'] != name: continue
             yield {**instance, 'ready': None}
     else:
+        resources_snapshot = None if with_logs else deployment_manager.get_resources_snapshot()
         for instance_data in get_all_instances():
             metadata_keys = ('name',)
             spec_keys = ('id', 'siteUrl', 'siteTitle', 'domain', 'registerSubdomain')
@@ -269,7 +403,12 @@ def list_instances(full=False, quick=False, withCredentials=False, name=None):
                 for k in metadata_keys:
                     instance_data[k] = metadata.get(k)
                 instance_type = instance_data['metadata']['labels'].get('{}/instance-type'.format(labels_manager.get_label_prefix()))
-                deployment = deployment_manager.get(instance_data['id'], instance_type, instance_data)
+                if resources_snapshot is None:
+                    deployment = deployment_manager.get(instance_data['id'], instance_type, instance_data)
+                else:
+                    deployment = deployment_manager.get(instance_data['id'], instance_type, instance_data,
+                                                        resources=resources_snapshot.get(instance_data['id'], []),
+                                                        with_logs=False)
                 instance_data['ready'] = deployment.get('ready')
             except Exception as e:
                 pass
@@ -433,13 +572,32 @@ def run_ckan_commands(instance_id_or_name, command, dry_run=False, use_paster=Fa
                     logs.info(str(line))
 
 
-def get_container_logs(instance_id, **kubectl_args):
-    service = kubectl_args.pop('service')
-    pod_name = _get_running_pod_name(instance_id, service=service)
-    stream_logs = '-f ' if kubectl_args.pop('follow', None) else ''
-    k_args = [f'--{k}={v}' for k,v in kubectl_args.items() if v is not None]
-    full_args = stream_logs + ' '.join(k_args)
-    _stream_logs(f'kubectl -n {instance_id} logs {pod_name} {full_args}')
+def get_container_logs(instance_id, service='ckan', since=None, follow=None, tail=None, container=None,
+                       all_containers=False, ckan_cloud_logs=False, output=None):
+    """Stream the logs of the instance service pods
+
+    :param service: service name or comma-separated list of service names, logs of all the running pods are streamed
+    :param all_containers: stream the logs of all the pod containers, otherwise the container param or the default
+    :param ckan_cloud_logs: output the ckan cloud log markers as parsed JSON
+    """
+    streams, prefixes = [], []
+    for service_name in service.split(','):
+        for pod in _get_running_pods(instance_id, service_name.strip()):
+            pod_name = pod['metadata']['name']
+            if all_containers:
+                container_names = [c['name'] for c in pod['spec'].get('containers', [])]
+            else:
+                container_names = [container]
+            for container_name in container_names:
+                streams.append(kubectl.PodLogsStream(
+                    pod_name, container_name, namespace=instance_id, follow=bool(follow),
+                    since_seconds=_parse_duration_seconds(since),
+                    tail_lines=int(tail) if tail is not None and int(tail) >= 0 else None
+                ))
+                prefixes.append(f'[{pod_name}/{container_name}] ' if container_name else f'[{pod_name}] ')
+    if len(streams) == 1:
+        prefixes = ['']
+    _stream_logs(streams, prefixes, ckan_cloud_logs=ckan_cloud_logs, output=output)
 
 
 def ssh_into_container(instance_id, service, command):
@@ -447,6 +605,18 @@ def ssh_into_container(instance_id, service, command):
     subprocess.run(f'kubectl -n {instance_id} exec -it {pod_name} {command}', shell=True)
 
 
+def _get_running_pods(instance_id, service='ckan'):
+    deployment = kubectl.get(f'deployment {service}', namespace=instance_id, required=False)
+    if deployment:
+        pods = kubectl.get_items_by_labels('pod', deployment['spec']['selector']['matchLabels'], required=False,
+                                           namespace=instance_id) or []
+        pods = [pod for pod in pods if pod.get('status', {}).get('phase') == 'Running']
+        if pods:
+            return pods
+    pod_name = _get_running_pod_name(instance_id, service=service)
+    return [kubectl.get(f'pod {pod_name}', namespace=instance_id, required=True)]
+
+
 def _get_running_pod_name(instance_id, service='ckan'):
     pod_name = None
     while not pod_name:
@@ -463,21 +633,21 @@ def _get_running_pod_name(instance_id, service='ckan'):
 def _get_instance_id_and_type(instance_id_or_name=None, instance_id=None, required=True):
     if instance_id:
         logs.debug(f'Getting instance type using instance_id', instance_id=instance_id)
-        instance = crds_manager.get(INSTANCE_CRD_SINGULAR, name=instance_id, required=False)
+        instance = crds_manager.get_cached(INSTANCE_CRD_SINGULAR, name=instance_id, required=False)
         instance_name = None
     else:
         logs.debug(f'Attempting to get instance type using id', instance_id_or_name=instance_id_or_name)
-        instance = crds_manager.get(INSTANCE_CRD_SINGULAR, name=instance_id_or_name, required=False)
+        instance = crds_manager.get_cached(INSTANCE_CRD_SINGULAR, name=instance_id_or_name, required=False)
         if instance:
             instance_id = instance_id_or_name
             instance_name = None
         else:
             logs.debug(f'Attempting to get instance type from instance name', instance_id_or_name=instance_id_or_name)
-            instance_name = crds_manager.get(INSTANCE_NAME_CRD_SINGULAR, name=instance_id_or_name, required=False)
+            instance_name = crds_manager.get_cached(INSTANCE_NAME_CRD_SINGULAR, name=instance_id_or_name, required=False)
             if instance_name:
                 instance_id = instance_name['spec'].get('latest-instance-id')
                 logs.debug(instance_id=instance_id)
-                instance = crds_manager.get(INSTANCE_CRD_SINGULAR, name=instance_id, required=False)
+                instance = crds_manager.get_cached(INSTANCE_CRD_SINGULAR, name=instance_id, required=False)
                 instance_name = instance_id_or_name
             else:
                 instance_name = None
@@ -496,7 +666,54 @@ def _generate_password(length):
     return binascii.hexlify(os.urandom(length)).decode()
 
 
-def _stream_logs(command):
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, shell=True)
-    for c in iter(lambda: process.stdout.read(1), b''):
-        sys.stdout.buffer.write(c)
+def _parse_duration_seconds(duration):
+    """Parse a kubectl duration (e.g. 5s, 2m, 1h30m) to seconds"""
+    if not duration:
+        return None
+    parts = re.findall(r'(\d+)([hms])', duration)
+    assert parts and ''.join(n + u for n, u in parts) == duration, f'Invalid duration: {duration}'
+    return sum(int(n) * {'h': 3600, 'm': 60, 's': 1}[u] for n, u in parts)
+
+
+def _stream_logs(streams, prefixes, ckan_cloud_logs=False, output=None, batch_size=1000):
+    """Stream the log lines of multiple log streams to the output, lines are written in batches
+
+    Each stream is read in a separate thread, lines are prefixed to identify the stream they came from.
+    """
+    output = output or sys.stdout.buffer
+    lines = queue.Queue(maxsize=batch_size * 10)
+
+    def _read(stream, prefix):
+        remaining = ''
+        try:
+            for line in stream:
+                if ckan_cloud_logs and (remaining or logs.CKAN_CLOUD_LOG_START in line):
+                    if not remaining and line.split(logs.CKAN_CLOUD_LOG_START)[0].strip():
+                        lines.put(f'{prefix}{line.split(logs.CKAN_CLOUD_LOG_START)[0]}\n')
+                    logdatas, remaining = logs.parse_ckan_cloud_logs(remaining + line + '\n')
+                    for logdata in logdatas:
+                        lines.put(f'{prefix}ckan-cloud-log: {json.dumps(logdata)}\n')
+                else:
+                    lines.put(f'{prefix}{line}\n')
+        except Exception as e:
+            lines.put(f'{prefix}failed to get logs: {e}\n')
+        finally:
+            lines.put(None)
+
+    for stream, prefix in zip(streams, prefixes):
+        threading.Thread(target=_read, args=(stream, prefix), daemon=True).start()
+    num_running = len(streams)
+    try:
+        while num_running > 0:
+            batch = [lines.get()]
+            try:
+                while len(batch) < batch_size:
+                    batch.append(lines.get_nowait())
+            except queue.Empty:
+                pass
+            num_running -= batch.count(None)
+            output.write(''.join(line for line in batch if line is not None).encode())
+            output.flush()
+    finally:
+        for stream in streams:
+            stream.close()
@@ -181,3 +181,29 @@ def create_dns_record(sub_domain, root_domain, load_balancer_ip_or_hostname):
         # Create if does not
         cmd = f'network dns record-set a add-record  -g {resource_group} -z {root_domain} -n {sub_domain} -a {load_balancer_ip_or_hostname}'
         az_check_output(cmd)
+
+
+def list_dns_a_records(root_domain):
+    """Returns {fqdn: ip} of all A records in the zone, using a single az call"""
+    resource_group = _config_get('azure-rg')
+    record_sets = json.loads(az_check_output(f'network dns record-set a list -g {resource_group} -z {root_domain} -o json'))
+    records = {}
+    for record_set in record_sets:
+        if record_set.get('aRecords'):
+            name = root_domain if record_set['name'] == '@' else f'{record_set["name"]}.{root_domain}'
+            records[name.lower()] = record_set['aRecords'][0]['ipv4Address']
+    return records
+
+
+def update_dns_a_record(sub_domain, root_domain, ip, exists=False):
+    resource_group = _config_get('azure-rg')
+    if exists:
+        az_check_output(f'network dns record-set a update -g {resource_group} -z {root_domain} -n {sub_domain} '
+                        f'--set aRecords[0].ipv4Address={ip}')
+    else:
+        az_check_output(f'network dns record-set a add-record -g {resource_group} -z {root_domain} -n {sub_domain} -a {ip}')
+
+
+def delete_dns_a_record(sub_domain, root_domain):
+    resource_group = _config_get('azure-rg')
+    az_check_output(f'network dns record-set a delete -g {resource_group} -z {root_domain} -n {sub_domain} --yes')
@@ -57,3 +57,26 @@ def get_all_dbs_users():
         'dbs': [' | '.join(map(str, db)) for db in dbs],
         'users': [' | '.join(map(str, user)) for user in users]
     }, default_flow_style=False))
+
+
+@db_group.command()
+@click.argument('DATASTORE_NAMES', nargs=-1)
+@click.option('--dry-run', is_flag=True, help='only report the missing permissions')
+def datastore_permissions(datastore_names, dry_run):
+    """Apply the missing read-only permissions of all (or the given) datastores"""
+    from ckan_cloud_operator import datastore_permissions as datastore_permissions_manager
+    datastores = [
+        datastore for datastore in datastore_permissions_manager.get_all_datastores()
+        if not datastore_names or datastore[0] in datastore_names
+    ]
+    num_errors = 0
+    for res in datastore_permissions_manager.reconcile_all(datastores, dry_run=dry_run):
+        if res.get('error'):
+            num_errors += 1
+        if res.get('error') or res.get('missing'):
+            logs.print_yaml_dump([res])
+    logs.info(f'{len(datastores)} datastores', errors=num_errors, dry_run=dry_run)
+    if num_errors:
+        logs.exit_catastrophic_failure()
+    else:
+        logs.exit_great_success()
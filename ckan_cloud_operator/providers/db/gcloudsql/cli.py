@@ -31,14 +31,29 @@ def operation_status(operation_id):
 @click.argument('CONNECTION_STRING', required=False)
 @click.option('--db-prefix')
 @click.option('--dry-run', is_flag=True)
-def create_backup(database, connection_string, db_prefix, dry_run):
-    manager.create_backup(database, connection_string, db_prefix=db_prefix, dry_run=dry_run)
+@click.option('--format', 'dump_format', type=click.Choice(['plain', 'custom']), default='plain',
+              help='custom format dumps can be restored using parallel jobs')
+@click.option('--compressor', type=click.Choice(['gzip', 'pigz', 'zstd', 'none']), default='gzip',
+              help='compressor for plain format dumps')
+def create_backup(database, connection_string, db_prefix, dry_run, dump_format, compressor):
+    manager.create_backup(database, connection_string, db_prefix=db_prefix, dry_run=dry_run,
+                          dump_format=dump_format, compressor=compressor)
     logs.exit_great_success()
 
 
 @gcloudsql_group.command()
 @click.option('--db-prefix')
 @click.option('--dry-run', is_flag=True)
-def create_all_backups(db_prefix, dry_run):
-    manager.create_all_backups(db_prefix, dry_run=dry_run)
+@click.option('--concurrency', type=int, default=4, help='number of databases to dump concurrently')
+@click.option('--format', 'dump_format', type=click.Choice(['plain', 'custom']), default='plain',
+              help='custom format dumps can be restored using parallel jobs')
+@click.option('--compressor', type=click.Choice(['gzip', 'pigz', 'zstd', 'none']), default='gzip',
+              help='compressor for plain format dumps')
+@click.option('--skip-unchanged', is_flag=True, help='skip databases with no writes since their last backup')
+@click.option('--full-backup-days', type=int, default=7,
+              help='with --skip-unchanged: backup unchanged databases if their last backup is older than this')
+def create_all_backups(db_prefix, dry_run, concurrency, dump_format, compressor, skip_unchanged, full_backup_days):
+    manager.create_all_backups(db_prefix, dry_run=dry_run, concurrency=concurrency, dump_format=dump_format,
+                               compressor=compressor, skip_unchanged=skip_unchanged,
+                               full_backup_days=full_backup_days)
     logs.exit_great_success()
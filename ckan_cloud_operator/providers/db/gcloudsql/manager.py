@@ -21,12 +21,12 @@ def _config_interactive_set(default_values, namespace=None, is_secret=False, suf
 import datetime
 import os
 import yaml
-import subprocess
 import json
 
 from ckan_cloud_operator import logs
 from ckan_cloud_operator.providers.cluster import manager as cluster_manager
 from ckan_cloud_operator.drivers.gcloud import driver as gcloud_driver
+from ckan_cloud_operator.drivers.postgres import backup as backup_driver
 
 
 def initialize(db_prefix=None, interactive=False):
@@ -99,46 +99,78 @@ def get_all_db_names(db_prefix=None):
     ]
 
 
-def create_backup(database, connection_string=None, db_prefix=None, if_not_exists=False, dry_run=False):
-    filename = f'{database}_' + datetime.datetime.now().strftime('%Y%m%d%H%M') + '.gz'
+def create_backup(database, connection_string=None, db_prefix=None, if_not_exists=False, dry_run=False,
+                  dump_format='plain', compressor='gzip'):
+    """Dump a database and stream it to the backups bucket, returns False if the backup exists (with if_not_exists)"""
+    timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M')
     gs_url = os.path.join(
-        _credentials_get(None, key='backups-gs-base-url', required=True),
-        *([db_prefix] if db_prefix else []),
-        datetime.datetime.now().strftime('%Y/%m/%d/%H'),
-        filename
+        _get_backups_base_url(db_prefix),
+        backup_driver.get_dump_filename(database, timestamp, dump_format, compressor)
     )
     if if_not_exists and gcloud_driver.call(*_gcloud().get_project_zone(), f'ls {gs_url}') == 0:
         return False
     else:
         if not connection_string:
-            from ckan_cloud_operator.providers.db import manager as db_manager
-            connection_string = db_manager.get_external_admin_connection_string(db_name=database, db_prefix=db_prefix)
-        logs.info(f'Dumping DB: {filename}')
-        if not dry_run:
-            subprocess.check_call([
-                "bash", "-o", "pipefail", "-c",
-                    f"pg_dump -d {connection_string} --format=plain --no-owner --no-acl --schema=public | "
-                    f"sed -E 's/(DROP|CREATE|COMMENT ON) EXTENSION/-- \\1 EXTENSION/g' | "
-                    f"gzip -c > {filename}",
-            ])
-            subprocess.check_call(f'ls -lah {filename}', shell=True)
-        logs.info(f'Copying to: {gs_url}')
+            connection_string = _get_backup_connection_string(database, db_prefix)
+        logs.info(f'Dumping DB: {database} -> {gs_url}')
         if not dry_run:
-            gcloud_driver.check_call(
-                *_gcloud().get_project_zone(),
-                f'-m cp ./{filename} {gs_url} && rm {filename}',
-                gsutil=True
-            )
+            res = backup_driver.dump(connection_string, gs_url, dump_format, compressor)
+            logs.info(f'Dumped DB: {database}', size=res['size'], duration_seconds=res['duration_seconds'])
         return True
 
 
-def create_all_backups(db_prefix=None, dry_run=False):
+def create_all_backups(db_prefix=None, dry_run=False, concurrency=4, dump_format='plain', compressor='gzip',
+                       skip_unchanged=False, full_backup_days=7):
+    """Dump all the databases concurrently, streaming them to the backups bucket with a manifest of the backups
+
+    :param skip_unchanged: skip databases which had no writes since their last successful backup
+    :param full_backup_days: with skip_unchanged - backup unchanged databases if the last backup is older than this
+    """
     logs.info('Fetching all database names')
-    db_names = get_all_db_names(db_prefix=db_prefix)
-    logs.info('{} DBs'.format(len(db_names)))
-    for db in db_names:
-        if db not in ['postgres'] and not db.startswith('template'):
-            assert create_backup(db, db_prefix=db_prefix, dry_run=dry_run)
+    db_names = [
+        db for db in get_all_db_names(db_prefix=db_prefix)
+        if db not in ['postgres'] and not db.startswith('template')
+    ]
+    base_url = _get_backups_base_url(db_prefix)
+    # the markers are taken before the dumps, writes which happen during the dump are backed up in the next run
+    change_markers = _get_backups_change_markers(db_prefix)
+    if skip_unchanged:
+        backups_state = get_backups_state(db_prefix)
+        skipped_db_names = [
+            db for db in db_names
+            if _is_backup_unchanged(backups_state.get(db), change_markers.get(db), full_backup_days)
+        ]
+    else:
+        skipped_db_names = []
+    logs.info('{} DBs'.format(len(db_names)), skipped=len(skipped_db_names), base_url=base_url,
+              concurrency=concurrency, dump_format=dump_format, compressor=compressor)
+    if dry_run:
+        return None
+    manifest = backup_driver.dump_all(
+        [db for db in db_names if db not in skipped_db_names], lambda db: _get_backup_connection_string(db, db_prefix),
+        base_url, concurrency=concurrency, dump_format=dump_format, compressor=compressor,
+        skipped_databases=skipped_db_names
+    )
+    successful_backups = [backup for backup in manifest['backups'] if backup['status'] == 'success']
+    if successful_backups:
+        _set_backups_state(db_prefix, {
+            backup['database']: {
+                'marker': change_markers.get(backup['database']),
+                'timestamp': datetime.datetime.now().isoformat(),
+                'url': backup['url'],
+            } for backup in successful_backups
+        })
+    failed = [backup['database'] for backup in manifest['backups'] if backup['status'] != 'success']
+    logs.info(f'Dumped {len(successful_backups)} DBs', skipped=len(skipped_db_names),
+              total_size=manifest['total_size'], duration_seconds=manifest['duration_seconds'])
+    assert not failed, f'Failed to backup DBs: {failed}'
+    return manifest
+
+
+def get_backups_state(db_prefix=None):
+    """Get the last successful backup of each db - {db_name: {'marker': .., 'timestamp': .., 'url': ..}}"""
+    values = _config_get(suffix=_get_backups_state_suffix(db_prefix), required=False) or {}
+    return {db_name: json.loads(value) for db_name, value in values.items()}
 
 
 def get_operation_status(operation_id):
@@ -159,6 +191,42 @@ def _get_config_credentials_kwargs(db_prefix):
     }
 
 
+def _get_backups_state_suffix(db_prefix):
+    return f'{db_prefix}-backups-state' if db_prefix else 'backups-state'
+
+
+def _set_backups_state(db_prefix, backups_state):
+    _config_set(values={db_name: json.dumps(state) for db_name, state in backups_state.items()},
+                suffix=_get_backups_state_suffix(db_prefix))
+
+
+def _get_backups_change_markers(db_prefix):
+    from ckan_cloud_operator.providers.db import manager as db_manager
+    from ckan_cloud_operator.drivers.postgres import driver as postgres_driver
+    with db_manager.admin_connect(db_prefix=db_prefix) as admin_conn:
+        return postgres_driver.get_dbs_change_markers(admin_conn)
+
+
+def _is_backup_unchanged(backup_state, change_marker, full_backup_days):
+    if not backup_state or not change_marker or backup_state.get('marker') != change_marker:
+        return False
+    backup_age = datetime.datetime.now() - datetime.datetime.fromisoformat(backup_state['timestamp'])
+    return backup_age < datetime.timedelta(days=full_backup_days)
+
+
+def _get_backups_base_url(db_prefix):
+    return os.path.join(
+        _credentials_get(None, key='backups-gs-base-url', required=True),
+        *([db_prefix] if db_prefix else []),
+        datetime.datetime.now().strftime('%Y/%m/%d/%H')
+    )
+
+
+def _get_backup_connection_string(database, db_prefix):
+    from ckan_cloud_operator.providers.db import manager as db_manager
+    return db_manager.get_external_admin_connection_string(db_name=database, db_prefix=db_prefix)
+
+
 def _gcloud():
     return cluster_manager.get_provider()
 
@@ -15,6 +15,9 @@ from .rds.constants import PROVIDER_ID as db_rds_provider_id
 from .minikube.constants import PROVIDER_ID as db_minikube_provider_id
 
 
+__ADMIN_CONNECTION_STRINGS = {}
+
+
 def initialize(log_kwargs=None, interactive=False, default_cluster_provider=None):
     """Initialize / upgrade the db module and sub-modules"""
     if default_cluster_provider == 'aws':
@@ -213,10 +216,22 @@ def get_provider():
     return providers_manager.get_provider(db_provider_submodule)
 
 
+def admin_connect(db_prefix=None):
+    """Get a pooled admin connection to the db server of the db prefix, usage: `with admin_connect() as admin_conn:`"""
+    if db_prefix not in __ADMIN_CONNECTION_STRINGS:
+        __ADMIN_CONNECTION_STRINGS[db_prefix] = get_external_admin_connection_string(db_prefix=db_prefix)
+    return postgres_driver.pooled_connect(__ADMIN_CONNECTION_STRINGS[db_prefix])
+
+
 def check_db_exists(db_name, db_prefix=None):
-    admin_connection_string = get_external_admin_connection_string(db_prefix=db_prefix)
-    with postgres_driver.connect(admin_connection_string) as admin_conn:
-        return len(list(postgres_driver.list_roles(admin_conn, role_name=db_name))) > 0
+    return check_dbs_exist([db_name], db_prefix=db_prefix)[db_name]
+
+
+def check_dbs_exist(db_names, db_prefix=None):
+    """Check the roles of multiple dbs exist using a single query, returns {db_name: bool}"""
+    with admin_connect(db_prefix=db_prefix) as admin_conn:
+        role_names = set(postgres_driver.list_roles(admin_conn, role_names=db_names))
+    return {db_name: db_name in role_names for db_name in db_names}
 
 
 def check_connection_string(connection_string):
@@ -64,6 +64,12 @@ def proxy_update(verify_instance_id, set_pool_mode, reload):
     logs.exit_great_success()
 
 
+@proxy.command()
+def status():
+    """Show the proxy databases, pools and stats"""
+    logs.print_yaml_dump(manager.get_status())
+
+
 @proxy.command()
 def initialize():
     manager.initialize()
@@ -19,5 +19,11 @@ def reload():
     get_provider().reload()
 
 
+def get_status():
+    provider = get_provider()
+    assert hasattr(provider, 'get_status'), 'db proxy provider does not support getting the status'
+    return provider.get_status()
+
+
 def get_provider(default=None, required=True):
     return providers_manager.get_provider(PROVIDER_SUBMODULE, default=default, required=required)
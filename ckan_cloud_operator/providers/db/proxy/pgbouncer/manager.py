@@ -23,6 +23,9 @@ import time
 import os
 import subprocess
 import traceback
+import datetime
+
+import psycopg2
 
 from distutils.util import strtobool
 
@@ -40,24 +43,104 @@ def initialize():
     _set_provider()
 
 
+__ADMIN_CONNECTION = None
+
+
 def update(wait_updated=False, set_pool_mode=None):
     if set_pool_mode:
         _config_set('pool-mode', set_pool_mode)
-    _apply_config_secret()
+    db_names = _apply_config_secret()
     if wait_updated:
-        logs.info('Waiting 1 minute for pgbouncer secret to be updated...')
-        time.sleep(60)
-        reload()
+        wait_databases(db_names)
 
 
 def reload():
-    deployment_app = _get_resource_labels(for_deployment=True)['app']
+    """Reload the pgbouncer configuration using the admin console, falls back to kubectl exec in each pod"""
     logs.info('Reloading pgbouncers...')
-    for pod_name in kubectl.check_output(
-            f'get pods -l app={deployment_app} --output=custom-columns=name:.metadata.name --no-headers'
-    ).decode().splitlines():
-        kubectl.check_call(f'exec {pod_name} -- pgbouncer -q -u pgbouncer -d -R /var/local/pgbouncer/pgbouncer.ini')
-        logs.info(f'{pod_name}: PgBouncer Reloaded')
+    try:
+        admin_command('RELOAD')
+        logs.info('PgBouncer Reloaded')
+    except psycopg2.Error:
+        logs.debug_verbose(traceback.format_exc())
+        logs.warning('Failed to reload using the pgbouncer admin console, reloading using kubectl exec')
+        for pod_name in _get_pod_names():
+            kubectl.check_call(f'exec {pod_name} -- pgbouncer -q -u pgbouncer -d -R /var/local/pgbouncer/pgbouncer.ini')
+            logs.info(f'{pod_name}: PgBouncer Reloaded')
+
+
+def wait_databases(db_names, timeout_seconds=180, poll_interval_seconds=2):
+    """Reload pgbouncer until all the given databases are live
+
+    The updated config secret takes a while to propagate to the pgbouncer volume, touching the pods
+    triggers the kubelet to sync the volume, the admin console is polled to confirm the change is live.
+    If the admin console is not reachable, waits for the secret to propagate and reloads using kubectl exec.
+    """
+    db_names = set(db_name for db_name in db_names if db_name)
+    logs.info('Waiting for pgbouncer databases to be updated...', num_databases=len(db_names))
+    _touch_pods()
+    start_time = time.time()
+    connected = False
+    while True:
+        try:
+            admin_command('RELOAD')
+            connected = True
+            missing_db_names = db_names - set(database['name'] for database in get_databases())
+        except psycopg2.Error as e:
+            if not connected:
+                logs.debug_verbose(traceback.format_exc())
+                logs.warning(f'Failed to connect to the pgbouncer admin console ({e}), '
+                             f'waiting for the secret to be updated and reloading using kubectl exec')
+                time.sleep(40)
+                reload()
+                return
+            logs.warning(f'pgbouncer admin console error: {e}')
+            missing_db_names = db_names
+        if not missing_db_names:
+            logs.info('PgBouncer databases updated', seconds=round(time.time() - start_time, 1))
+            return
+        if time.time() - start_time >= timeout_seconds:
+            logs.warning(f'Timed out waiting for pgbouncer databases: {sorted(missing_db_names)}')
+            return
+        logs.debug('Waiting for pgbouncer databases', missing_db_names=sorted(missing_db_names))
+        time.sleep(poll_interval_seconds)
+
+
+def get_databases():
+    return admin_command('SHOW DATABASES')
+
+
+def get_pools():
+    return admin_command('SHOW POOLS')
+
+
+def get_stats():
+    return admin_command('SHOW STATS')
+
+
+def get_status():
+    return {'databases': get_databases(), 'pools': get_pools(), 'stats': get_stats()}
+
+
+def admin_command(command):
+    """Run a command on the pgbouncer admin console, returns the result rows as dicts
+
+    The admin connection is kept open between calls and reconnected if it was closed.
+    """
+    global __ADMIN_CONNECTION
+    for retry in (False, True):
+        if not __ADMIN_CONNECTION or __ADMIN_CONNECTION.closed:
+            __ADMIN_CONNECTION = _get_admin_connection()
+        try:
+            with __ADMIN_CONNECTION.cursor() as cur:
+                cur.execute(command)
+                if not cur.description:
+                    return []
+                columns = [column[0] for column in cur.description]
+                return [dict(zip(columns, row)) for row in cur.fetchall()]
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            __ADMIN_CONNECTION.close()
+            if retry:
+                raise
 
 
 def get_internal_proxy_host_port():
@@ -87,6 +170,31 @@ def start_port_forward():
                           shell=True)
 
 
+def _get_admin_connection():
+    admin_user, admin_password, _ = db_manager.get_admin_db_credentials()
+    host, port = get_external_proxy_host_port()
+    if not host:
+        host, port = get_internal_proxy_host_port()
+    # the admin console does not support transactions
+    conn = psycopg2.connect(host=host, port=port, user=admin_user, password=admin_password, dbname='pgbouncer',
+                            connect_timeout=10)
+    conn.autocommit = True
+    return conn
+
+
+def _get_pod_names():
+    deployment_app = _get_resource_labels(for_deployment=True)['app']
+    return kubectl.check_output(
+        f'get pods -l app={deployment_app} --output=custom-columns=name:.metadata.name --no-headers'
+    ).decode().splitlines()
+
+
+def _touch_pods():
+    timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
+    for pod_name in _get_pod_names():
+        kubectl.call(f'annotate pod {pod_name} --overwrite ckan-cloud/config-updated={timestamp}')
+
+
 def _apply_config_secret(force=False):
     update_dbs = {}
     update_users = {}
@@ -147,6 +255,7 @@ def _apply_config_secret(force=False):
         'users.txt': "\n".join(users_txt)
     }
     _config_set(values=updated_secret, is_secret=True)
+    return list(update_dbs)
 
 
 def _apply_deployment():
@@ -0,0 +1,248 @@
+"""DNS records reconciliation for routers
+
+The existing records of each zone are fetched once and compared to the desired records,
+only the missing or changed records are created / updated, batched where the provider API allows.
+Records are deleted only if they were previously managed by the router and still point to its load balancer.
+
+The fake provider keeps the zones in memory (or in CKAN_CLOUD_OPERATOR_FAKE_DNS_FILE) and counts
+the requests a real provider would make, it is used for tests and offline benchmarks.
+"""
+import json
+import math
+import os
+import time
+
+from ckan_cloud_operator import logs
+from ckan_cloud_operator import cloudflare
+
+
+__ZONE_IDS = {}
+__FAKE_PROVIDER = None
+
+
+def get_record_type(target):
+    return 'A' if cloudflare.is_ip(target) else 'CNAME'
+
+
+def get_provider(dns_provider, cloudflare_email=None, cloudflare_auth_key=None):
+    global __FAKE_PROVIDER
+    if dns_provider == 'cloudflare':
+        return CloudflareDnsProvider(cloudflare_email, cloudflare_auth_key)
+    elif dns_provider == 'route53':
+        return Route53DnsProvider()
+    elif dns_provider == 'azure':
+        return AzureDnsProvider()
+    elif dns_provider == 'fake':
+        if not __FAKE_PROVIDER:
+            __FAKE_PROVIDER = FakeDnsProvider(os.environ.get('CKAN_CLOUD_OPERATOR_FAKE_DNS_FILE'))
+        return __FAKE_PROVIDER
+    else:
+        raise NotImplementedError(f'Unsupported DNS provider: {dns_provider}')
+
+
+def get_changes(existing_records, desired_records, managed_names=None, managed_target=None):
+    """Compare existing {name: {'type': .., 'content': ..}} records to desired {name: target} records
+
+    Managed records which are not desired are deleted if they point to the managed target.
+    Returns lists of creates and updates - (name, target) tuples and deletes - names
+    """
+    creates, updates, deletes = [], [], []
+    for name, target in sorted(desired_records.items()):
+        record = existing_records.get(name)
+        if not record:
+            creates.append((name, target))
+        elif record['content'] != target or record['type'] != get_record_type(target):
+            updates.append((name, target))
+    for name in sorted(managed_names or []):
+        record = existing_records.get(name)
+        if name not in desired_records and record and record['content'] == managed_target:
+            deletes.append(name)
+    return creates, updates, deletes
+
+
+def reconcile(dns_provider, domains, target, managed_domains=None, dry_run=False, cloudflare_email=None,
+              cloudflare_auth_key=None, provider=None):
+    """Make sure all the domains point to the target
+
+    :param domains: {root_domain: [sub_domain, ..]} of the desired records
+    :param managed_domains: domains previously managed by the caller, records which are not desired anymore are deleted
+    """
+    if dns_provider.lower() == 'none':
+        return None
+    if not provider:
+        provider = get_provider(dns_provider, cloudflare_email, cloudflare_auth_key)
+    managed_domains = managed_domains or {}
+    stats = {'created': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+    for root_domain in sorted(set(domains) | set(managed_domains)):
+        desired_records = {_get_name(sub_domain, root_domain): target for sub_domain in domains.get(root_domain, [])}
+        managed_names = [_get_name(sub_domain, root_domain) for sub_domain in managed_domains.get(root_domain, [])]
+        existing_records = provider.list_records(root_domain)
+        creates, updates, deletes = get_changes(existing_records, desired_records, managed_names, target)
+        logs.info('DNS zone changes', dns_provider=dns_provider, root_domain=root_domain, dry_run=dry_run,
+                  num_records=len(desired_records), num_creates=len(creates), num_updates=len(updates),
+                  num_deletes=len(deletes))
+        logs.debug_verbose(creates=creates, updates=updates, deletes=deletes)
+        if not dry_run and (creates or updates or deletes):
+            provider.apply_changes(root_domain, existing_records, creates, updates, deletes)
+        stats['created'] += len(creates)
+        stats['updated'] += len(updates)
+        stats['deleted'] += len(deletes)
+        stats['unchanged'] += len(desired_records) - len(creates) - len(updates)
+    return stats
+
+
+def _get_name(sub_domain, root_domain):
+    return f'{sub_domain}.{root_domain}'.lower()
+
+
+def _get_cached_zone_id(dns_provider, root_domain, get_zone_id):
+    key = (dns_provider, root_domain)
+    if not __ZONE_IDS.get(key):
+        __ZONE_IDS[key] = get_zone_id()
+        assert __ZONE_IDS[key], f'Invalid zone name: {root_domain}'
+    return __ZONE_IDS[key]
+
+
+class CloudflareDnsProvider(object):
+
+    def __init__(self, auth_email, auth_key):
+        self.auth_email = auth_email
+        self.auth_key = auth_key
+
+    def list_records(self, root_domain):
+        zone_id = self._get_zone_id(root_domain)
+        return {
+            record['name'].lower(): record
+            for record in cloudflare.list_dns_records(self.auth_email, self.auth_key, zone_id)
+            if record['type'] in ['A', 'CNAME']
+        }
+
+    def apply_changes(self, root_domain, existing_records, creates, updates, deletes):
+        cloudflare.batch_dns_records(
+            self.auth_email, self.auth_key, self._get_zone_id(root_domain),
+            posts=[self._get_record(name, target) for name, target in creates],
+            puts=[dict(self._get_record(name, target), id=existing_records[name]['id']) for name, target in updates],
+            deletes=[existing_records[name]['id'] for name in deletes]
+        )
+
+    def _get_zone_id(self, root_domain):
+        # zone ids are cached by the cloudflare module
+        zone_id = cloudflare.get_zone_id(self.auth_email, self.auth_key, root_domain)
+        assert zone_id, f'Invalid zone name: {root_domain}'
+        return zone_id
+
+    def _get_record(self, name, target):
+        return {'type': get_record_type(target), 'name': name, 'content': target, 'ttl': 120, 'proxied': False}
+
+
+class Route53DnsProvider(object):
+    # each UPSERT counts as 2 changes, the limit is 1000 changes per request
+    BATCH_SIZE = 400
+
+    def __init__(self):
+        from ckan_cloud_operator.providers.cluster.aws import manager as aws_manager
+        self._aws_manager = aws_manager
+        self._client = None
+
+    def list_records(self, root_domain):
+        records = {}
+        paginator = self._get_client().get_paginator('list_resource_record_sets')
+        for page in paginator.paginate(HostedZoneId=self._get_zone_id(root_domain)):
+            for record_set in page['ResourceRecordSets']:
+                if record_set['Type'] in ['A', 'CNAME'] and record_set.get('ResourceRecords'):
+                    records[record_set['Name'].rstrip('.').lower()] = {
+                        'type': record_set['Type'],
+                        'content': record_set['ResourceRecords'][0]['Value'],
+                        'record_set': record_set
+                    }
+        return records
+
+    def apply_changes(self, root_domain, existing_records, creates, updates, deletes):
+        changes = []
+        for name, target in creates + updates:
+            existing_record = existing_records.get(name)
+            if existing_record and existing_record['type'] != get_record_type(target):
+                changes.append({'Action': 'DELETE', 'ResourceRecordSet': existing_record['record_set']})
+            changes.append({'Action': 'UPSERT', 'ResourceRecordSet': {
+                'Name': f'{name}.',
+                'Type': get_record_type(target),
+                'TTL': 300,
+                'ResourceRecords': [{'Value': target}]
+            }})
+        for name in deletes:
+            changes.append({'Action': 'DELETE', 'ResourceRecordSet': existing_records[name]['record_set']})
+        for i in range(0, len(changes), self.BATCH_SIZE):
+            response = self._get_client().change_resource_record_sets(
+                HostedZoneId=self._get_zone_id(root_domain),
+                ChangeBatch={'Comment': 'ckan-cloud-operator', 'Changes': changes[i:i + self.BATCH_SIZE]}
+            )
+            assert response['ResponseMetadata']['HTTPStatusCode'] == 200
+
+    def _get_client(self):
+        if not self._client:
+            self._client = self._aws_manager.get_boto3_client('route53')
+        return self._client
+
+    def _get_zone_id(self, root_domain):
+        return _get_cached_zone_id('route53', root_domain,
+                                   lambda: self._aws_manager.get_dns_hosted_zone_id(root_domain))
+
+
+class AzureDnsProvider(object):
+    """Azure DNS supports only A records, the az cli does not support batching so changes are applied one by one"""
+
+    def __init__(self):
+        from ckan_cloud_operator.providers.cluster.azure import manager as azure_manager
+        self._azure_manager = azure_manager
+
+    def list_records(self, root_domain):
+        return {
+            name: {'type': 'A', 'content': ip}
+            for name, ip in self._azure_manager.list_dns_a_records(root_domain).items()
+        }
+
+    def apply_changes(self, root_domain, existing_records, creates, updates, deletes):
+        for name, target in creates + updates:
+            self._azure_manager.update_dns_a_record(self._get_sub_domain(name, root_domain), root_domain, target,
+                                                    exists=name in existing_records)
+        for name in deletes:
+            self._azure_manager.delete_dns_a_record(self._get_sub_domain(name, root_domain), root_domain)
+
+    def _get_sub_domain(self, name, root_domain):
+        return name[:-len(root_domain) - 1]
+
+
+class FakeDnsProvider(object):
+
+    def __init__(self, filename=None, latency=0, page_size=1000, batch_size=200):
+        self.filename = filename
+        self.latency = latency
+        self.page_size = page_size
+        self.batch_size = batch_size
+        self.num_requests = 0
+        if filename and os.path.exists(filename):
+            with open(filename) as f:
+                self.zones = json.load(f)
+        else:
+            self.zones = {}
+
+    def list_records(self, root_domain):
+        records = self.zones.get(root_domain, {})
+        self._request(math.ceil(len(records) / self.page_size) or 1)
+        return {name: dict(record) for name, record in records.items()}
+
+    def apply_changes(self, root_domain, existing_records, creates, updates, deletes):
+        self._request(math.ceil((len(creates) + len(updates) + len(deletes)) / self.batch_size))
+        records = self.zones.setdefault(root_domain, {})
+        for name, target in creates + updates:
+            records[name] = {'type': get_record_type(target), 'content': target}
+        for name in deletes:
+            del records[name]
+        if self.filename:
+            with open(self.filename, 'w') as f:
+                json.dump(self.zones, f)
+
+    def _request(self, num_requests):
+        self.num_requests += num_requests
+        if self.latency:
+            time.sleep(self.latency * num_requests)
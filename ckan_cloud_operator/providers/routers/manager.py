@@ -86,3 +86,17 @@ def update_dns_record(dns_provider, sub_domain, root_domain, load_balancer_ip_or
         return
     else:
         raise NotImplementedError()
+
+
+def update_dns_records(dns_provider, domains, load_balancer_ip_or_hostname, managed_domains=None,
+                       cloudflare_email=None, cloudflare_auth_key=None, dry_run=False):
+    """Reconcile the DNS records of multiple domains using a single fetch of each zone's records
+
+    :param domains: {root_domain: [sub_domain, ..]}
+    :param managed_domains: domains which were previously updated, records which are not in domains are deleted
+    """
+    from ckan_cloud_operator.providers.routers import dns
+    logs.info('updating DNS records', dns_provider=dns_provider, num_root_domains=len(domains),
+              load_balancer_ip_or_hostname=load_balancer_ip_or_hostname, dry_run=dry_run)
+    return dns.reconcile(dns_provider, domains, load_balancer_ip_or_hostname, managed_domains=managed_domains,
+                         dry_run=dry_run, cloudflare_email=cloudflare_email, cloudflare_auth_key=cloudflare_auth_key)
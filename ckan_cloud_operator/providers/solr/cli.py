@@ -75,6 +75,10 @@ def get_configs(config_name, output_dir, filename, all):
             config_names = [cn for cn in config_names if 'ckan' in cn]
     for zk_config_name in config_names:
         print(f'-- {zk_config_name}')
+        if output_dir and not filename:
+            for zk_filename in manager.zk_get_config_files(zk_config_name, output_dir):
+                print(f'/{zk_config_name}{zk_filename} --> {output_dir}/{zk_config_name}{zk_filename}')
+            continue
         if filename:
             config_files = [filename]
         else:
@@ -1,18 +1,27 @@
-import subprocess
 import json
 import os
 import glob
 import time
+import hashlib
+import shlex
+import shutil
+import tempfile
 
 from ckan_cloud_operator.config import manager as config_manager
 from ckan_cloud_operator.infra import CkanInfra
 from ckan_cloud_operator import logs
 from ckan_cloud_operator import kubectl
+from ckan_cloud_operator.drivers.solr import driver as solr_driver
 
 from .constants import PROVIDER_SUBMODULE
 from .solrcloud.constants import PROVIDER_ID as solrcloud_provider_id
 
 
+ZKCLI = '/opt/solr/server/scripts/cloud-scripts/zkcli.sh'
+ZK_DOWNLOAD_DIR = '/tmp/ckan-cloud-zk-download'
+ZK_UPLOAD_DIR = '/tmp/ckan-cloud-zk-upload'
+
+
 def initialize(interactive=False, dry_run=False):
     ckan_infra = CkanInfra(required=False)
     solr_config = config_manager.interactive_set(
@@ -130,19 +139,10 @@ def solr_curl(path, required=False, debug=False):
     if is_self_hosted():
         return get_provider().solr_curl(path, required=required, debug=debug)
     else:
-        http_endpoint = get_internal_http_endpoint()
+        output = solr_driver.curl(get_internal_http_endpoint(), path, required=required, max_retries=0)
         if debug:
-            subprocess.check_call(f'curl \'{http_endpoint}{path}\'')
-        else:
-            exitcode, output = subprocess.getstatusoutput(f'curl -s -f \'{http_endpoint}{path}\'')
-            if exitcode == 0:
-                return output
-            elif required:
-                logs.critical(output)
-                raise Exception(f'Failed to run solr curl: {http_endpoint}{path}')
-            else:
-                logs.warning(output)
-                return False
+            print(output)
+        return output
 
 def zk_set_url_scheme(scheme='http', timeout=300):
     pod_name = kubectl.get('pods', '-l', 'app=provider-solr-solrcloud-zk', required=True)['items'][0]['metadata']['name']
@@ -166,19 +166,12 @@ def zk_list_configs():
 
 
 def zk_list_config_files(config_name, config_files, base_path=''):
-    path = f'/configs/{config_name}{base_path}'
-    # print(f'path={path}')
-    pod_name = kubectl.get('pods', '-l', 'app=provider-solr-solrcloud-zk', required=True)['items'][0]['metadata']['name']
-    lines = list(kubectl.check_output(f'exec {pod_name} zkCli.sh ls {path}').decode().splitlines())[5:]
-    # print(f'lines={lines}')
-    assert len(lines) == 1
+    """Append the files of a config set to config_files, the whole config set is listed in one pass"""
+    prefix = f'{config_name}{base_path}/'
     num_files = 0
-    for name in lines[0][1:-1].split(','):
-        name = name.strip()
-        if not name: continue
-        # print(f'name={name}')
-        if zk_list_config_files(config_name, config_files, base_path=f'{base_path}/{name}') == 0:
-            config_files.append(f'{base_path}/{name}')
+    for filename in sorted(_zk_download_configs(_get_sc_pod_name(), [config_name])):
+        if filename.startswith(prefix):
+            config_files.append(filename[len(config_name):])
             num_files += 1
     return num_files
 
@@ -194,31 +187,89 @@ def zk_get_config_file(config_name, config_file, output_filename):
         f.write('\n'.join(lines))
 
 
-def zk_put_configs(configs_dir):
-    def retry_if_fails(command, max_retries=15):
-        if max_retries < 0:
-            return
-        try:
-            kubectl.check_output(command)
-        except:
-            time.sleep(5)
-            retry_if_fails(command, max_retries=max_retries-1)
+def zk_get_config_files(config_name, output_dir):
+    """Download all the files of a config set to output_dir/config_name in one pass, returns the config files"""
+    pod_name = _get_sc_pod_name()
+    config_files = [filename[len(config_name):] for filename in sorted(_zk_download_configs(pod_name, [config_name]))
+                    if filename.startswith(f'{config_name}/')]
+    if config_files:
+        os.makedirs(output_dir, exist_ok=True)
+        kubectl.check_output(f'cp {pod_name}:{ZK_DOWNLOAD_DIR}/{config_name} {output_dir}/{config_name}')
+    return config_files
 
-    pod_name = kubectl.get('pods', '-l', 'app=provider-solr-solrcloud-zk', required=True)['items'][0]['metadata']['name']
-    logs.info(f'using pod {pod_name}')
+
+def zk_put_configs(configs_dir):
+    """Sync the local config sets to ZooKeeper, only changed files are uploaded
+
+    Each sub-directory of configs_dir is a config set (/configs/<name>). The current config sets are downloaded
+    in the solr pod and compared to the local files by content hash, the changed files are copied to the pod
+    in one bundle and uploaded with a single zkcli session per config set, which creates the missing znodes.
+    """
+    configs_dir = configs_dir.rstrip('/')
+    local_hashes = {}
     for input_filename in glob.glob(f'{configs_dir}/**/*', recursive=True):
         if not os.path.isfile(input_filename): continue
-        output_filename = '/configs' + input_filename.replace(configs_dir, '')
-        logs.info(f'{input_filename} --> {output_filename}')
-        output_filepath = ''
-        for output_filepart in output_filename.split('/')[:-1]:
-            output_filepart = output_filepart.strip()
-            if not output_filepart:
-                continue
-            output_filepath += f'/{output_filepart}'
-            logs.info(f'create {output_filepath} null')
-            retry_if_fails(f'exec {pod_name} zkCli.sh create {output_filepath} null')
-        logs.info(f'copy {output_filename}')
-        retry_if_fails(f'cp {input_filename} {pod_name}:/tmp/zk_input')
-        logs.info(f'create {output_filename}')
-        retry_if_fails(f"exec {pod_name} -- /bin/bash -c '/usr/bin/zkCli.sh create {output_filename} \"$(cat /tmp/zk_input)\"'")
+        with open(input_filename, 'rb') as f:
+            local_hashes[os.path.relpath(input_filename, configs_dir)] = hashlib.sha1(f.read()).hexdigest()
+    config_names = sorted(set(filename.split('/')[0] for filename in local_hashes if '/' in filename))
+    pod_name = _get_sc_pod_name()
+    logs.info(f'using pod {pod_name}')
+    zk_hashes = _zk_download_configs(pod_name, config_names)
+    changed_filenames = sorted(filename for filename, file_hash in local_hashes.items()
+                               if zk_hashes.get(filename) != file_hash)
+    logs.info('ZooKeeper configs diff', num_files=len(local_hashes), num_changed_files=len(changed_filenames))
+    if not changed_filenames:
+        return
+    script = []
+    for filename in changed_filenames:
+        logs.info(f'{configs_dir}/{filename} --> /configs/{filename}')
+        if '/' not in filename:
+            script.append(f'{ZKCLI} -zkhost "$ZK_HOST" -cmd putfile /configs/{shlex.quote(filename)} '
+                          f'{ZK_UPLOAD_DIR}/{shlex.quote(filename)}')
+    for config_name in sorted(set(filename.split('/')[0] for filename in changed_filenames if '/' in filename)):
+        script.append(f'{ZKCLI} -zkhost "$ZK_HOST" -cmd upconfig -confname {shlex.quote(config_name)} '
+                      f'-confdir {ZK_UPLOAD_DIR}/{shlex.quote(config_name)}')
+    with tempfile.TemporaryDirectory() as upload_dir:
+        for filename in changed_filenames:
+            os.makedirs(os.path.dirname(f'{upload_dir}/{filename}'), exist_ok=True)
+            shutil.copyfile(f'{configs_dir}/{filename}', f'{upload_dir}/{filename}')
+        _retry_if_fails(lambda: [
+            _sc_exec(pod_name, f'rm -rf {ZK_UPLOAD_DIR}'),
+            kubectl.check_output(f'cp {upload_dir} {pod_name}:{ZK_UPLOAD_DIR}'),
+            _sc_exec(pod_name, ' && '.join(script))
+        ])
+
+
+def _get_sc_pod_name():
+    return kubectl.get('pods', '-l', 'app=provider-solr-solrcloud-sc', required=True)['items'][0]['metadata']['name']
+
+
+def _sc_exec(pod_name, script):
+    return kubectl.check_output(f'exec {pod_name} -- bash -c {shlex.quote(script)}').decode()
+
+
+def _zk_download_configs(pod_name, config_names):
+    """Download config sets in the solr pod, returns the sha1 hash of each file: {config_name/filename: hash}"""
+    script = [f'rm -rf {ZK_DOWNLOAD_DIR}', f'mkdir -p {ZK_DOWNLOAD_DIR}', f'cd {ZK_DOWNLOAD_DIR}']
+    for config_name in config_names:
+        # missing config sets are ignored
+        script.append(f'({ZKCLI} -zkhost "$ZK_HOST" -cmd downconfig -confname {shlex.quote(config_name)} '
+                      f'-confdir {shlex.quote(config_name)} >/dev/null 2>&1 || true)')
+    script.append('find . -type f -exec sha1sum {} +')
+    hashes = {}
+    for line in _sc_exec(pod_name, ' && '.join(script)).splitlines():
+        if line.strip():
+            file_hash, filename = line.split(None, 1)
+            hashes[filename.strip()[2:]] = file_hash
+    return hashes
+
+
+def _retry_if_fails(func, max_retries=3):
+    for retry_num in range(max_retries + 1):
+        try:
+            return func()
+        except Exception:
+            if retry_num == max_retries:
+                raise
+            logs.warning(f'ZooKeeper configs upload failed, retrying in {5 * 2 ** retry_num} seconds')
+            time.sleep(5 * 2 ** retry_num)
@@ -23,11 +23,15 @@ import yaml
 import json
 import time
 import os
+import atexit
+import queue
+import threading
 
 from ckan_cloud_operator import kubectl
 from ckan_cloud_operator import logs
 from ckan_cloud_operator.config import manager as config_manager
 from ckan_cloud_operator.providers.cluster import manager as cluster_manager
+from ckan_cloud_operator.drivers.solr import driver as solr_driver
 
 from .constants import LOG4J_PROPERTIES, SOLR_CONFIG_XML
 
@@ -55,26 +59,88 @@ def get_internal_http_endpoint():
     return f'http://{solrcloud_host_name}.{namespace}.svc.cluster.local:8983/solr'
 
 
+PORT_FORWARD_START_TIMEOUT_SECONDS = 30
+
+__PORT_FORWARD = {}
+__PORT_FORWARD_LOCK = threading.Lock()
+
+
+def get_http_base_url():
+    """Get the solr base url for requests from the operator
+
+    Inside the cluster the solrcloud service is used directly, outside of the cluster a port-forward to the service
+    is started and kept running until the operator exits. Set CKAN_CLOUD_OPERATOR_SOLR_URL to use a different url.
+    """
+    if os.environ.get('CKAN_CLOUD_OPERATOR_SOLR_URL'):
+        return os.environ['CKAN_CLOUD_OPERATOR_SOLR_URL']
+    elif os.environ.get('KUBERNETES_SERVICE_HOST'):
+        return get_internal_http_endpoint()
+    else:
+        return f'http://127.0.0.1:{_get_managed_port_forward_port()}/solr'
+
+
 def solr_curl(path, required=False, debug=False, max_retries=15):
-    deployment_name = _get_resource_name(_get_sc_suffixes()[0])
+    output = solr_driver.curl(get_http_base_url, path, required=required, max_retries=max_retries,
+                              on_retry=_check_managed_port_forward)
     if debug:
-        kubectl.check_call(f'exec deployment-pod::{deployment_name} -- curl \'localhost:8983/solr{path}\'',
-                           use_first_pod=True)
-    else:
-        exitcode, output = kubectl.getstatusoutput(f'exec deployment-pod::{deployment_name} -- curl -s -f \'localhost:8983/solr{path}\'',
-                           use_first_pod=True)
-        if exitcode == 0:
-            return output
-        elif required:
-            if max_retries > 0:
-                logs.info(f'Failed to run solr curl: localhost:8983/solr{path} - retring in 30 seconds')
-                time.sleep(30)
-                solr_curl(path, required=required, debug=debug, max_retries=max_retries-1)
-            logs.critical(output)
-            raise Exception(f'Failed to run solr curl: localhost:8983/solr{path}')
-        else:
-            logs.warning(output)
-            return False
+        print(output)
+    return output
+
+
+def _get_managed_port_forward_port():
+    with __PORT_FORWARD_LOCK:
+        process = __PORT_FORWARD.get('process')
+        if not process or process.poll() is not None:
+            namespace = cluster_manager.get_operator_namespace_name()
+            service_name = _config_get('sc-main-host-name', required=True)
+            logs.debug('Starting solr port-forward', namespace=namespace, service_name=service_name)
+            process = subprocess.Popen(['kubectl', '-n', namespace, 'port-forward', f'service/{service_name}', ':8983'],
+                                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            # Forwarding from 127.0.0.1:35219 -> 8983
+            line = _read_port_forward_output(process)
+            if not line.startswith('Forwarding from 127.0.0.1:'):
+                process.terminate()
+            assert line.startswith('Forwarding from 127.0.0.1:'), f'Failed to start solr port-forward: {line}'
+            if not __PORT_FORWARD:
+                atexit.register(_stop_managed_port_forward)
+            __PORT_FORWARD.update(process=process, port=int(line.split(' -> ')[0].split(':')[-1]))
+        return __PORT_FORWARD['port']
+
+
+def _read_port_forward_output(process, timeout_seconds=PORT_FORWARD_START_TIMEOUT_SECONDS):
+    """Returns the first output line of the port-forward, or an empty string if it didn't start in time
+
+    kubectl prints a line for every forwarded connection, the output is drained in a daemon thread,
+    otherwise kubectl blocks once the pipe buffer is full and all the requests hang
+    """
+    first_line = queue.Queue()
+
+    def _drain():
+        started = False
+        for line in iter(process.stdout.readline, b''):
+            if not started:
+                started = True
+                first_line.put(line.decode())
+        if not started:
+            first_line.put('')
+
+    threading.Thread(target=_drain, daemon=True).start()
+    try:
+        return first_line.get(timeout=timeout_seconds)
+    except queue.Empty:
+        return ''
+
+
+def _check_managed_port_forward():
+    process = __PORT_FORWARD.get('process')
+    if process and process.poll() is not None:
+        logs.info('Solr port-forward was stopped, it will be restarted')
+
+
+def _stop_managed_port_forward():
+    process = __PORT_FORWARD.get('process')
+    if process and process.poll() is None:
+        process.terminate()
 
 
 def initialize(interactive=False, dry_run=False):
@@ -36,9 +36,10 @@ def add_cli_commands(click, command_group, great_success):
     @command_group.command('update')
     @click.argument('ROUTER_NAME')
     @click.option('--wait-ready', is_flag=True)
-    def routers_update(router_name, wait_ready):
+    @click.option('--full', is_flag=True, help='Run the hooks and update DNS for all routes, not only the changed routes')
+    def routers_update(router_name, wait_ready, full):
         """Update a router to latest resource spec"""
-        routers_manager.update(router_name, wait_ready)
+        routers_manager.update(router_name, wait_ready, full=full)
         great_success()
 
     @command_group.command('list')
@@ -227,3 +228,29 @@ def add_cli_commands(click, command_group, great_success):
     @click.argument('ROOT_DOMAIN')
     def cloudflare_rate_limits(root_domain):
         logs.print_yaml_dump(routers_manager.get_cloudflare_rate_limits(root_domain))
+
+    @command_group.command('dns-benchmark')
+    @click.option('--num-records', default=5000)
+    @click.option('--num-changes', default=10)
+    @click.option('--latency', default=0.2, help='simulated latency in seconds of each DNS provider request')
+    def dns_benchmark(num_records, num_changes, latency):
+        """Benchmark DNS records reconciliation against the local fake DNS provider"""
+        import time
+        from ckan_cloud_operator.providers.routers import dns
+        provider = dns.FakeDnsProvider(latency=latency)
+        domains = {'ckan.io': [f'site{i}' for i in range(num_records)]}
+        results = {}
+        for name, sub_domains in [
+            ('initial', domains['ckan.io']),
+            ('no-changes', domains['ckan.io']),
+            ('changes', domains['ckan.io'][num_changes:] + [f'new{i}' for i in range(num_changes)]),
+        ]:
+            num_requests, start_time = provider.num_requests, time.time()
+            stats = dns.reconcile('fake', {'ckan.io': sub_domains}, '1.2.3.4', managed_domains=domains,
+                                  provider=provider)
+            domains = {'ckan.io': sub_domains}
+            results[name] = dict(stats, requests=provider.num_requests - num_requests,
+                                 seconds=round(time.time() - start_time, 3),
+                                 # zone id, record id and create / update requests for each record
+                                 per_record_requests=3 * len(sub_domains))
+        logs.print_yaml_dump(results)
@@ -3,6 +3,7 @@ import hashlib
 
 from ckan_cloud_operator import kubectl
 from ckan_cloud_operator import logs
+from ckan_cloud_operator.drivers.kubectl import informer
 from ckan_cloud_operator.routers.annotations import CkanRoutersAnnotations
 from ckan_cloud_operator.routers.traefik import manager as traefik_manager
 from ckan_cloud_operator.routers.routes import manager as routes_manager
@@ -58,16 +59,17 @@ def get_traefik_router_spec(default_root_domain=None, cloudflare_email=None, clo
     }
 
 
-def update(router_name, wait_ready=False, dry_run=False):
+def update(router_name, wait_ready=False, dry_run=False, full=False):
     router, spec, router_type, annotations, labels, router_type_config = _init_router(router_name)
     print(f'Updating CkanCloudRouter {router_name} (type={router_type}) (labels={labels})')
     routes = routes_manager.list(labels)
-    router_type_config['manager'].update(router_name, wait_ready, spec, annotations, routes, dry_run=dry_run)
+    router_type_config['manager'].update(router_name, wait_ready, spec, annotations, routes, dry_run=dry_run,
+                                         full=full)
 
 
 def list(full=False, values_only=False, async_print=True):
     res = None if async_print else []
-    for router in kubectl.get('CkanCloudRouter')['items']:
+    for router in informer.get_items_by_labels('CkanCloudRouter', None, required=True):
         if values_only:
             data = {'name': router['metadata']['name'],
                     'type': router['spec']['type']}
@@ -88,7 +90,7 @@ def list(full=False, values_only=False, async_print=True):
 def get(router_name_or_values, required=False, only_dns=False, failfast=False):
     if type(router_name_or_values) == str:
         router_name = router_name_or_values
-        router_values = kubectl.get(f'CkanCloudRouter {router_name}', required=required)
+        router_values = informer.get_item('CkanCloudRouter', router_name, required=required)
     else:
         router_name = router_name_or_values['metadata']['name']
         router_values = router_name_or_values
@@ -188,35 +190,35 @@ def delete(router_name, router_type=None):
 def get_datapusher_routes(datapusher_name, edit=False):
     labels = {'ckan-cloud/route-datapusher-name': datapusher_name}
     if edit: kubectl.edit_items_by_labels('CkanCloudRoute', labels)
-    else: return kubectl.get_items_by_labels('CkanCloudRoute', labels, required=False)
+    else: return informer.get_items_by_labels('CkanCloudRoute', labels)
 
 
 def get_backend_url_routes(target_resorce_id, edit=False):
     labels = {'ckan-cloud/route-target-resource-id': target_resorce_id}
     if edit: kubectl.edit_items_by_labels('CkanCloudRoute', labels)
-    else: return kubectl.get_items_by_labels('CkanCloudRoute', labels, required=False)
+    else: return informer.get_items_by_labels('CkanCloudRoute', labels)
 
 
 def get_deis_instance_routes(deis_instance_id, edit=False):
     labels = {'ckan-cloud/route-deis-instance-id': deis_instance_id}
     if edit: kubectl.edit_items_by_labels('CkanCloudRoute', labels)
-    else: return kubectl.get_items_by_labels('CkanCloudRoute', labels, required=False)
+    else: return informer.get_items_by_labels('CkanCloudRoute', labels)
 
 
 def get_ckan_instance_routes(ckan_instance_id, edit=False):
     labels = {'ckan-cloud/route-ckan-instance-id': ckan_instance_id}
     if edit: kubectl.edit_items_by_labels('CkanCloudRoute', labels)
-    else: return kubectl.get_items_by_labels('CkanCloudRoute', labels, required=False)
+    else: return informer.get_items_by_labels('CkanCloudRoute', labels)
 
 
 def get_app_instance_routes(app_instance_id, edit=False):
     labels = {'ckan-cloud/route-app-instance-id': app_instance_id}
     if edit: kubectl.edit_items_by_labels('CkanCloudRoute', labels)
-    else: return kubectl.get_items_by_labels('CkanCloudRoute', labels, required=False)
+    else: return informer.get_items_by_labels('CkanCloudRoute', labels)
 
 
 def get_all_routes():
-    return kubectl.get('CkanCloudRoute')['items']
+    return informer.get_items_by_labels('CkanCloudRoute', None, required=True)
 
 
 def get_domain_routes(root_domain=None, sub_domain=None):
@@ -226,7 +228,7 @@ def get_domain_routes(root_domain=None, sub_domain=None):
     labels = {'ckan-cloud/route-root-domain': root_domain}
     if sub_domain:
         labels['ckan-cloud/route-sub-domain']: sub_domain
-    return kubectl.get_items_by_labels('CkanCloudRoute', labels, required=False)
+    return informer.get_items_by_labels('CkanCloudRoute', labels)
 
 
 # delete_routes mtehod is dangerous - better to delete manually via kubectl
@@ -281,7 +283,7 @@ def _get_labels(router_name, router_type):
 
 
 def _init_router(router_name, router_values=None, required=False):
-    router = kubectl.get(f'CkanCloudRouter {router_name}', required=required) if not router_values else router_values
+    router = informer.get_item('CkanCloudRouter', router_name, required=required) if not router_values else router_values
     if router:
         spec = router['spec']
         router_type = spec['type']
@@ -5,6 +5,7 @@ from ckan_cloud_operator.routers.routes import datapusher_subdomain
 from ckan_cloud_operator.routers.routes import backend_url_subdomain
 from ckan_cloud_operator import kubectl
 from ckan_cloud_operator import logs
+from ckan_cloud_operator.drivers.kubectl import informer
 
 
 def get_module(route):
@@ -25,7 +26,7 @@ def get_module(route):
 
 
 def list(router_labels):
-    routes = kubectl.get_items_by_labels('CkanCloudRoute', router_labels, required=False)
+    routes = informer.get_items_by_labels('CkanCloudRoute', router_labels)
     logs.debug_verbose(router_labels=router_labels, routes=routes)
     _routes = []
     if routes:
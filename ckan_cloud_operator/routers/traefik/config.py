@@ -18,6 +18,12 @@ def _get_base_config(**kwargs):
         'ping': {
             'entryPoint': 'http'
         },
+        # on shutdown keep accepting requests while the pod is removed from the load balancer,
+        # /ping returns 503 during this time so the pod is marked as not ready
+        'lifeCycle': {
+            'requestAcceptGraceTimeout': '10s',
+            'graceTimeOut': '10s'
+        },
         'file': {},
         'frontends': {},
         'backends': {},
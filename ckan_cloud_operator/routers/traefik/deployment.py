@@ -13,7 +13,8 @@ from ckan_cloud_operator.labels import manager as labels_manager
 from ckan_cloud_operator.config import manager as config_manager
 
 
-def _get_deployment_spec(router_name, router_type, annotations, image=None, httpauth_secrets=None, dns_provider=None):
+def _get_deployment_spec(router_name, router_type, annotations, image=None, httpauth_secrets=None, dns_provider=None,
+                         replicas=1):
     volume_spec = cluster_manager.get_or_create_multi_user_volume_claim(get_label_suffixes(router_name, router_type))
     httpauth_secrets_volume_mounts, httpauth_secrets_volumes = [], []
     if httpauth_secrets:
@@ -34,8 +35,13 @@ def _get_deployment_spec(router_name, router_type, annotations, image=None, http
         default=None
     )
     deployment_spec = {
-        'replicas': 1,
+        'replicas': replicas,
         'revisionHistoryLimit': 5,
+        # new pods must pass the /ping readiness check before old pods are terminated
+        'strategy': {
+            'type': 'RollingUpdate',
+            'rollingUpdate': {'maxUnavailable': 0, 'maxSurge': 1}
+        },
         'selector': {
             'matchLabels': get_labels(router_name, router_type, for_deployment=True)
         },
@@ -44,6 +50,8 @@ def _get_deployment_spec(router_name, router_type, annotations, image=None, http
                 'labels': get_labels(router_name, router_type, for_deployment=True)
             },
             'spec': {
+                # terminating pods keep serving during the traefik lifeCycle grace timeouts
+                'terminationGracePeriodSeconds': 60,
                 'containers': [
                     {
                         'name': 'traefik',
@@ -55,6 +63,11 @@ def _get_deployment_spec(router_name, router_type, annotations, image=None, http
                             *httpauth_secrets_volume_mounts,
                         ],
                         'args': ['--configFile=/etc-traefik/traefik.toml'],
+                        'readinessProbe': {
+                            'httpGet': {'path': '/ping', 'port': 80},
+                            'periodSeconds': 2,
+                            'failureThreshold': 2,
+                        },
                         **(json.loads(container_spec_overrides) if container_spec_overrides else {})
                     }
                 ],
@@ -112,7 +125,61 @@ def _get_resource_name(router_name):
     return f'router-traefik-{router_name}'
 
 
-def _update(router_name, spec, annotations, routes):
+def _get_route_hashes(routes, config):
+    """Hash of each route spec together with its generated traefik frontend / backend"""
+    hashes = {}
+    for route in routes:
+        route_name = routes_manager.get_name(route)
+        hashes[route_name] = hashlib.sha256(json.dumps({
+            'spec': route['spec'],
+            'frontend': config['frontends'].get(route_name),
+            'backend': config['backends'].get(route_name),
+        }, sort_keys=True).encode()).hexdigest()
+    return hashes
+
+
+def _get_router_hash(spec, cloudflare_email, load_balancer_ip):
+    """Hash of the router settings which affect all the routes"""
+    return hashlib.sha256(json.dumps({
+        'spec': spec,
+        'cloudflare-email': cloudflare_email,
+        'load-balancer-ip': load_balancer_ip,
+    }, sort_keys=True).encode()).hexdigest()
+
+
+def _get_replicas(router_name, spec, config):
+    """Returns the number of traefik replicas, set using the router spec 'replicas' attribute (defaults to 1)
+
+    Traefik 1.x doesn't support ACME file storage with multiple instances (each instance would issue / renew
+    the certificates and overwrite the shared acme.json), so multiple replicas are used only without ACME
+    """
+    replicas = int(spec.get('replicas') or 1)
+    if replicas > 1 and 'acme' in config:
+        logs.warning(f'router {router_name}: multiple replicas are not supported with ACME file storage, '
+                     f'using 1 replica instead of {replicas}')
+        replicas = 1
+    return replicas
+
+
+def _get_changed_routes(old_hashes, new_hashes):
+    added = [name for name in new_hashes if name not in old_hashes]
+    changed = [name for name in new_hashes if name in old_hashes and old_hashes[name] != new_hashes[name]]
+    removed = [name for name in old_hashes if name not in new_hashes]
+    return added, changed, removed
+
+
+def _get_deployed_hashes(resource_name):
+    """Returns the router hash, route hashes and DNS domains which were saved with the deployed config"""
+    configmap = kubectl.get(f'configmap {resource_name}', required=False)
+    annotations = (configmap or {}).get('metadata', {}).get('annotations') or {}
+    return (
+        annotations.get('ckan-cloud/router-hash'),
+        json.loads(annotations.get('ckan-cloud/route-hashes') or '{}'),
+        json.loads(annotations.get('ckan-cloud/dns-domains') or '{}'),
+    )
+
+
+def _update(router_name, spec, annotations, routes, full=False):
     dns_provider = spec.get('dns-provider', 'cloudflare')
     if dns_provider == 'none':
         logs.info('No DNS provider, not setting up ingress')
@@ -123,26 +190,22 @@ def _update(router_name, spec, annotations, routes):
     external_domains = spec.get('external-domains')
     logs.info('updating traefik deployment', resource_name=resource_name, router_type=router_type,
               cloudflare_email=cloudflare_email, cloudflare_auth_key_len=len(cloudflare_auth_key) if cloudflare_auth_key else 0,
-              external_domains=external_domains, dns_provider=dns_provider)
-    kubectl.apply(kubectl.get_configmap(
-        resource_name, get_labels(router_name, router_type),
-        {'traefik.toml': toml.dumps(traefik_router_config.get(
-            routes, cloudflare_email,
-            enable_access_log=bool(spec.get('enable-access-log')),
-            wildcard_ssl_domain=spec.get('wildcard-ssl-domain'),
-            external_domains=external_domains,
-            dns_provider=dns_provider,
-            force=True
-        ))}
+              external_domains=external_domains, dns_provider=dns_provider, full=full)
+    config = traefik_router_config.get(
+        routes, cloudflare_email,
+        enable_access_log=bool(spec.get('enable-access-log')),
+        wildcard_ssl_domain=spec.get('wildcard-ssl-domain'),
+        external_domains=external_domains,
+        dns_provider=dns_provider,
+        force=True
+    )
+    # frontends / backends are in a watched rules file which traefik hot-reloads when the configmap is updated,
+    # other changes to traefik.toml require a rolling update of the pods
+    rules_toml = toml.dumps({'frontends': config['frontends'], 'backends': config['backends']})
+    config_toml = toml.dumps(dict(
+        {k: v for k, v in config.items() if k not in ['frontends', 'backends']},
+        file={'filename': '/etc-traefik/rules.toml', 'watch': True}
     ))
-    domains = {}
-    httpauth_secrets = []
-    for route in routes:
-        root_domain, sub_domain = routes_manager.get_domain_parts(route)
-        domains.setdefault(root_domain, []).append(sub_domain)
-        routes_manager.pre_deployment_hook(route, get_labels(router_name, router_type))
-        if route['spec'].get('httpauth-secret') and route['spec']['httpauth-secret'] not in httpauth_secrets:
-            httpauth_secrets.append(route['spec']['httpauth-secret'])
     load_balancer = kubectl.get_resource(
         'v1', 'Service', f'loadbalancer-{resource_name}',
         get_labels(router_name, router_type)
@@ -160,33 +223,65 @@ def _update(router_name, spec, annotations, routes):
     kubectl.apply(load_balancer)
     load_balancer_ip = get_load_balancer_ip(router_name)
     logs.info(f'load balancer ip: {load_balancer_ip}')
+    # only routes which changed since the last deployed config require hooks / DNS updates,
+    # changes in router settings or load balancer ip require a full update of all the routes
+    router_hash = _get_router_hash(spec, cloudflare_email, load_balancer_ip)
+    route_hashes = _get_route_hashes(routes, config)
+    deployed_router_hash, deployed_route_hashes, deployed_dns_domains = _get_deployed_hashes(resource_name)
+    if full or deployed_router_hash != router_hash:
+        deployed_route_hashes = {}
+    added, changed, removed = _get_changed_routes(deployed_route_hashes, route_hashes)
+    logs.info('traefik routes diff', num_routes=len(routes), num_added=len(added), num_changed=len(changed),
+              num_removed=len(removed), full=not deployed_route_hashes)
+    logs.debug_verbose(added=added, changed=changed, removed=removed)
+    domains = {}
+    httpauth_secrets = []
+    for route in routes:
+        if route['spec'].get('httpauth-secret') and route['spec']['httpauth-secret'] not in httpauth_secrets:
+            httpauth_secrets.append(route['spec']['httpauth-secret'])
+        root_domain, sub_domain = routes_manager.get_domain_parts(route)
+        domains.setdefault(root_domain, []).append(sub_domain)
+        if routes_manager.get_name(route) in added + changed:
+            routes_manager.pre_deployment_hook(route, get_labels(router_name, router_type))
     from ckan_cloud_operator.providers.routers import manager as routers_manager
     if external_domains:
-        from ckan_cloud_operator.providers.routers import manager as routers_manager
         external_domains_router_root_domain = routers_manager.get_default_root_domain()
         env_id = routers_manager.get_env_id()
         assert router_name.startswith('prod-'), f'invalid external domains router name: {router_name}'
         external_domains_router_sub_domain = f'cc-{env_id}-{router_name}'
-        routers_manager.update_dns_record(
-            dns_provider, external_domains_router_sub_domain, external_domains_router_root_domain,
-            load_balancer_ip, cloudflare_email, cloudflare_auth_key
-        )
+        dns_domains = {external_domains_router_root_domain: [external_domains_router_sub_domain]}
     else:
-        for root_domain, sub_domains in domains.items():
-            for sub_domain in sub_domains:
-                routers_manager.update_dns_record(
-                    dns_provider, sub_domain, root_domain,
-                    load_balancer_ip, cloudflare_email, cloudflare_auth_key
-                )
-    kubectl.apply(kubectl.get_deployment(
+        dns_domains = {root_domain: sorted(set(sub_domains)) for root_domain, sub_domains in domains.items()}
+    if added or changed or removed or dns_domains != deployed_dns_domains:
+        # the zones are fetched once and compared to all the router domains, which also fixes manual changes
+        routers_manager.update_dns_records(
+            dns_provider, dns_domains, load_balancer_ip, managed_domains=deployed_dns_domains,
+            cloudflare_email=cloudflare_email, cloudflare_auth_key=cloudflare_auth_key
+        )
+    # the hashes are saved with the config, so routes which failed the hooks / DNS update are retried next time
+    configmap = kubectl.get_configmap(resource_name, get_labels(router_name, router_type),
+                                      {'traefik.toml': config_toml, 'rules.toml': rules_toml})
+    configmap['metadata'].setdefault('annotations', {}).update(**{
+        'ckan-cloud/router-hash': router_hash,
+        'ckan-cloud/route-hashes': json.dumps(route_hashes, sort_keys=True),
+        'ckan-cloud/dns-domains': json.dumps(dns_domains, sort_keys=True),
+    })
+    kubectl.apply(configmap)
+    # the config hash annotation triggers a rolling update of the pods only when traefik.toml changed
+    deployment = kubectl.get_deployment(
         resource_name, get_labels(router_name, router_type, for_deployment=True),
         _get_deployment_spec(
             router_name, router_type, annotations,
             image=('traefik:1.7' if (external_domains or len(httpauth_secrets) > 0) else None),
             httpauth_secrets=httpauth_secrets,
-            dns_provider=dns_provider
-        )
-    ))
+            dns_provider=dns_provider,
+            replicas=_get_replicas(router_name, spec, config)
+        ),
+        with_timestamp=False
+    )
+    deployment['spec']['template']['metadata'].setdefault('annotations', {})['ckan-cloud/traefik-config-hash'] = \
+        hashlib.sha256(config_toml.encode()).hexdigest()
+    kubectl.apply(deployment)
 
 
 def get_load_balancer_ip(router_name, failfast=False):
@@ -222,10 +317,10 @@ def get_cloudflare_credentials():
     return cloudflare_email, cloudflare_auth_key
 
 
-def update(router_name, wait_ready, spec, annotations, routes, dry_run=False):
+def update(router_name, wait_ready, spec, annotations, routes, dry_run=False, full=False):
     old_deployment = kubectl.get(f'deployment router-traefik-{router_name}', required=False)
     old_generation = old_deployment.get('metadata', {}).get('generation') if old_deployment else None
-    expected_new_generation = old_generation + 3 if old_generation else None
+    expected_new_generation = old_generation + 1 if old_generation else None
     if expected_new_generation:
         print(f'old deployment generation: {old_generation}')
     else:
@@ -233,27 +328,21 @@ def update(router_name, wait_ready, spec, annotations, routes, dry_run=False):
     if not dry_run:
         annotations.update_status(
             'router', 'created',
-            lambda: _update(router_name, spec, annotations, routes),
+            lambda: _update(router_name, spec, annotations, routes, full=full),
             force_update=True
         )
         if expected_new_generation:
-            _scale_down_scale_up(f'router-traefik-{router_name}')
-            while True:
-                time.sleep(.2)
-                new_deployment = kubectl.get(f'deployment router-traefik-{router_name}', required=False)
-                if not new_deployment: continue
-                new_generation = new_deployment.get('metadata', {}).get('generation')
-                if not new_generation: continue
-                if new_generation == old_generation: continue
-                if new_generation != expected_new_generation:
-                    raise Exception(f'Invalid generation: {new_generation} (expected: {expected_new_generation})')
+            new_deployment = kubectl.get(f'deployment router-traefik-{router_name}', required=False)
+            new_generation = (new_deployment or {}).get('metadata', {}).get('generation')
+            if new_generation == old_generation:
+                print('deployment was not changed, route changes are hot-reloaded by traefik')
+            elif new_generation != expected_new_generation:
+                raise Exception(f'Invalid generation: {new_generation} (expected: {expected_new_generation})')
+            else:
                 print(f'new deployment generation: {new_generation}')
-                break
         if wait_ready:
-            print('Waiting for instance to be ready...')
-            while time.sleep(2):
-                if get(router_name)['ready']: break
-                print('.')
+            print('Waiting for rolling update to complete...')
+            kubectl.wait_deployment_rollout(f'router-traefik-{router_name}')
 
 
 def get(router_name):
@@ -295,7 +384,3 @@ def get_labels(router_name, router_type, for_deployment=False):
         get_label_suffixes(router_name, router_type),
         extra_labels=extra_labels
     )
-
-def _scale_down_scale_up(deployment='router-traefik-instances-default', replicas=1):
-    kubectl.call(f'scale deployment {deployment} --replicas=0')
-    kubectl.call(f'scale deployment {deployment} --replicas={replicas}')
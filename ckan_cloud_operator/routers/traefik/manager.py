@@ -80,10 +80,10 @@ def get(router_name, attr='deployment', router=None, failfast=False):
         return {'deployment': deployment_data(), 'dns': dns_data()}
 
 
-def update(router_name, wait_ready, spec, annotations, routes, dry_run=False):
+def update(router_name, wait_ready, spec, annotations, routes, dry_run=False, full=False):
     logs.debug(f'updating traefik router: {router_name}')
     logs.debug_verbose(router_name=router_name, spec=spec, routes=routes)
-    return traefik_deployment.update(router_name, wait_ready, spec, annotations, routes, dry_run=dry_run)
+    return traefik_deployment.update(router_name, wait_ready, spec, annotations, routes, dry_run=dry_run, full=full)
 
 
 def _init_router(router_name):
@@ -52,24 +52,11 @@ if not old_db_url and not old_datastore_url:
         datepath = os.environ['IMPORT_DATE_PATH']
     else:
         datepath = datetime.datetime.now().strftime('%Y/%m/%d')
-    if os.environ.get('IMPORT_HOUR'):
-        hours = [int(os.environ['IMPORT_HOUR'])]
-    else:
-        hours = reversed(range(25))
-    for hour in hours:
-        print(f'looking for backups in ({dbprefixpath}/{datepath}/{hour:02d})', file=sys.__stderr__)
-        try:
-            old_db_url = subprocess.check_output(
-                f'gsutil ls "{gs_base_url}{dbprefixpath}/{datepath}/{hour:02d}/{old_db_name}_"' + "'*'", shell=True)
-            old_datastore_url = subprocess.check_output(
-                f'gsutil ls "{gs_base_url}{dbprefixpath}/{datepath}/{hour:02d}/{old_datastore_name}_"' + "'*'",
-                shell=True)
-        except Exception:
-            continue
-        if old_db_url and old_datastore_url:
-            break
-    old_db_url = old_db_url.decode().strip()
-    old_datastore_url = old_datastore_url.decode().strip()
+    hour = int(os.environ['IMPORT_HOUR']) if os.environ.get('IMPORT_HOUR') else None
+    backup_urls = ckan_db_migration.get_latest_backup_urls(f'{gs_base_url}{dbprefixpath}',
+                                                           [old_db_name, old_datastore_name], datepath, hour=hour)
+    if backup_urls:
+        old_db_url, old_datastore_url = backup_urls
 
 logs.info(old_db_url=old_db_url, old_datastore_url=old_datastore_url)
 
@@ -0,0 +1,90 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from ckan_cloud_operator.config import manager
+
+
+@patch('ckan_cloud_operator.providers.cluster.manager.get_operator_namespace_name', new=lambda: 'ckan-cloud')
+@patch('ckan_cloud_operator.providers.cluster.manager.get_operator_configmap_name', new=lambda: 'ckan-cloud-operator-config')
+class ConfigManagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        manager.clear_cache()
+
+    def tearDown(self):
+        manager.clear_cache()
+
+    @patch('ckan_cloud_operator.kubectl.get')
+    def test_get_cached_with_ttl(self, get):
+        get.return_value = {'data': {'foo': 'bar', 'label-prefix': 'ckan-cloud'}}
+        self.assertEqual(manager.get('foo', configmap_name='test'), 'bar')
+        self.assertEqual(manager.get('label-prefix', configmap_name='test'), 'ckan-cloud')
+        self.assertEqual(get.call_count, 1)
+        get.assert_called_once_with('configmap test', required=False, namespace='ckan-cloud')
+        with patch('time.time', return_value=manager.time.time() + manager.CACHE_TTL_SECONDS + 1):
+            # static keys have a longer TTL
+            self.assertEqual(manager.get('label-prefix', configmap_name='test'), 'ckan-cloud')
+            self.assertEqual(get.call_count, 1)
+            self.assertEqual(manager.get('foo', configmap_name='test'), 'bar')
+            self.assertEqual(get.call_count, 2)
+        self.assertEqual(manager.get('foo', configmap_name='test', ttl=0), 'bar')
+        self.assertEqual(get.call_count, 3)
+
+    @patch('ckan_cloud_operator.kubectl.check_call')
+    @patch('ckan_cloud_operator.kubectl.get')
+    def test_delete_invalidates(self, get, check_call):
+        get.return_value = {'data': {'foo': 'bar'}}
+        self.assertEqual(manager.get('foo', configmap_name='test'), 'bar')
+        manager.delete(configmap_name='test')
+        check_call.assert_called_once_with('delete configmap test')
+        get.return_value = None
+        self.assertEqual(manager.get('foo', configmap_name='test'), None)
+        self.assertEqual(get.call_count, 2)
+
+    @patch('ckan_cloud_operator.labels.manager.get_label_prefix', new=lambda: 'ckan-cloud')
+    @patch('ckan_cloud_operator.kubectl.get')
+    @patch('ckan_cloud_operator.kubectl.get_items_by_labels')
+    def test_prefetch(self, get_items_by_labels, get):
+        get_items_by_labels.side_effect = lambda kind, labels, **kwargs: {
+            'configmap': [{'metadata': {'name': 'test'}, 'data': {'foo': 'bar'}}],
+            'secret': [{'metadata': {'name': 'test-secret'}, 'data': {'password': 'MTIz'}}],
+        }[kind]
+        with patch.dict(os.environ, {'CKAN_CLOUD_OPERATOR_CONFIG_PREFETCH': 'true'}):
+            self.assertEqual(manager.get('foo', configmap_name='test'), 'bar')
+            self.assertEqual(manager.get('password', secret_name='test-secret'), '123')
+        self.assertEqual(get_items_by_labels.call_count, 2)
+        self.assertEqual(get_items_by_labels.call_args[0][1], {'ckan-cloud/operator-config-namespace': 'ckan-cloud'})
+        get.assert_not_called()
+
+    @patch('ckan_cloud_operator.kubectl.get')
+    def test_snapshot(self, get):
+        get.return_value = {'data': {'foo': 'bar'}}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'snapshot.json')
+            with patch.dict(os.environ, {'CKAN_CLOUD_OPERATOR_CONFIG_SNAPSHOT': filename}):
+                self.assertEqual(manager.get('foo', configmap_name='test'), 'bar')
+                # the snapshot is written when the process exits
+                self.assertFalse(os.path.exists(filename))
+                manager._save_snapshot()
+                with open(filename) as f:
+                    snapshot = json.load(f)
+                self.assertEqual(snapshot['configs']['configmap:ckan-cloud:test']['values'], {'foo': 'bar'})
+                # simulate a new process
+                with patch.object(manager, '_fetch') as _fetch:
+                    manager.__dict__['__CACHED_VALUES'].clear()
+                    manager.__dict__['__SNAPSHOT_LOADED'] = False
+                    self.assertEqual(manager.get('foo', configmap_name='test'), 'bar')
+                    _fetch.assert_not_called()
+
+    @patch('ckan_cloud_operator.drivers.kubectl.informer.get_item')
+    @patch('ckan_cloud_operator.kubectl.get')
+    def test_informers_only_for_operator_namespace(self, get, get_item):
+        get.return_value = {'data': {'foo': 'bar'}}
+        get_item.return_value = {'data': {'foo': 'baz'}}
+        self.assertEqual(manager.get('foo', configmap_name='test', namespace='instance1'), 'bar')
+        get_item.assert_not_called()
+        self.assertEqual(manager.get('foo', configmap_name='test'), 'baz')
+        get_item.assert_called_once_with('configmap', 'test', namespace='ckan-cloud')
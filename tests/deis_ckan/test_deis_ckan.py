@@ -3,7 +3,8 @@ from unittest.mock import patch, Mock, MagicMock, call
 
 from ckan_cloud_operator.deis_ckan.ckan import DeisCkanInstanceCKAN
 from ckan_cloud_operator.deis_ckan.instance import DeisCkanInstance
-from ckan_cloud_operator.deis_ckan.db import DeisCkanInstanceDb, postgres_driver, db_manager, DATASTORE_PERMISSIONS_SQL_TEMPLATE
+from ckan_cloud_operator.deis_ckan.db import DeisCkanInstanceDb, postgres_driver, db_manager
+from ckan_cloud_operator.datastore_permissions import DATASTORE_PERMISSIONS_SQL_TEMPLATE
 
 
 class CkanTestCase(unittest.TestCase):
@@ -84,17 +85,22 @@ class DbTestCase(unittest.TestCase):
         self.datastore = DeisCkanInstanceDb(self.instance, 'datastore')
 
     def test_set_datastore_readonly_permissions(self):
-        postgres_driver.connect = MagicMock()
-        db_manager.get_external_admin_connection_string = MagicMock()
         conn = MagicMock()
         cursor = MagicMock()
+        # none of the permissions are set
+        cursor.description = [Mock() for _ in range(5)]
+        for column, name in zip(cursor.description, ['connect', 'usage', 'select_tables', 'default_select', 'template']):
+            column.name = name
+        cursor.fetchone.return_value = (False, False, False, False, False)
         conn.cursor.return_value.__enter__.return_value = cursor
-        postgres_driver.connect.return_value.__enter__.return_value = conn
         self.instance.annotations.get_secret = lambda x: 'postgres_ro'
 
-        self.datastore.set_datastore_readonly_permissions()
+        with patch.object(postgres_driver, 'connect') as connect, \
+                patch.object(db_manager, 'get_external_admin_connection_string'):
+            connect.return_value.__enter__.return_value = conn
+            self.datastore.set_datastore_readonly_permissions()
 
-        self.assertEqual(cursor.execute.call_count, 5)
+        self.assertEqual(cursor.execute.call_count, 6)
         cursor.execute.assert_has_calls([
             call("GRANT CONNECT ON DATABASE \"test\" TO \"postgres_ro\";"),
             call("GRANT USAGE ON SCHEMA public TO \"postgres_ro\";"),
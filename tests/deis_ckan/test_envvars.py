@@ -0,0 +1,58 @@
+import base64
+import json
+import unittest
+from unittest.mock import patch
+
+from ckan_cloud_operator import gitlab
+from ckan_cloud_operator import kubectl
+
+
+def _secret(data, labels=None):
+    return {'metadata': {'name': 'ckan-envvars', 'labels': labels or {}},
+            'data': {k: base64.b64encode(v.encode()).decode() for k, v in data.items()}}
+
+
+class EnvvarsSecretTestCase(unittest.TestCase):
+
+    @patch('ckan_cloud_operator.kubectl.get')
+    @patch('ckan_cloud_operator.kubectl.apply')
+    def test_update_secret_skip_unchanged(self, apply, get):
+        secret = _secret({'CKAN_SITE_URL': 'https://a', 'CKAN_SITE_ID': 'a'})
+        kubectl.update_secret('ckan-envvars', {'CKAN_SITE_URL': 'https://a', 'EMPTY': ''}, namespace='a',
+                              secret=secret, skip_unchanged=True)
+        self.assertEqual(apply.call_count, 0)
+        data = kubectl.update_secret('ckan-envvars', {'CKAN_SITE_URL': 'https://b'}, namespace='a',
+                                     secret=secret, skip_unchanged=True)
+        self.assertEqual(apply.call_count, 1)
+        self.assertEqual(data, {'CKAN_SITE_URL': 'https://b', 'CKAN_SITE_ID': 'a'})
+        kubectl.update_secret('ckan-envvars', {'CKAN_SITE_URL': 'https://a'}, namespace='a', secret={},
+                              skip_unchanged=True)
+        self.assertEqual(apply.call_count, 2)
+        self.assertEqual(get.call_count, 0)
+
+
+class GitlabDotenvCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        gitlab.clear_cache()
+
+    def test_get_envvars_cached_by_commit_sha(self):
+        commit_shas = ['sha1', 'sha1', 'sha2']
+        requests = []
+
+        def _curl(urlpart, *args, **kwargs):
+            requests.append(urlpart)
+            if '/repository/branches/' in urlpart:
+                return json.dumps({'commit': {'id': commit_shas.pop(0)}})
+            else:
+                return 'CKAN_SITE_ID=test\n'
+
+        ckan_gitlab = gitlab.CkanGitlab()
+        with patch.object(ckan_gitlab, '_curl', side_effect=_curl), \
+                patch.object(ckan_gitlab, '_get_project_id', return_value=1):
+            for _ in range(3):
+                self.assertEqual(ckan_gitlab.get_envvars('org/repo'), {'CKAN_SITE_ID': 'test'})
+        self.assertEqual([urlpart for urlpart in requests if '/files/' in urlpart], [
+            'projects/1/repository/files/.env/raw?ref=sha1',
+            'projects/1/repository/files/.env/raw?ref=sha2',
+        ])
@@ -0,0 +1,68 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+import yaml
+
+from ckan_cloud_operator.drivers.helm import driver
+
+
+class HelmDriverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        patcher = patch.dict(os.environ, {'HELM_REPOSITORY_CACHE': self.tmpdir.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        driver.__dict__['__HELM_VERSION'] = None
+        driver.__dict__['__UPDATED_REPOS'].clear()
+        self.calls = []
+        self.deployed = {'chart': 'ckan-1.0.0', 'values': {'siteUrl': 'https://ckan.io', 'replicas': 2}}
+
+    def _subprocess(self, cmd, **kwargs):
+        self.calls.append(cmd)
+        if cmd.startswith('helm version'):
+            return b'version.BuildInfo{Version:"v3.2.0"}'
+        elif cmd.startswith('helm repo list'):
+            return json.dumps([{'name': 'ckan-cloud', 'url': 'https://charts'}]).encode()
+        elif cmd.startswith('helm list'):
+            return json.dumps([{'name': 'ckan-cloud-i1', 'status': 'deployed', 'chart': self.deployed['chart']}]).encode()
+        elif cmd.startswith('helm get values'):
+            return json.dumps(self.deployed['values']).encode()
+        return b''
+
+    def _deploy(self, values, chart_version='1.0.0'):
+        with tempfile.NamedTemporaryFile('w') as f:
+            yaml.dump(values, f)
+            f.flush()
+            with patch('subprocess.check_output', side_effect=self._subprocess), \
+                 patch('subprocess.check_call', side_effect=self._subprocess):
+                return driver.deploy('tiller', 'https://charts', 'ckan-cloud/ckan', chart_version, 'ckan-cloud-i1',
+                                     f.name, 'i1', skip_unchanged=True)
+
+    def test_deploy_skip_unchanged(self):
+        self.assertFalse(self._deploy({'siteUrl': 'https://ckan.io', 'replicas': 2}))
+        self.assertEqual(len([c for c in self.calls if c.startswith('helm upgrade')]), 0)
+        # repo index does not exist - the repo is added once per run, helm version is detected once
+        self.assertTrue(self._deploy({'siteUrl': 'https://ckan.io', 'replicas': 3}))
+        self.assertEqual(len([c for c in self.calls if c.startswith('helm repo add')]), 1)
+        self.assertEqual(len([c for c in self.calls if c.startswith('helm version')]), 1)
+        upgrades = [c for c in self.calls if c.startswith('helm upgrade')]
+        self.assertEqual(len(upgrades), 1)
+        self.assertNotIn('--dry-run', upgrades[0])
+        self.assertTrue(self._deploy({'siteUrl': 'https://ckan.io', 'replicas': 2}, chart_version='1.0.1'))
+
+    def test_update_repo_fresh_index(self):
+        with open(os.path.join(self.tmpdir.name, 'ckan-cloud-index.yaml'), 'w') as f:
+            yaml.dump({'entries': {'ckan': [{'version': '1.1.0-rc1'}, {'version': '1.0.0'}]}}, f)
+        self.assertFalse(self._deploy({'siteUrl': 'https://ckan.io', 'replicas': 2}, chart_version=''))
+        self.assertEqual(len([c for c in self.calls if c.startswith('helm repo add')]), 0)
+        driver.__dict__['__UPDATED_REPOS'].clear()
+        old_time = time.time() - driver.REPO_INDEX_TTL_SECONDS - 1
+        os.utime(os.path.join(self.tmpdir.name, 'ckan-cloud-index.yaml'), (old_time, old_time))
+        self._deploy({'siteUrl': 'https://ckan.io', 'replicas': 2})
+        self.assertEqual(len([c for c in self.calls if c.startswith('helm repo add')]), 1)
@@ -0,0 +1,86 @@
+import time
+import unittest
+from unittest.mock import patch
+
+from ckan_cloud_operator import kubectl
+from ckan_cloud_operator.drivers.kubectl import informer
+from ckan_cloud_operator.drivers.kubectl.api import KubeApiClient
+from ckan_cloud_operator.drivers.kubectl.fake_api_server import FakeApiServer
+
+
+def _route(name, router_name):
+    return {'apiVersion': 'stable.viderum.com/v1', 'kind': 'CkanCloudRoute', 'spec': {'type': 'backend-url'},
+            'metadata': {'name': name, 'namespace': 'ckan-cloud', 'labels': {'ckan-cloud/router-name': router_name}}}
+
+
+class InformerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeApiServer().start()
+        kubectl.set_api_client(KubeApiClient(self.server.url))
+
+    def tearDown(self):
+        kubectl.set_api_client(None)
+        self.server.stop()
+
+    def _wait_for(self, func):
+        for _ in range(50):
+            if func():
+                return
+            time.sleep(0.1)
+        self.fail('timed out')
+
+    def test_list_by_labels(self):
+        self.server.add(_route('route1', 'router1'))
+        self.server.add(_route('route2', 'router2'))
+        routes = informer.get_items_by_labels('CkanCloudRoute', {'ckan-cloud/router-name': 'router1'})
+        self.assertEqual([r['metadata']['name'] for r in routes], ['route1'])
+        self.assertEqual(informer.get_item('CkanCloudRoute', 'route2')['spec'], {'type': 'backend-url'})
+        num_requests = len(self.server.requests)
+        informer.get_items_by_labels('CkanCloudRoute', {'ckan-cloud/router-name': 'router2'})
+        informer.get_item('CkanCloudRoute', 'route1')
+        self.assertEqual(self.server.requests[num_requests:], [])
+        # changes made outside of the process are received from the watch
+        self.server.add(_route('route3', 'router1'))
+        self._wait_for(lambda: len(informer.get_items_by_labels('CkanCloudRoute', {'ckan-cloud/router-name': 'router1'})) == 2)
+        self.server.delete('stable.viderum.com/v1', 'ckancloudroutes', 'ckan-cloud', 'route1')
+        self._wait_for(lambda: informer.get_item('CkanCloudRoute', 'route1') is None)
+
+    def test_write_invalidates(self):
+        self.server.add(_route('route1', 'router1'))
+        self.assertEqual(informer.get_item('CkanCloudRoute', 'route1')['spec'], {'type': 'backend-url'})
+        route = _route('route1', 'router2')
+        route['spec']['type'] = 'datapusher-subdomain'
+        kubectl.apply(route)
+        self.assertEqual(informer.get_item('CkanCloudRoute', 'route1')['spec'], {'type': 'datapusher-subdomain'})
+        self.assertEqual(informer.get_items_by_labels('CkanCloudRoute', {'ckan-cloud/router-name': 'router1'}), [])
+        kubectl.check_call('delete CkanCloudRoute route1')
+        self.assertEqual(informer.get_item('CkanCloudRoute', 'route1'), None)
+
+
+class InformerWatchFailedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        kubectl.set_api_client(None)
+        informer.enable()
+
+    def tearDown(self):
+        informer.reset()
+        informer.enable(None)
+
+    @patch('ckan_cloud_operator.drivers.kubectl.informer.time.sleep', new=lambda seconds: None)
+    @patch('ckan_cloud_operator.drivers.kubectl.informer.subprocess.Popen', side_effect=OSError('watch not allowed'))
+    @patch('ckan_cloud_operator.kubectl.get_items_by_labels', return_value=[])
+    @patch('ckan_cloud_operator.kubectl.get', return_value=None)
+    def test_lookups_after_watch_failed(self, get, get_items_by_labels, popen):
+        informer.get_item('CkanCloudRoute', 'route1')
+        route_informer = informer.get_informer('CkanCloudRoute')
+        route_informer._watch_thread.join(5)
+        self.assertTrue(route_informer._watch_failed)
+        get.reset_mock()
+        informer.get_item('CkanCloudRoute', 'route1')
+        get.assert_called_once_with('CkanCloudRoute route1', required=False, namespace='ckan-cloud')
+        informer.get_items_by_labels('CkanCloudRoute', {'ckan-cloud/router-name': 'router1'})
+        get_items_by_labels.assert_called_once_with('CkanCloudRoute', {'ckan-cloud/router-name': 'router1'},
+                                                    required=False, namespace='ckan-cloud')
+        self.assertEqual(get.call_count, 1)
@@ -0,0 +1,90 @@
+import threading
+import unittest
+from unittest.mock import patch
+
+from ckan_cloud_operator import kubectl
+from ckan_cloud_operator.drivers.kubectl.api import KubeApiClient, UnsupportedCommand
+from ckan_cloud_operator.drivers.kubectl.fake_api_server import FakeApiServer
+
+
+class KubectlApiBackendTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeApiServer().start()
+        kubectl.set_api_client(KubeApiClient(self.server.url))
+
+    def tearDown(self):
+        kubectl.set_api_client(None)
+        self.server.stop()
+
+    def test_get(self):
+        self.server.add({'apiVersion': 'apps/v1', 'kind': 'Deployment', 'spec': {'replicas': 1},
+                         'metadata': {'name': 'router-traefik-foo', 'namespace': 'ckan-cloud', 'labels': {'app': 'x'}}})
+        deployment = kubectl.get('deployment router-traefik-foo')
+        self.assertEqual(deployment['kind'], 'Deployment')
+        self.assertEqual(deployment['spec'], {'replicas': 1})
+        self.assertEqual(kubectl.get('deployment missing', required=False), None)
+        items = kubectl.get_items_by_labels('deployment', {'app': 'x'})
+        self.assertEqual([item['metadata']['name'] for item in items], ['router-traefik-foo'])
+        self.assertEqual(items[0]['apiVersion'], 'apps/v1')
+        self.assertEqual(kubectl.get_items_by_labels('deployment', {'app': 'y'}), [])
+
+    def test_get_custom_resource(self):
+        self.server.add({'apiVersion': 'stable.viderum.com/v1', 'kind': 'CkanCloudRouter', 'spec': {'type': 'traefik'},
+                         'metadata': {'name': 'foo', 'namespace': 'ckan-cloud'}})
+        self.assertEqual(kubectl.get('CkanCloudRouter foo')['spec'], {'type': 'traefik'})
+        self.assertEqual(len(kubectl.get('CkanCloudRouter')['items']), 1)
+
+    def test_apply_and_delete(self):
+        kubectl.update_configmap('foo', {'a': 'b'}, labels={'app': 'x'})
+        kubectl.update_configmap('foo', {'c': 'd'}, labels={'app': 'x'})
+        self.assertEqual(kubectl.get('configmap foo')['data'], {'a': 'b', 'c': 'd'})
+        kubectl.check_call('delete --ignore-not-found configmap foo')
+        self.assertEqual(kubectl.get('configmap foo', required=False), None)
+        self.assertEqual(kubectl.call('delete configmap foo'), 1)
+
+    def test_apply_fetched_resource(self):
+        kubectl.update_configmap('foo', {'a': 'b'})
+        configmap = kubectl.get('configmap foo')
+        self.assertEqual(configmap['metadata']['managedFields'][0]['manager'], 'ckan-cloud-operator')
+        configmap['data']['c'] = 'd'
+        kubectl.apply(configmap)
+        self.assertEqual(kubectl.get('configmap foo')['data'], {'a': 'b', 'c': 'd'})
+        with self.assertRaisesRegex(Exception, 'managedFields must be nil'):
+            kubectl.get_api_client().request('PATCH', '/api/v1/namespaces/ckan-cloud/configmaps/foo', body=configmap,
+                                             content_type='application/apply-patch+yaml')
+
+    @patch('ckan_cloud_operator.logs.subprocess_run')
+    def test_apply_client_side_applied_fallback(self, subprocess_run):
+        self.server.add({'apiVersion': 'v1', 'kind': 'ConfigMap', 'data': {'a': 'b'}, 'metadata': {
+            'name': 'foo', 'namespace': 'ckan-cloud',
+            'annotations': {'kubectl.kubernetes.io/last-applied-configuration': '{}'}
+        }})
+        kubectl.apply({'apiVersion': 'v1', 'kind': 'ConfigMap', 'data': {'c': 'd'},
+                       'metadata': {'name': 'foo', 'namespace': 'ckan-cloud'}})
+        self.assertEqual(subprocess_run.call_count, 1)
+        self.assertEqual(kubectl.get('configmap foo')['data'], {'a': 'b'})
+
+    @patch('ckan_cloud_operator.logs.subprocess_check_call')
+    def test_unsupported_fallback(self, subprocess_check_call):
+        with self.assertRaises(UnsupportedCommand):
+            kubectl.get_api_client().get_cmd('all', ['-l app=ckan'])
+        kubectl.check_call('rollout restart deployment/foo')
+        subprocess_check_call.assert_called_once_with('kubectl -n ckan-cloud rollout restart deployment/foo', shell=True)
+
+    def test_wait_deployment_rollout(self):
+        deployment = {'apiVersion': 'apps/v1', 'kind': 'Deployment', 'spec': {'replicas': 2},
+                      'metadata': {'name': 'router-traefik-foo', 'namespace': 'ckan-cloud'},
+                      'status': {'observedGeneration': 1, 'replicas': 3, 'updatedReplicas': 1, 'availableReplicas': 2}}
+        self.server.add(deployment)
+        self.assertFalse(kubectl.is_deployment_rolled_out(kubectl.get('deployment router-traefik-foo')))
+
+        def _rollout():
+            deployment['status'].update(replicas=2, updatedReplicas=2)
+            self.server.add(deployment)
+
+        timer = threading.Timer(.5, _rollout)
+        timer.start()
+        kubectl.wait_deployment_rollout('router-traefik-foo', timeout_seconds=10)
+        timer.join()
+        self.assertTrue(kubectl.is_deployment_rolled_out(kubectl.get('deployment router-traefik-foo')))
@@ -0,0 +1,74 @@
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from ckan_cloud_operator.drivers.postgres import backup
+
+
+TEST_POSTGRES_URL = os.environ.get('CKAN_CLOUD_OPERATOR_TEST_POSTGRES_URL')
+TEST_S3_BUCKET = os.environ.get('CKAN_CLOUD_OPERATOR_TEST_S3_BUCKET')
+
+
+def _fake_dump_commands(connection_string, dump_format='plain', compressor='gzip'):
+    return [['echo', f'-- dump of {connection_string}'], ['gzip', '-c']]
+
+
+class PostgresBackupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_dump_commands(self):
+        self.assertEqual([cmd[0] for cmd in backup.get_dump_commands('postgresql://db', 'plain', 'zstd')],
+                         ['pg_dump', 'sed', 'zstd'])
+        self.assertEqual([cmd[0] for cmd in backup.get_dump_commands('postgresql://db', 'custom', 'zstd')],
+                         ['pg_dump'])
+        self.assertEqual(backup.get_dump_filename('db1', '201901220300', 'plain', 'zstd'), 'db1_201901220300.zst')
+        self.assertEqual(backup.get_dump_filename('db1', '201901220300', 'custom'), 'db1_201901220300.dump')
+
+    @patch('ckan_cloud_operator.drivers.postgres.backup.get_dump_commands', new=_fake_dump_commands)
+    def test_dump_all(self):
+        manifest = backup.dump_all(['db1', 'db2', 'db3'], lambda db: f'postgresql://{db}', self.tmpdir,
+                                   concurrency=2, timestamp='201901220300')
+        self.assertEqual([b['status'] for b in manifest['backups']], ['success'] * 3)
+        for b in manifest['backups']:
+            filename = os.path.join(self.tmpdir, f'{b["database"]}_201901220300.gz')
+            with open(filename, 'rb') as f:
+                data = f.read()
+            self.assertEqual(b['size'], len(data))
+            self.assertEqual(b['sha256'], hashlib.sha256(data).hexdigest())
+            self.assertEqual(gzip.decompress(data).decode(), f'-- dump of postgresql://{b["database"]}\n')
+        with open(os.path.join(self.tmpdir, 'manifest_201901220300.json')) as f:
+            self.assertEqual(json.load(f), manifest)
+
+    def test_dump_all_failure(self):
+        def _failing_dump_commands(connection_string, dump_format='plain', compressor='gzip'):
+            return [['false'] if connection_string.endswith('db2') else ['echo', 'ok']]
+
+        with patch('ckan_cloud_operator.drivers.postgres.backup.get_dump_commands', new=_failing_dump_commands):
+            manifest = backup.dump_all(['db1', 'db2'], lambda db: f'postgresql://{db}', self.tmpdir)
+        self.assertEqual([b['status'] for b in manifest['backups']], ['success', 'failed'])
+        # a failed dump doesn't leave a partial backup
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['_tmp', 'db1_{}.gz'.format(manifest['timestamp']),
+                                                           'manifest_{}.json'.format(manifest['timestamp'])])
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, '_tmp')), [])
+
+
+@unittest.skipUnless(TEST_POSTGRES_URL and TEST_S3_BUCKET and shutil.which('pg_dump'),
+                     'requires a local PostgreSQL (CKAN_CLOUD_OPERATOR_TEST_POSTGRES_URL) and an S3 compatible '
+                     'storage (CKAN_CLOUD_OPERATOR_TEST_S3_BUCKET, CKAN_CLOUD_OPERATOR_BACKUPS_S3_ENDPOINT_URL)')
+class PostgresBackupS3TestCase(unittest.TestCase):
+
+    def test_dump_to_s3(self):
+        res = backup.dump(TEST_POSTGRES_URL, f's3://{TEST_S3_BUCKET}/test/db.dump', dump_format='custom')
+        data = backup._get_s3_client().get_object(Bucket=TEST_S3_BUCKET, Key='test/db.dump')['Body'].read()
+        self.assertTrue(data.startswith(b'PGDMP'))
+        self.assertEqual(res['sha256'], hashlib.sha256(data).hexdigest())
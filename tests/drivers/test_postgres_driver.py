@@ -0,0 +1,129 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch, MagicMock
+
+import psycopg2.extensions
+
+from ckan_cloud_operator.drivers.postgres import driver
+
+
+TEST_POSTGRES_URL = os.environ.get('CKAN_CLOUD_OPERATOR_TEST_POSTGRES_URL')
+
+
+class FakeCursor(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def execute(self, query, args=()):
+        self.queries.append((query, args))
+
+
+class PostgresCatalogTestCase(unittest.TestCase):
+
+    def test_get_dbs_roles_info(self):
+        role_row = ['db1'] + [None] * (len(driver.ROLE_FIELDS) - 1)
+        db_row = ['db1'] + [None] * (len(driver.DB_FIELDS) - 1)
+        cur = FakeCursor([
+            role_row + db_row,
+            ['role1'] + role_row[1:] + [None] * len(driver.DB_FIELDS),
+        ])
+        admin_conn = MagicMock(cursor=lambda: cur)
+        res = driver.get_dbs_roles_info(admin_conn, ['db1', 'role1', 'missing'])
+        self.assertEqual(len(cur.queries), 1)
+        self.assertEqual(cur.queries[0][1], (['db1', 'role1', 'missing'],))
+        self.assertEqual(res['db1']['db']['datname'], 'db1')
+        self.assertEqual(res['db1']['role']['rolname'], 'db1')
+        self.assertEqual(res['role1']['role']['rolname'], 'role1')
+        self.assertIsNone(res['role1']['db'])
+        self.assertEqual(res['missing'], {'role': None, 'db': None})
+
+    @patch('psycopg2.connect')
+    def test_pooled_connect(self, connect):
+        connect.side_effect = lambda *args, **kwargs: MagicMock(
+            closed=False, info=MagicMock(transaction_status=psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+        )
+        connections = []
+        for _ in range(3):
+            with driver.pooled_connect('postgresql://test-pooled-connect/db') as conn:
+                connections.append(conn)
+        # the connection is reused and kept open
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual(len(set(map(id, connections))), 1)
+        connections[0].close.assert_not_called()
+
+        def _use_connection(_):
+            with driver.pooled_connect('postgresql://test-pooled-connect/db'):
+                time.sleep(.05)
+
+        # more concurrent users than connections wait for a free connection
+        with ThreadPoolExecutor(driver.POOL_MAX_CONNECTIONS * 2) as executor:
+            list(executor.map(_use_connection, range(driver.POOL_MAX_CONNECTIONS * 2)))
+        self.assertEqual(connect.call_count, driver.POOL_MAX_CONNECTIONS)
+        driver.close_pools()
+        connections[0].close.assert_called_once()
+
+
+@unittest.skipUnless(TEST_POSTGRES_URL and shutil.which('pg_restore'),
+                     'requires a local PostgreSQL (CKAN_CLOUD_OPERATOR_TEST_POSTGRES_URL) and the PostgreSQL client')
+class PostgresRestoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        with driver.connect(TEST_POSTGRES_URL) as conn:
+            with conn.cursor() as cur:
+                cur.execute('DROP TABLE IF EXISTS restore_test; '
+                            'CREATE TABLE restore_test AS SELECT generate_series(1, 1000) AS id')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _restore(self, dump_format, jobs=1):
+        filename = os.path.join(self.tmpdir, f'dump.{dump_format}')
+        subprocess.check_call(['pg_dump', '--dbname', TEST_POSTGRES_URL, '--table', 'restore_test', '--no-owner',
+                               '--no-acl', '--clean', '--if-exists', f'--format={dump_format}', '--file', filename])
+        with driver.connect(TEST_POSTGRES_URL) as conn:
+            with conn.cursor() as cur:
+                cur.execute('DROP TABLE restore_test')
+        events = list(driver.restore(TEST_POSTGRES_URL, filename, jobs=jobs))
+        with driver.connect(TEST_POSTGRES_URL) as conn:
+            with conn.cursor() as cur:
+                cur.execute('SELECT count(*) FROM restore_test')
+                self.assertEqual(cur.fetchone()[0], 1000)
+        return events
+
+    def test_restore_custom_format(self):
+        events = self._restore('custom', jobs=2)
+        self.assertEqual(events[-1]['restored-items'], events[-1]['total-items'])
+
+    def test_restore_plain(self):
+        events = self._restore('plain')
+        self.assertEqual(events[-1]['restored-bytes'], events[-1]['total-bytes'])
+
+    def test_create_delete_base_dbs(self):
+        db_names = ['test-base-db-1', 'test-base-db-2']
+        with driver.connect(TEST_POSTGRES_URL) as admin_conn:
+            driver.delete_base_dbs(admin_conn, db_names)
+            errors = driver.create_base_dbs(admin_conn, [(name, 'password') for name in db_names])
+            self.assertEqual(errors, {name: [] for name in db_names})
+            self.assertEqual(driver.create_base_dbs(admin_conn, [(db_names[0], 'password')]),
+                             {db_names[0]: ['role-exists', 'db-exists']})
+            info = driver.get_dbs_roles_info(admin_conn, db_names)
+            self.assertTrue(all(info[name]['db'] and info[name]['role'] for name in db_names))
+            self.assertEqual(driver.delete_base_dbs(admin_conn, db_names), {name: [] for name in db_names})
+            self.assertEqual(list(driver.list_roles(admin_conn, role_names=db_names)), [])
@@ -0,0 +1,71 @@
+import io
+import json
+import unittest
+from argparse import Namespace
+from unittest.mock import patch
+
+from ckan_cloud_operator.drivers import postgresdbdiff
+
+
+def _definition(columns, indexes=None, constraints=None, definition=None):
+    res = {'columns': columns, 'indexes': indexes or {}, 'constraints': constraints or {}}
+    if definition:
+        res['definition'] = definition
+    return res
+
+
+DB1_CATALOG = {
+    'tables': {
+        'package': _definition({'id': 'text NO', 'name': 'text NO'}, {'package_pkey': 'CREATE UNIQUE INDEX ...'}),
+        'resource': _definition({'id': 'text NO'}),
+        'only1': _definition({'id': 'text NO'}),
+    },
+    'views': {'v1': _definition({'id': 'text YES'}, definition='SELECT id FROM package')},
+    'rowcount_estimates': {'package': 10, 'resource': 5, 'only1': 0},
+}
+
+DB2_CATALOG = {
+    'tables': {
+        'package': _definition({'id': 'text NO', 'name': 'character varying NO'}, {'package_pkey': 'CREATE UNIQUE INDEX ...'}),
+        'resource': _definition({'id': 'text NO'}),
+        'only2': _definition({'id': 'text NO'}),
+    },
+    'views': {'v1': _definition({'id': 'text YES'}, definition='SELECT id FROM package')},
+    'rowcount_estimates': {'package': 10, 'resource': 7, 'only2': 0},
+}
+
+
+class PostgresDbDiffTestCase(unittest.TestCase):
+
+    def _main(self, **kwargs):
+        options = Namespace(**dict(dict(db1='db1', db2='db2', diff_folder=None, rowcount=False,
+                                        rowcount_estimate=False, rowcount_workers=2, catalog=True, json=True),
+                                   **kwargs))
+        stdout = io.StringIO()
+        with patch('ckan_cloud_operator.drivers.postgresdbdiff.parser_arguments', return_value=options), \
+             patch('ckan_cloud_operator.drivers.postgresdbdiff.get_db_catalog',
+                   side_effect=lambda db_name: DB1_CATALOG if db_name == 'db1' else DB2_CATALOG), \
+             patch('sys.stdout', stdout):
+            postgresdbdiff.main()
+        return json.loads(stdout.getvalue())
+
+    def test_catalog_diff(self):
+        res = self._main()
+        self.assertEqual(res['tables']['additional_in_db1'], ['only1'])
+        self.assertEqual(res['tables']['additional_in_db2'], ['only2'])
+        self.assertEqual(list(res['tables']['not_matching']), ['package'])
+        self.assertIn('+    name character varying NO', res['tables']['not_matching']['package'])
+        self.assertEqual(res['tables']['not_matching_rowcount'], {})
+        self.assertEqual(res['views']['not_matching'], {})
+
+    def test_catalog_diff_rowcount_estimate(self):
+        res = self._main(rowcount_estimate=True)
+        self.assertEqual(res['tables']['not_matching_rowcount'], {'resource': [5, 7]})
+
+    def test_parallel_rowcount(self):
+        rowcounts = {('db1', 'resource'): 5, ('db2', 'resource'): 6, ('db1', 'package'): 1, ('db2', 'package'): 1}
+        options = Namespace(db1='db1', db2='db2', rowcount_estimate=False, rowcount_workers=4, catalog=False)
+        with patch('ckan_cloud_operator.drivers.postgresdbdiff.get_table_rowcount',
+                   side_effect=lambda db_name, table_name: rowcounts[(db_name, table_name)]):
+            self.assertEqual(postgresdbdiff.get_table_rowcounts(options, ['resource', 'package']),
+                             {'resource': (5, 6), 'package': (1, 1)})
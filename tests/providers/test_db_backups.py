@@ -0,0 +1,49 @@
+import datetime
+import json
+import unittest
+from unittest.mock import patch
+
+from ckan_cloud_operator.providers.db.gcloudsql import manager
+
+
+def _dump_all(databases, get_connection_string, base_url, skipped_databases=None, **kwargs):
+    return {
+        'backups': [{'database': db, 'url': f'{base_url}/{db}.gz', 'status': 'success', 'size': 1}
+                    for db in databases],
+        'skipped': skipped_databases, 'total_size': len(databases), 'duration_seconds': 1,
+    }
+
+
+@patch('ckan_cloud_operator.providers.db.gcloudsql.manager._get_backups_base_url', new=lambda db_prefix: 'gs://b')
+@patch('ckan_cloud_operator.providers.db.gcloudsql.manager.get_all_db_names',
+       new=lambda db_prefix: ['postgres', 'template1', 'db1', 'db2', 'db3'])
+@patch('ckan_cloud_operator.providers.db.gcloudsql.manager.backup_driver.dump_all', side_effect=_dump_all)
+@patch('ckan_cloud_operator.providers.db.gcloudsql.manager._config_set')
+@patch('ckan_cloud_operator.providers.db.gcloudsql.manager._config_get')
+@patch('ckan_cloud_operator.providers.db.gcloudsql.manager._get_backups_change_markers')
+class DbBackupsTestCase(unittest.TestCase):
+
+    def _state(self, marker, days_ago=0):
+        return json.dumps({'marker': marker, 'url': 'gs://b/old.gz',
+                           'timestamp': (datetime.datetime.now() - datetime.timedelta(days=days_ago)).isoformat()})
+
+    def test_skip_unchanged(self, get_markers, config_get, config_set, dump_all):
+        get_markers.return_value = {'db1': '1:0:0:', 'db2': '5:1:0:', 'db3': '2:0:0:'}
+        config_get.return_value = {
+            'db1': self._state('1:0:0:'),
+            'db2': self._state('4:1:0:'),
+            'db3': self._state('2:0:0:', days_ago=8),
+        }
+        manifest = manager.create_all_backups(skip_unchanged=True)
+        self.assertEqual([b['database'] for b in manifest['backups']], ['db2', 'db3'])
+        self.assertEqual(manifest['skipped'], ['db1'])
+        saved_state = config_set.call_args[1]['values']
+        self.assertEqual(sorted(saved_state), ['db2', 'db3'])
+        self.assertEqual(json.loads(saved_state['db2'])['marker'], '5:1:0:')
+
+    def test_backup_all(self, get_markers, config_get, config_set, dump_all):
+        get_markers.return_value = {'db1': '1:0:0:'}
+        config_get.return_value = {'db1': self._state('1:0:0:')}
+        manifest = manager.create_all_backups()
+        self.assertEqual([b['database'] for b in manifest['backups']], ['db1', 'db2', 'db3'])
+        self.assertEqual(sorted(config_set.call_args[1]['values']), ['db1', 'db2', 'db3'])
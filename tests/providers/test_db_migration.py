@@ -0,0 +1,92 @@
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from ckan_cloud_operator.providers.ckan.db import migration
+
+
+class DbMigrationTestCase(unittest.TestCase):
+
+    @patch('ckan_cloud_operator.providers.ckan.db.migration._gcloud')
+    def test_get_latest_backup_urls(self, gcloud):
+        base_url = 'gs://backups/prod2/2019/01/22'
+        gcloud.return_value.getstatusoutput.return_value = (0, '\n'.join([
+            f'{base_url}/03/nav_201901220300.gz',
+            f'{base_url}/03/nav-datastore_201901220300.gz',
+            f'{base_url}/05/nav_201901220500.gz',
+            f'{base_url}/05/nav_foo_201901220500.gz',
+            f'{base_url}/04/nav_201901220400.gz',
+            f'{base_url}/04/nav-datastore_201901220401.gz',
+        ]))
+        self.assertEqual(
+            migration.get_latest_backup_urls('gs://backups/prod2', ['nav', 'nav-datastore'], '2019/01/22'),
+            [f'{base_url}/04/nav_201901220400.gz', f'{base_url}/04/nav-datastore_201901220401.gz']
+        )
+        gcloud.return_value.getstatusoutput.assert_called_once_with(f"ls '{base_url}/**'", gsutil=True)
+        self.assertIsNone(migration.get_latest_backup_urls('gs://backups/prod2', ['other'], '2019/01/22'))
+
+    def test_import_data_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def _import_db(import_url, db_name, import_user, db_prefix):
+            yield {'msg': f'Restoring {import_url}'}
+            # both imports must be running at the same time to pass the barrier
+            barrier.wait()
+            yield {'msg': 'Restored'}
+
+        with patch('ckan_cloud_operator.providers.ckan.db.migration._import_db', side_effect=_import_db):
+            events = list(migration._import_data(None, 'db1', 'db1-datastore', db_import_url='gs://b/db.dump',
+                                                 datastore_import_url='gs://b/datastore.dump'))
+        self.assertEqual(sorted(e['step'] for e in events), [
+            'import-datastore-data', 'import-datastore-data-progress', 'import-datastore-data-progress',
+            'import-db-data', 'import-db-data-progress', 'import-db-data-progress'
+        ])
+
+    def test_import_data_failure(self):
+        def _import_db(import_url, db_name, import_user, db_prefix):
+            yield {'msg': 'Restoring'}
+            if db_name == 'db1-datastore':
+                raise Exception('restore failed')
+
+        with patch('ckan_cloud_operator.providers.ckan.db.migration._import_db', side_effect=_import_db):
+            with self.assertRaises(Exception):
+                list(migration._import_data(None, 'db1', 'db1-datastore', db_import_url='/tmp/db.dump',
+                                            datastore_import_url='/tmp/datastore.dump'))
+
+    @patch('ckan_cloud_operator.providers.ckan.db.migration._gcloudsql')
+    @patch('ckan_cloud_operator.providers.ckan.db.migration._download_dump', return_value='/dev/null')
+    @patch('ckan_cloud_operator.drivers.postgres.driver.restore', return_value=iter([]))
+    @patch('ckan_cloud_operator.providers.db.manager.get_external_admin_connection_string', new=lambda *a, **kw: 'pg')
+    def test_import_db_provider_or_restore(self, restore, download_dump, gcloudsql):
+        for import_url in ['gs://b/db_201901220300.gz', 'gs://b/db.sql']:
+            list(migration._import_db(import_url, 'db1', 'db1', None))
+        self.assertEqual([c[0][0] for c in gcloudsql.return_value.import_db.call_args_list],
+                         ['gs://b/db_201901220300.gz', 'gs://b/db.sql'])
+        self.assertEqual(restore.call_count, 0)
+        # the db provider can't import zstd compressed or custom-format dumps
+        for import_url in ['gs://b/db_201901220300.zst', 'gs://b/db_201901220300.dump']:
+            list(migration._import_db(import_url, 'db1', 'db1', None))
+        self.assertEqual([c[0][0] for c in download_dump.call_args_list],
+                         ['gs://b/db_201901220300.zst', 'gs://b/db_201901220300.dump'])
+        self.assertEqual(restore.call_count, 2)
+        self.assertEqual(gcloudsql.return_value.import_db.call_count, 2)
+
+    @patch('ckan_cloud_operator.providers.ckan.db.migration._gcloudsql')
+    def test_import_data_provider_imports_sequentially(self, gcloudsql):
+        running, max_running = [0], [0]
+        lock = threading.Lock()
+
+        def _import_db(*args, **kwargs):
+            with lock:
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+            time.sleep(0.2)
+            with lock:
+                running[0] -= 1
+
+        gcloudsql.return_value.import_db.side_effect = _import_db
+        list(migration._import_data(None, 'db1', 'db1-datastore', db_import_url='gs://b/db.gz',
+                                    datastore_import_url='gs://b/datastore.gz'))
+        self.assertEqual(gcloudsql.return_value.import_db.call_count, 2)
+        self.assertEqual(max_running[0], 1)
@@ -0,0 +1,102 @@
+import json
+import threading
+import time
+import unittest
+
+from ckan_cloud_operator import kubectl
+from ckan_cloud_operator.drivers.kubectl.api import KubeApiClient
+from ckan_cloud_operator.drivers.kubectl.fake_api_server import FakeApiServer
+from ckan_cloud_operator.providers.ckan.deployment.helm import manager
+
+
+def _log_event(event):
+    return '--START_CKAN_CLOUD_LOG--' + json.dumps({'event': event}) + '--END_CKAN_CLOUD_LOG--\n'
+
+
+class HelmDeploymentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeApiServer(log_follow_timeout=30).start()
+        kubectl.set_api_client(KubeApiClient(self.server.url))
+
+    def tearDown(self):
+        kubectl.set_api_client(None)
+        self.server.stop()
+
+    def test_wait_instance_events(self):
+        self.server.add({'apiVersion': 'v1', 'kind': 'Pod', 'metadata': {
+            'name': 'ckan-1', 'namespace': 'instance1', 'labels': {'app': 'ckan'}
+        }, 'status': {
+            'initContainerStatuses': [{'name': 'secrets', 'restartCount': 0, 'state': {'terminated': {}}}],
+            'containerStatuses': [{'name': 'ckan', 'restartCount': 0, 'state': {'waiting': {}}}],
+        }})
+        self.server.set_pod_log('instance1', 'ckan-1', 'secrets', _log_event('ckan-env-vars-exists') +
+                                _log_event('ckan-secrets-created') + _log_event('got-ckan-secrets'))
+        self.server.set_pod_log('instance1', 'ckan-1', 'ckan', '')
+
+        def _start_ckan():
+            time.sleep(0.5)
+            pod = kubectl.get('pod ckan-1', namespace='instance1')
+            pod['status']['containerStatuses'][0]['state'] = {'running': {}}
+            self.server.add(pod)
+            time.sleep(0.5)
+            for event in ['ckan-entrypoint-initialized', 'ckan-entrypoint-db-init-success',
+                          'ckan-entrypoint-extra-init-success']:
+                self.server.append_pod_log('instance1', 'ckan-1', 'ckan', 'log line\n' + _log_event(event))
+
+        threading.Thread(target=_start_ckan).start()
+        start_time = time.time()
+        manager._wait_instance_events('instance1')
+        self.assertLess(time.time() - start_time, 5)
+
+    def test_get_from_resources_snapshot(self):
+        for instance_id, pod_ready in [('instance1', 'True'), ('instance2', 'False')]:
+            self.server.add({'apiVersion': 'apps/v1', 'kind': 'Deployment', 'metadata': {
+                'name': 'ckan', 'namespace': instance_id, 'generation': 1, 'creationTimestamp': '2020-01-01T00:00:00Z'
+            }, 'status': {}})
+            self.server.add({'apiVersion': 'v1', 'kind': 'Pod', 'metadata': {
+                'name': 'ckan-1', 'namespace': instance_id, 'labels': {'app': 'ckan'},
+                'creationTimestamp': '2020-01-01T00:00:00Z'
+            }, 'spec': {'containers': [{'name': 'ckan', 'image': 'ckan:1'}]}, 'status': {'conditions': [
+                {'type': 'Ready', 'status': pod_ready, 'reason': '', 'message': '', 'lastTransitionTime': ''}
+            ]}})
+        num_requests = len(self.server.requests)
+        snapshot = kubectl.get_all_namespaces_items(['deployment', 'replicaset', 'pod'])
+        self.assertEqual(len(self.server.requests) - num_requests, 3)
+        self.assertEqual(sorted(snapshot), ['instance1', 'instance2'])
+        num_requests = len(self.server.requests)
+        self.assertTrue(manager.get('instance1', resources=snapshot['instance1'], with_logs=False)['ready'])
+        self.assertFalse(manager.get('instance2', resources=snapshot['instance2'], with_logs=False)['ready'])
+        self.assertEqual(len(self.server.requests), num_requests)
+
+    def test_get_logs_incremental(self):
+        self.server.add({'apiVersion': 'apps/v1', 'kind': 'Deployment', 'metadata': {
+            'name': 'ckan', 'namespace': 'instance1', 'generation': 1, 'creationTimestamp': '2020-01-01T00:00:00Z'
+        }, 'status': {}})
+        self.server.add({'apiVersion': 'v1', 'kind': 'Pod', 'metadata': {
+            'name': 'ckan-1', 'namespace': 'instance1', 'labels': {'app': 'ckan'},
+            'creationTimestamp': '2020-01-01T00:00:00Z'
+        }, 'spec': {'containers': [{'name': 'ckan', 'image': 'ckan:1'}]}, 'status': {
+            'initContainerStatuses': [{'name': 'secrets', 'restartCount': 0, 'state': {'terminated': {}}}],
+            'containerStatuses': [{'name': 'ckan', 'restartCount': 0, 'state': {'running': {}}}],
+        }})
+        self.server.set_pod_log('instance1', 'ckan-1', 'secrets', _log_event('got-ckan-secrets'))
+        self.server.set_pod_log('instance1', 'ckan-1', 'ckan', 'starting\n' + _log_event('ckan-entrypoint-initialized'))
+
+        def _get_events():
+            resources = kubectl.get('deployment', namespace='instance1')['items'] + \
+                        kubectl.get('pod', namespace='instance1')['items']
+            pod_status = manager.get('instance1', resources=resources)['pods'][0]
+            return [logdata['event'] for logdata in pod_status['ckan-cloud-logs']], pod_status['logs']
+
+        events, pod_logs = _get_events()
+        self.assertEqual(events, ['got-ckan-secrets', 'ckan-entrypoint-initialized'])
+        self.assertTrue(pod_logs.startswith('starting\n--START_CKAN_CLOUD_LOG--'))
+        self.server.append_pod_log('instance1', 'ckan-1', 'ckan', _log_event('ckan-entrypoint-db-init-success'))
+        num_queries = len(self.server.pod_log_queries)
+        events, _ = _get_events()
+        self.assertEqual(events, ['got-ckan-secrets', 'ckan-entrypoint-initialized', 'ckan-entrypoint-db-init-success'])
+        # the terminated secrets container logs are not fetched again, the ckan logs are fetched since the last line
+        new_queries = self.server.pod_log_queries[num_queries:]
+        self.assertEqual([key[2] for key, _ in new_queries], ['ckan'])
+        self.assertIn('sinceTime', new_queries[0][1])
@@ -0,0 +1,72 @@
+import io
+import json
+import unittest
+
+from ckan_cloud_operator import kubectl
+from ckan_cloud_operator.drivers.kubectl.api import KubeApiClient
+from ckan_cloud_operator.drivers.kubectl.fake_api_server import FakeApiServer
+from ckan_cloud_operator.providers.ckan.instance import manager
+
+
+class InstanceLogsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeApiServer().start()
+        kubectl.set_api_client(KubeApiClient(self.server.url))
+        for service in ['ckan', 'nginx']:
+            self.server.add({'apiVersion': 'apps/v1', 'kind': 'Deployment', 'metadata': {
+                'name': service, 'namespace': 'instance1'
+            }, 'spec': {'selector': {'matchLabels': {'app': service}}}})
+        for pod_name, service in [('ckan-1', 'ckan'), ('ckan-2', 'ckan'), ('nginx-1', 'nginx')]:
+            self.server.add({'apiVersion': 'v1', 'kind': 'Pod', 'metadata': {
+                'name': pod_name, 'namespace': 'instance1', 'labels': {'app': service}
+            }, 'spec': {'containers': [{'name': service}]}, 'status': {'phase': 'Running'}})
+            self.server.set_pod_log('instance1', pod_name, service,
+                                    ''.join(f'{pod_name} line {i}\n' for i in range(1000)))
+
+    def tearDown(self):
+        kubectl.set_api_client(None)
+        self.server.stop()
+
+    def test_multiplexed_logs(self):
+        output = io.BytesIO()
+        manager.get_container_logs('instance1', service='ckan,nginx', all_containers=True, output=output)
+        lines = output.getvalue().decode().splitlines()
+        self.assertEqual(len(lines), 3000)
+        for pod_name, container in [('ckan-1', 'ckan'), ('ckan-2', 'ckan'), ('nginx-1', 'nginx')]:
+            pod_lines = [line for line in lines if line.startswith(f'[{pod_name}/{container}] ')]
+            self.assertEqual(pod_lines, [f'[{pod_name}/{container}] {pod_name} line {i}' for i in range(1000)])
+
+    def test_single_container_ckan_cloud_logs(self):
+        self.server.set_pod_log('instance1', 'nginx-1', 'nginx', 'starting\n--START_CKAN_CLOUD_LOG--{"event":\n'
+                                                                 '"a"}--END_CKAN_CLOUD_LOG--\nlast line\n')
+        output = io.BytesIO()
+        manager.get_container_logs('instance1', service='nginx', tail='-1', ckan_cloud_logs=True, output=output)
+        self.assertEqual(output.getvalue().decode().splitlines(), [
+            'starting', 'ckan-cloud-log: ' + json.dumps({'event': 'a'}), 'last line'
+        ])
+
+    def test_parse_duration_seconds(self):
+        self.assertEqual(manager._parse_duration_seconds('1h30m5s'), 5405)
+        self.assertIsNone(manager._parse_duration_seconds(None))
+        with self.assertRaises(AssertionError):
+            manager._parse_duration_seconds('5x')
+
+
+class PodLogsStreamSubprocessTestCase(unittest.TestCase):
+
+    def _stream(self, script):
+        import subprocess
+        import sys
+        from unittest.mock import patch
+        popen = subprocess.Popen
+        with patch('ckan_cloud_operator.kubectl.get_api_client', return_value=None), \
+                patch('subprocess.Popen', new=lambda cmd, **kwargs: popen([sys.executable, '-c', script], **kwargs)):
+            return list(kubectl.PodLogsStream('ckan-1', namespace='instance1', follow=False))
+
+    def test_kubectl_logs(self):
+        self.assertEqual(self._stream('print("line 1"); print("line 2")'), ['line 1', 'line 2'])
+
+    def test_kubectl_logs_error(self):
+        with self.assertRaisesRegex(Exception, 'a container name must be specified'):
+            self._stream('import sys; sys.stderr.write("error: a container name must be specified"); sys.exit(1)')
@@ -0,0 +1,85 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from ckan_cloud_operator.providers.ckan.instance import manager
+
+
+class InstanceUpdateAllTestCase(unittest.TestCase):
+
+    @patch('ckan_cloud_operator.providers.ckan.instance.manager.informer')
+    @patch('ckan_cloud_operator.providers.ckan.instance.manager.routers_manager')
+    @patch('ckan_cloud_operator.providers.ckan.instance.manager.update')
+    def test_update_all(self, update, routers_manager, informer):
+        def _update(instance_id, **kwargs):
+            self.assertTrue(kwargs['skip_router_update'])
+            if instance_id == 'bad':
+                raise Exception('failed')
+        update.side_effect = _update
+        informer.is_enabled.return_value = False
+        with tempfile.TemporaryDirectory() as tmpdir:
+            journal_filename = os.path.join(tmpdir, 'journal.jsonl')
+            results = list(manager.update_all(['a', 'bad', 'b'], concurrency=2, journal_filename=journal_filename))
+            self.assertEqual(sorted((r['instance'], r['status']) for r in results),
+                             [('a', 'success'), ('b', 'success'), ('bad', 'failed')])
+            routers_manager.update.assert_called_once_with('instances-default', False)
+            # informers enabled for the update are disabled and their watches stopped when done
+            informer.enable.assert_called_with(None)
+            self.assertEqual(informer.reset.call_count, 1)
+            with open(journal_filename) as f:
+                self.assertEqual(len([json.loads(line) for line in f]), 6)
+            update.reset_mock()
+            results = list(manager.update_all(['a', 'bad', 'b'], journal_filename=journal_filename, resume=True))
+            self.assertEqual([(r['instance'], r['status']) for r in results], [('bad', 'failed')])
+            self.assertEqual(update.call_count, 1)
+
+
+@patch('ckan_cloud_operator.providers.ckan.instance.manager.get_storage_provider_id', new=lambda: 'minio')
+@patch('ckan_cloud_operator.providers.ckan.instance.manager.config_manager')
+@patch('ckan_cloud_operator.providers.ckan.instance.manager.routers_manager')
+@patch('ckan_cloud_operator.providers.ckan.instance.manager.annotations_manager')
+@patch('ckan_cloud_operator.providers.ckan.instance.manager.crds_manager')
+@patch('ckan_cloud_operator.providers.ckan.instance.manager.deployment_manager')
+class InstanceUpdateHashTestCase(unittest.TestCase):
+
+    def _update(self, deployment_manager, crds_manager, annotations_manager, previous_hash, ready=True,
+                chart_version='1.0.0', **kwargs):
+        instance = {'spec': {'siteUrl': 'https://ckan.io'}, 'metadata': {}}
+        crds_manager.get.return_value = instance
+        annotations_manager.get_value.return_value = previous_hash
+        deployment_manager.get_update_hash_data.return_value = {'chart-version': chart_version}
+        deployment_manager.get.return_value = {'ready': ready}
+        deployment_manager.pre_update_hook.return_value = {}
+        with patch('ckan_cloud_operator.providers.ckan.instance.manager._get_instance_id_and_type',
+                   return_value=('i1', 'helm', instance)):
+            manager.update('i1', **kwargs)
+        return annotations_manager.set_value.call_args[0][2] if annotations_manager.set_value.called else None
+
+    def test_update_unchanged(self, deployment_manager, crds_manager, annotations_manager, *args):
+        update_hash = self._update(deployment_manager, crds_manager, annotations_manager, None)
+        self.assertEqual(deployment_manager.update.call_count, 1)
+        annotations_manager.reset_mock()
+        self.assertIsNone(self._update(deployment_manager, crds_manager, annotations_manager, update_hash))
+        self.assertEqual(deployment_manager.update.call_count, 1)
+        self.assertEqual(self._update(deployment_manager, crds_manager, annotations_manager, update_hash, force=True),
+                         update_hash)
+        self.assertEqual(deployment_manager.update.call_count, 2)
+        # update-all skips the router update, the hash saved by a single instance update still matches
+        annotations_manager.reset_mock()
+        self.assertIsNone(self._update(deployment_manager, crds_manager, annotations_manager, update_hash,
+                                       skip_router_update=True))
+        self.assertEqual(deployment_manager.update.call_count, 2)
+
+    def test_update_changed_or_not_ready(self, deployment_manager, crds_manager, annotations_manager, *args):
+        update_hash = self._update(deployment_manager, crds_manager, annotations_manager, None)
+        self._update(deployment_manager, crds_manager, annotations_manager, update_hash, ready=False)
+        self.assertEqual(deployment_manager.update.call_count, 2)
+        new_hash = self._update(deployment_manager, crds_manager, annotations_manager, update_hash,
+                                chart_version='1.0.1')
+        self.assertNotEqual(new_hash, update_hash)
+        self.assertEqual(deployment_manager.update.call_count, 3)
+        self._update(deployment_manager, crds_manager, annotations_manager, new_hash, chart_version='1.0.1',
+                     skip_solr=True)
+        self.assertEqual(deployment_manager.update.call_count, 4)
@@ -0,0 +1,45 @@
+import unittest
+from unittest.mock import patch
+
+import psycopg2
+
+from ckan_cloud_operator.providers.db.proxy.pgbouncer import manager
+
+
+class PgBouncerTestCase(unittest.TestCase):
+
+    @patch('ckan_cloud_operator.providers.db.proxy.pgbouncer.manager._touch_pods')
+    @patch('time.sleep')
+    def test_wait_databases(self, sleep, touch_pods):
+        databases = [[{'name': 'pgbouncer'}], [{'name': 'pgbouncer'}, {'name': 'db1'}],
+                     [{'name': 'pgbouncer'}, {'name': 'db1'}, {'name': 'db2'}]]
+        commands = []
+
+        def _admin_command(command):
+            commands.append(command)
+            return databases.pop(0) if command == 'SHOW DATABASES' else []
+
+        with patch('ckan_cloud_operator.providers.db.proxy.pgbouncer.manager.admin_command', new=_admin_command):
+            manager.wait_databases(['db1', 'db2', None])
+        self.assertEqual(commands, ['RELOAD', 'SHOW DATABASES'] * 3)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(touch_pods.call_count, 1)
+
+    @patch('ckan_cloud_operator.providers.db.proxy.pgbouncer.manager._get_pod_names', new=lambda: ['pgbouncer-1'])
+    @patch('ckan_cloud_operator.kubectl.check_call')
+    def test_reload_fallback(self, check_call):
+        with patch('ckan_cloud_operator.providers.db.proxy.pgbouncer.manager.admin_command',
+                   side_effect=psycopg2.OperationalError()):
+            manager.reload()
+        self.assertEqual(check_call.call_count, 1)
+        self.assertIn('exec pgbouncer-1', check_call.call_args[0][0])
+
+    @patch('ckan_cloud_operator.providers.db.proxy.pgbouncer.manager._touch_pods')
+    @patch('ckan_cloud_operator.providers.db.proxy.pgbouncer.manager.reload')
+    @patch('time.sleep')
+    def test_wait_databases_without_admin_console(self, sleep, reload, touch_pods):
+        with patch('ckan_cloud_operator.providers.db.proxy.pgbouncer.manager.admin_command',
+                   side_effect=psycopg2.OperationalError('connection refused')):
+            manager.wait_databases(['db1'])
+        self.assertEqual(reload.call_count, 1)
+        self.assertEqual(sleep.call_count, 1)
@@ -0,0 +1,55 @@
+import unittest
+from unittest.mock import patch
+
+from ckan_cloud_operator.providers.routers import dns
+
+
+class RoutersDnsTestCase(unittest.TestCase):
+
+    def test_get_changes(self):
+        existing = {
+            'a.ckan.io': {'type': 'A', 'content': '1.2.3.4'},
+            'b.ckan.io': {'type': 'A', 'content': '5.6.7.8'},
+            'c.ckan.io': {'type': 'A', 'content': '1.2.3.4'},
+            'd.ckan.io': {'type': 'A', 'content': '5.6.7.8'},
+        }
+        desired = {'a.ckan.io': '1.2.3.4', 'b.ckan.io': '1.2.3.4', 'e.ckan.io': '1.2.3.4'}
+        creates, updates, deletes = dns.get_changes(existing, desired, ['c.ckan.io', 'd.ckan.io'], '1.2.3.4')
+        self.assertEqual(creates, [('e.ckan.io', '1.2.3.4')])
+        self.assertEqual(updates, [('b.ckan.io', '1.2.3.4')])
+        # d points to a different target, it might be managed by another router
+        self.assertEqual(deletes, ['c.ckan.io'])
+
+    def test_reconcile_fake_provider(self):
+        provider = dns.FakeDnsProvider(page_size=100, batch_size=100)
+        domains = {'ckan.io': [f'site{i}' for i in range(1000)]}
+        stats = dns.reconcile('fake', domains, 'lb.example.com', provider=provider)
+        self.assertEqual(stats, {'created': 1000, 'updated': 0, 'deleted': 0, 'unchanged': 0})
+        self.assertEqual(provider.num_requests, 1 + 10)
+        self.assertEqual(provider.zones['ckan.io']['site1.ckan.io'], {'type': 'CNAME', 'content': 'lb.example.com'})
+        stats = dns.reconcile('fake', {'ckan.io': domains['ckan.io'][:999]}, 'lb.example.com',
+                              managed_domains=domains, provider=provider)
+        self.assertEqual(stats, {'created': 0, 'updated': 0, 'deleted': 1, 'unchanged': 999})
+        self.assertEqual(provider.num_requests, 11 + 10 + 1)
+
+    @patch('ckan_cloud_operator.cloudflare.request')
+    def test_cloudflare_provider(self, request):
+        def _request(auth_email, auth_key, urlpart, data=None, method='GET'):
+            if urlpart.startswith('zones?name='):
+                return {'success': True, 'result': [{'id': 'zone1', 'name': 'ckan.io'}]}
+            elif urlpart.startswith('zones/zone1/dns_records?'):
+                page = int(urlpart.split('page=')[1].split('&')[0])
+                return {'success': True, 'result_info': {'total_pages': 2},
+                        'result': [{'id': f'r{page}', 'type': 'A', 'name': f'site{page}.ckan.io', 'content': '1.1.1.1'}]}
+            elif urlpart == 'zones/zone1/dns_records/batch':
+                return {'success': True}
+            raise Exception(urlpart)
+
+        request.side_effect = _request
+        stats = dns.reconcile('cloudflare', {'ckan.io': ['site1', 'site2', 'site3']}, '1.1.1.1',
+                              cloudflare_email='a@b.c', cloudflare_auth_key='key')
+        self.assertEqual(stats, {'created': 1, 'updated': 0, 'deleted': 0, 'unchanged': 2})
+        batch_call = request.call_args_list[-1][0]
+        self.assertEqual(batch_call[2:], ('zones/zone1/dns_records/batch', {'posts': [
+            {'type': 'A', 'name': 'site3.ckan.io', 'content': '1.1.1.1', 'ttl': 120, 'proxied': False}
+        ]}, 'POST'))
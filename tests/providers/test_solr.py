@@ -1,7 +1,10 @@
 import json
 import unittest
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 
+import requests
+
+from ckan_cloud_operator.drivers.solr import driver as solr_driver
 from ckan_cloud_operator.providers.solr import manager
 
 
@@ -47,3 +50,50 @@ class SolrManagerTestCase(unittest.TestCase):
             'solr_http_endpoint': '192.168.0.101'
         }
         self.assertEqual(manager.get_collection_status('montreal'), expected_status)
+
+
+class SolrDriverTestCase(unittest.TestCase):
+
+    @patch('time.sleep')
+    @patch('ckan_cloud_operator.drivers.solr.driver.get_session')
+    def test_curl_retry(self, get_session, sleep):
+        get_session.return_value.get.side_effect = [
+            requests.ConnectionError('failed'), MagicMock(status_code=503, text=''),
+            MagicMock(status_code=200, json=lambda: {'schema': {'name': 'ckan'}})
+        ]
+        on_retry = MagicMock()
+        res = solr_driver.curl(lambda: 'http://solr/solr', '/montreal/schema', required=True, parse_json=True,
+                               on_retry=on_retry)
+        self.assertEqual(res, {'schema': {'name': 'ckan'}})
+        self.assertEqual([c[0][0] for c in sleep.call_args_list], [1, 2])
+        self.assertEqual(on_retry.call_count, 2)
+        get_session.return_value.get.assert_called_with('http://solr/solr/montreal/schema', timeout=60)
+
+    @patch('time.sleep')
+    @patch('ckan_cloud_operator.drivers.solr.driver.get_session')
+    def test_curl_not_required(self, get_session, sleep):
+        get_session.return_value.get.return_value = MagicMock(status_code=404, text='not found')
+        self.assertFalse(solr_driver.curl('http://solr/solr', '/montreal/schema'))
+        self.assertEqual(sleep.call_count, 0)
+        with self.assertRaises(Exception):
+            solr_driver.curl('http://solr/solr', '/montreal/schema', required=True, max_retries=2)
+        self.assertEqual(sleep.call_count, 2)
+
+
+class SolrcloudPortForwardTestCase(unittest.TestCase):
+
+    def test_port_forward_output_is_drained(self):
+        import subprocess
+        import sys
+        from ckan_cloud_operator.providers.solr.solrcloud import manager as solrcloud_manager
+        # kubectl prints a line for every connection, the process must not block on a full pipe
+        process = subprocess.Popen([sys.executable, '-c', 'print("Forwarding from 127.0.0.1:1234 -> 8983")\n'
+                                                          'for i in range(100000): print("Handling connection", i)'],
+                                   stdout=subprocess.PIPE)
+        line = solrcloud_manager._read_port_forward_output(process)
+        self.assertEqual(line, 'Forwarding from 127.0.0.1:1234 -> 8983\n')
+        self.assertEqual(process.wait(timeout=20), 0)
+        process = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(5)'], stdout=subprocess.PIPE)
+        self.assertEqual(solrcloud_manager._read_port_forward_output(process, timeout_seconds=.2), '')
+        process.kill()
+        process.wait()
@@ -1,28 +1,53 @@
-import json
+import hashlib
 import unittest
-from unittest.mock import patch, call
+from unittest.mock import patch
 
 from ckan_cloud_operator.providers.solr import manager
 
 
+def _sha1(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+@patch('ckan_cloud_operator.providers.solr.manager.kubectl.get',
+       new=lambda *args, **kwargs: {'items': [{'metadata': {'name': 'sc-pod'}}]})
 class ZooKeeperTestCase(unittest.TestCase):
-    @patch('ckan_cloud_operator.providers.solr.manager.kubectl.get')
-    @patch('ckan_cloud_operator.providers.solr.manager.kubectl.check_output')
-    def test_put_configs(self, kubectl_check_output, kubectl_get):
-        kubectl_get.return_value = {
-            'items': [
-                {
-                    'metadata': {
-                        'name': 'zk-default-pod'
-                    }
-                }
-            ]
+
+    def _put_configs(self, configs_dir, zk_hashes):
+        def _check_output(cmd):
+            return ''.join(f'{h}  ./{f}\n' for f, h in zk_hashes.items()).encode() if 'sha1sum' in cmd else b''
+
+        with patch('ckan_cloud_operator.providers.solr.manager.kubectl.check_output',
+                   side_effect=_check_output) as check_output:
+            manager.zk_put_configs(configs_dir)
+        return [c[0][0] for c in check_output.call_args_list]
+
+    def test_put_configs(self):
+        cmds = self._put_configs('tests/test_data/schema', {})
+        self.assertEqual(len(cmds), 4)
+        self.assertIn('find . -type f -exec sha1sum', cmds[0])
+        self.assertIn('rm -rf /tmp/ckan-cloud-zk-upload', cmds[1])
+        self.assertRegex(cmds[2], '^cp .* sc-pod:/tmp/ckan-cloud-zk-upload$')
+        self.assertIn('-cmd putfile /configs/schema.xml /tmp/ckan-cloud-zk-upload/schema.xml', cmds[3])
+
+    def test_put_configs_only_changed(self):
+        configs_dir = 'ckan_cloud_operator/data/solr'
+        zk_hashes = {
+            'ckan_default/schema.xml': _sha1(f'{configs_dir}/ckan_default/schema.xml'),
+            'ckan_default/lang/stopwords_en.txt': _sha1(f'{configs_dir}/ckan_default/lang/stopwords_en.txt'),
         }
-        manager.zk_put_configs('tests/test_data/schema')
-        self.assertEqual(kubectl_check_output.call_count, 3)
-        expected_calls = [
-            call('exec zk-default-pod zkCli.sh create /configs null'),
-            call('cp tests/test_data/schema/schema.xml zk-default-pod:/tmp/zk_input'),
-            call('exec zk-default-pod bash -- -c \'zkCli.sh create /configs/schema.xml "$(cat /tmp/zk_input)"\'')
-        ]
-        self.assertEqual(kubectl_check_output.call_args_list, expected_calls)
+        cmds = self._put_configs(configs_dir, zk_hashes)
+        self.assertIn('-cmd downconfig -confname ckan_default', cmds[0])
+        self.assertIn('-cmd upconfig -confname ckan_default -confdir /tmp/ckan-cloud-zk-upload/ckan_default',
+                      cmds[3])
+        with patch('ckan_cloud_operator.providers.solr.manager.shutil.copyfile') as copyfile:
+            self._put_configs(configs_dir, zk_hashes)
+        copied = sorted(c[0][0].replace(f'{configs_dir}/', '') for c in copyfile.call_args_list)
+        self.assertNotIn('ckan_default/schema.xml', copied)
+        self.assertIn('ckan_default/solrconfig.xml', copied)
+        self.assertEqual(len(copied), 7)
+
+    def test_put_configs_no_changes(self):
+        zk_hashes = {'schema.xml': _sha1('tests/test_data/schema/schema.xml')}
+        self.assertEqual(len(self._put_configs('tests/test_data/schema', zk_hashes)), 1)
@@ -0,0 +1,85 @@
+import unittest
+from unittest.mock import patch, MagicMock
+
+from ckan_cloud_operator import cloudflare
+
+
+def _response(status_code, data=None, headers=None):
+    res = MagicMock(status_code=status_code, headers=headers or {})
+    res.json.return_value = data
+    return res
+
+
+class CloudflareTestCase(unittest.TestCase):
+
+    def setUp(self):
+        cloudflare.clear_cache()
+        self.session = MagicMock()
+        patcher = patch('ckan_cloud_operator.cloudflare._get_session', return_value=self.session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _get_urls(self):
+        return [(c[0][0], c[0][1].replace(cloudflare.API_URL, '')) for c in self.session.request.call_args_list]
+
+    def test_update_a_records(self):
+        def _request(method, url, json=None, timeout=None):
+            if '?name=' in url:
+                return _response(200, {'success': True, 'result': [{'id': 'z1', 'name': 'ckan.io'}]})
+            elif method == 'GET':
+                page = int(url.split('page=')[1].split('&')[0])
+                return _response(200, {'success': True, 'result_info': {'total_pages': 2}, 'result': [
+                    {'id': f'r{page}', 'name': f'r{page}.ckan.io', 'type': 'A', 'content': '1.2.3.4', 'ttl': 120,
+                     'proxied': False}
+                ]})
+            else:
+                return _response(200, {'success': True, 'result': dict(json, id='new')})
+
+        self.session.request.side_effect = _request
+        for sub_domain in ['r1', 'r2', 'r3', 'r4']:
+            cloudflare.update_a_record('a@b.c', 'key', 'ckan.io', f'{sub_domain}.ckan.io', '1.2.3.4')
+        cloudflare.update_a_record('a@b.c', 'key', 'ckan.io', 'r3.ckan.io', '1.2.3.5')
+        self.assertEqual(self._get_urls(), [
+            ('GET', 'zones?name=ckan.io'),
+            ('GET', 'zones/z1/dns_records?page=1&per_page=1000'),
+            ('GET', 'zones/z1/dns_records?page=2&per_page=1000'),
+            ('POST', 'zones/z1/dns_records'),
+            ('POST', 'zones/z1/dns_records'),
+            ('PUT', 'zones/z1/dns_records/new'),
+        ])
+
+    @patch('time.sleep')
+    def test_rate_limit_retry(self, sleep):
+        self.session.request.side_effect = [
+            _response(429, headers={'Retry-After': '3'}), _response(429), _response(200, {'success': True})
+        ]
+        self.assertEqual(cloudflare.request('a@b.c', 'key', 'zones'), {'success': True})
+        self.assertEqual([c[0][0] for c in sleep.call_args_list], [3, 2])
+
+    @patch('time.sleep')
+    def test_connection_error_retry(self, sleep):
+        self.session.request.side_effect = [
+            cloudflare.requests.ConnectionError('reset'), cloudflare.requests.Timeout(), _response(200, {'success': True})
+        ]
+        self.assertEqual(cloudflare.request('a@b.c', 'key', 'zones'), {'success': True})
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_update_a_record_ignores_other_record_types(self):
+        def _request(method, url, json=None, timeout=None):
+            if '?name=' in url:
+                return _response(200, {'success': True, 'result': [{'id': 'z1', 'name': 'ckan.io'}]})
+            elif method == 'GET':
+                return _response(200, {'success': True, 'result': [
+                    {'id': 'a1', 'name': 'r1.ckan.io', 'type': 'A', 'content': '1.2.3.4', 'ttl': 120,
+                     'proxied': False},
+                    {'id': 't1', 'name': 'r1.ckan.io', 'type': 'TXT', 'content': 'verify', 'ttl': 120,
+                     'proxied': False},
+                ]})
+            else:
+                return _response(200, {'success': True, 'result': dict(json, id='a1')})
+
+        self.session.request.side_effect = _request
+        cloudflare.update_a_record('a@b.c', 'key', 'ckan.io', 'r1.ckan.io', '1.2.3.4')
+        cloudflare.update_a_record('a@b.c', 'key', 'ckan.io', 'r1.ckan.io', '1.2.3.5')
+        self.assertEqual(self._get_urls()[-1], ('PUT', 'zones/z1/dns_records/a1'))
+        self.assertEqual(len(self._get_urls()), 3)
@@ -86,7 +86,7 @@ class RoutersManagerTestCase(unittest.TestCase):
         manager.update('datapusher', wait_ready=True)
         _init_router.assert_called_once_with('datapusher')
         list.assert_called_once_with({})
-        traefik_manager.update.assert_called_once_with('datapusher', True, {'update': True}, {}, 'router', dry_run=False)
+        traefik_manager.update.assert_called_once_with('datapusher', True, {'update': True}, {}, 'router', dry_run=False, full=False)
 
     @patch('ckan_cloud_operator.kubectl.get')
     def test_list(self, get):
@@ -0,0 +1,94 @@
+import json
+import unittest
+from unittest.mock import patch, MagicMock
+
+from ckan_cloud_operator.routers.traefik import deployment
+from ckan_cloud_operator.providers.routers.dns import FakeDnsProvider
+
+
+def _route(name, sub_domain, backend_url):
+    return {
+        'metadata': {'name': name},
+        'spec': {'type': 'backend-url-subdomain', 'sub-domain': sub_domain, 'root-domain': 'ckan.io',
+                 'backend-url': backend_url}
+    }
+
+
+def _config(routes):
+    return {
+        'frontends': {r['metadata']['name']: {'backend': r['metadata']['name']} for r in routes},
+        'backends': {r['metadata']['name']: {'url': r['spec']['backend-url']} for r in routes},
+    }
+
+
+@patch('ckan_cloud_operator.routers.traefik.deployment._get_deployment_spec',
+       new=lambda *args, **kwargs: {'template': {'metadata': {}}})
+@patch('ckan_cloud_operator.routers.traefik.deployment.get_labels', new=lambda *args, **kwargs: {'app': 'traefik'})
+@patch('ckan_cloud_operator.routers.traefik.deployment.get_load_balancer_ip', new=lambda *args: '1.2.3.4')
+@patch('ckan_cloud_operator.routers.traefik.deployment.get_cloudflare_credentials', new=lambda: ('a@b.c', 'key'))
+@patch('ckan_cloud_operator.kubectl.get_resource', new=lambda *args, **kwargs: {'metadata': {}})
+class TraefikDeploymentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dns_provider = FakeDnsProvider()
+
+    def _update(self, routes, deployed_configmap, full=False):
+        spec = {'type': 'traefik', 'dns-provider': 'fake'}
+        with patch('ckan_cloud_operator.kubectl.get', return_value=deployed_configmap), \
+             patch('ckan_cloud_operator.kubectl.apply') as apply, \
+             patch('ckan_cloud_operator.routers.traefik.config.get', return_value=_config(routes)), \
+             patch('ckan_cloud_operator.routers.routes.manager.get_domain_parts',
+                   new=lambda route: (route['spec']['root-domain'], route['spec']['sub-domain'])), \
+             patch('ckan_cloud_operator.routers.routes.manager.pre_deployment_hook') as pre_deployment_hook, \
+             patch('ckan_cloud_operator.providers.routers.dns.get_provider', return_value=self.dns_provider):
+            num_requests = self.dns_provider.num_requests
+            deployment._update('instances-default', spec, MagicMock(), routes, full=full)
+        configmap = [call[0][0] for call in apply.call_args_list if call[0][0].get('data')][0]
+        return configmap, pre_deployment_hook, self.dns_provider.num_requests - num_requests
+
+    def test_update_only_changed_routes(self):
+        routes = [_route('r1', 'one', 'http://one'), _route('r2', 'two', 'http://two')]
+        configmap, pre_deployment_hook, num_dns_requests = self._update(routes, None)
+        self.assertEqual(pre_deployment_hook.call_count, 2)
+        # one list of the zone records and one batch update
+        self.assertEqual(num_dns_requests, 2)
+        self.assertEqual(self.dns_provider.zones['ckan.io'], {
+            'one.ckan.io': {'type': 'A', 'content': '1.2.3.4'},
+            'two.ckan.io': {'type': 'A', 'content': '1.2.3.4'},
+        })
+        routes = [_route('r1', 'one', 'http://one'), _route('r2', 'two', 'http://two2'), _route('r3', 'three', 'http://3')]
+        _, pre_deployment_hook, num_dns_requests = self._update(routes, configmap)
+        self.assertEqual([c[0][0]['metadata']['name'] for c in pre_deployment_hook.call_args_list], ['r2', 'r3'])
+        self.assertEqual(num_dns_requests, 2)
+        self.assertEqual(sorted(self.dns_provider.zones['ckan.io']), ['one.ckan.io', 'three.ckan.io', 'two.ckan.io'])
+
+    def test_update_no_changes(self):
+        routes = [_route('r1', 'one', 'http://one')]
+        configmap, _, _ = self._update(routes, None)
+        new_configmap, pre_deployment_hook, num_dns_requests = self._update(routes, configmap)
+        self.assertEqual(pre_deployment_hook.call_count, 0)
+        self.assertEqual(num_dns_requests, 0)
+        self.assertEqual(json.loads(new_configmap['metadata']['annotations']['ckan-cloud/route-hashes']).keys(), {'r1'})
+
+    def test_update_full(self):
+        routes = [_route('r1', 'one', 'http://one')]
+        configmap, _, _ = self._update(routes, None)
+        _, pre_deployment_hook, num_dns_requests = self._update(routes, configmap, full=True)
+        self.assertEqual(pre_deployment_hook.call_count, 1)
+        # the zone is listed but the record is unchanged
+        self.assertEqual(num_dns_requests, 1)
+
+    def test_update_removed_route(self):
+        routes = [_route('r1', 'one', 'http://one'), _route('r2', 'two', 'http://two')]
+        configmap, _, _ = self._update(routes, None)
+        self.dns_provider.zones['ckan.io']['other.ckan.io'] = {'type': 'A', 'content': '5.6.7.8'}
+        self._update(routes[:1], configmap)
+        self.assertEqual(sorted(self.dns_provider.zones['ckan.io']), ['one.ckan.io', 'other.ckan.io'])
+
+
+class TraefikReplicasTestCase(unittest.TestCase):
+
+    def test_get_replicas(self):
+        self.assertEqual(deployment._get_replicas('r', {}, {'acme': {}}), 1)
+        self.assertEqual(deployment._get_replicas('r', {'replicas': 3}, {'acme': {}}), 1)
+        self.assertEqual(deployment._get_replicas('r', {'replicas': 3}, {}), 3)
@@ -0,0 +1,79 @@
+import unittest
+from collections import namedtuple
+from unittest.mock import MagicMock, patch
+
+from ckan_cloud_operator import datastore_permissions
+
+
+Column = namedtuple('Column', ['name'])
+
+
+class FakeCursor(object):
+
+    def __init__(self, check_row):
+        self.check_row = check_row
+        self.description = [Column(name) for name in ['connect', 'usage', 'select_tables', 'default_select',
+                                                       'template']]
+        self.statements = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, statement, args=None):
+        self.statements.append(statement)
+
+    def fetchone(self):
+        return self.check_row
+
+
+class DatastorePermissionsTestCase(unittest.TestCase):
+
+    def _reconcile(self, check_row, dry_run=False):
+        cur = FakeCursor(check_row)
+        conn = MagicMock(cursor=lambda: cur)
+        missing = datastore_permissions.reconcile(conn, 'ds1', 'ds1', 'ds1-ro', dry_run=dry_run)
+        return missing, cur.statements[1:]
+
+    def test_no_missing_permissions(self):
+        missing, statements = self._reconcile((True, True, True, True, True))
+        self.assertEqual(missing, [])
+        self.assertEqual(statements, [])
+
+    def test_missing_permissions(self):
+        missing, statements = self._reconcile((True, True, False, True, False))
+        self.assertEqual(missing, ['select_tables', 'template'])
+        self.assertEqual(statements[0], 'GRANT SELECT ON ALL TABLES IN SCHEMA public TO "ds1-ro";')
+        self.assertIn('GRANT SELECT ON "_table_metadata" TO "ds1-ro"', statements[1])
+        self.assertEqual(len(statements), 2)
+
+    def test_dry_run(self):
+        missing, statements = self._reconcile((False, True, True, True, True), dry_run=True)
+        self.assertEqual(missing, ['connect'])
+        self.assertEqual(statements, [])
+
+    @patch('ckan_cloud_operator.drivers.postgres.driver.connect')
+    def test_reconcile_all(self, connect):
+        def _get_connection_string(db_name, db_prefix):
+            if db_name == 'no-credentials':
+                raise Exception('missing admin credentials')
+            return f'postgresql://{db_name}'
+
+        def _reconcile(conn, db_name, site_user, ro_user, dry_run=False):
+            if db_name == 'bad':
+                raise Exception('role does not exist')
+            return ['usage']
+
+        with patch('ckan_cloud_operator.datastore_permissions.reconcile', side_effect=_reconcile), \
+                patch('ckan_cloud_operator.providers.db.manager.get_external_admin_connection_string',
+                      side_effect=_get_connection_string):
+            results = list(datastore_permissions.reconcile_all([('no-credentials', 'no-credentials', 'nc-ro', None),
+                                                                ('ds1', 'ds1', 'ds1-ro', None),
+                                                                ('bad', 'bad', 'bad-ro', None)]))
+        self.assertEqual(results[0]['error'], 'missing admin credentials')
+        self.assertEqual(results[1]['missing'], ['usage'])
+        self.assertEqual(results[2]['error'], 'role does not exist')
+        self.assertEqual(connect.call_count, 2)
+        self.assertEqual(connect.return_value.__enter__.return_value.close.call_count, 2)
@@ -0,0 +1,79 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import requests
+
+from ckan_cloud_operator import gitlab
+
+
+class FakeSession(object):
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def request(self, method, url, json=None, headers=None, timeout=None):
+        self.requests.append((method, url, dict(headers or {})))
+        status_code, etag, text = self.responses[url].pop(0)
+        return FakeResponse(status_code, etag, text)
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, etag, text):
+        self.status_code = status_code
+        self.headers = {'ETag': etag} if etag else {}
+        self.text = text
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(self.status_code)
+
+
+class GitlabClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        gitlab.clear_cache()
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cache_dir.cleanup)
+
+    def _session(self, responses):
+        session = FakeSession(responses)
+        patchers = [patch('ckan_cloud_operator.gitlab.CACHE_DIR', new=self.cache_dir.name),
+                    patch('ckan_cloud_operator.gitlab._get_session', return_value=session)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return session
+
+    def test_request_etag_cache(self):
+        url = f'{gitlab.API_URL}projects/1/repository/files/Dockerfile/raw?ref=master'
+        session = self._session({url: [(200, '"v1"', 'FROM a'), (304, None, ''), (200, '"v2"', 'FROM b')]})
+        self.assertEqual(gitlab.request('projects/1/repository/files/Dockerfile/raw?ref=master'), 'FROM a')
+        self.assertEqual(gitlab.request('projects/1/repository/files/Dockerfile/raw?ref=master'), 'FROM a')
+        self.assertEqual(gitlab.request('projects/1/repository/files/Dockerfile/raw?ref=master'), 'FROM b')
+        self.assertEqual([headers for _, _, headers in session.requests],
+                         [{}, {'If-None-Match': '"v1"'}, {'If-None-Match': '"v1"'}])
+        cache_files = [os.path.join(root, f) for root, _, files in os.walk(self.cache_dir.name) for f in files]
+        self.assertEqual(len(cache_files), 1)
+        self.assertEqual(os.stat(cache_files[0]).st_mode & 0o777, 0o600)
+
+    def test_get_files(self):
+        responses = {
+            f'{gitlab.API_URL}projects/org%2Frepo{i}': [(200, None, json.dumps({'id': i}))] for i in range(3)
+        }
+        responses.update({
+            f'{gitlab.API_URL}projects/{i}/repository/files/Dockerfile/raw?ref=master': [(200, None, f'FROM {i}')]
+            for i in range(2)
+        })
+        responses[f'{gitlab.API_URL}projects/2/repository/files/Dockerfile/raw?ref=master'] = [(404, None, '')]
+        self._session(responses)
+        dockerfiles = gitlab.get_files([f'org/repo{i}' for i in range(3)], 'Dockerfile')
+        self.assertEqual(dockerfiles['org/repo0'], 'FROM 0')
+        self.assertEqual(dockerfiles['org/repo1'], 'FROM 1')
+        self.assertIsNone(dockerfiles['org/repo2'])
+        # the project ids are cached
+        self.assertEqual(gitlab.get_project_id('org/repo2'), 2)
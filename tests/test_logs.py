@@ -0,0 +1,18 @@
+import json
+import unittest
+
+from ckan_cloud_operator import logs
+
+
+def _log_event(event):
+    return logs.CKAN_CLOUD_LOG_START + json.dumps({'event': event}) + logs.CKAN_CLOUD_LOG_END + '\n'
+
+
+class CkanCloudLogsTestCase(unittest.TestCase):
+
+    def test_parse_ckan_cloud_logs(self):
+        logdatas, remaining = logs.parse_ckan_cloud_logs('foo\n' + _log_event('a') + '--START_CKAN_CLOUD_LOG--{"ev')
+        self.assertEqual(logdatas, [{'event': 'a'}])
+        self.assertEqual(remaining, '--START_CKAN_CLOUD_LOG--{"ev')
+        logdatas, remaining = logs.parse_ckan_cloud_logs(remaining + 'ent": "b"}--END_CKAN_CLOUD_LOG--\n')
+        self.assertEqual((logdatas, remaining), ([{'event': 'b'}], ''))